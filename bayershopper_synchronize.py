@@ -45,17 +45,23 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'classes
 
 import datetime
 import logging
+import collections
+import threading
+import time
+import json
 
 from optparse import OptionParser
 from ConfigParser import SafeConfigParser
 
-from simple_salesforce import Salesforce, SalesforceLogin, SalesforceAuthenticationFailed
-import requests
-
-import psycopg2, psycopg2.extensions, psycopg2.extras
-
-from get_inspections import GetInspections
-from swdb import SWDB
+u"""
+simple_salesforce, requests, psycopg2 und die Module, die sie benötigen, werden erst dort
+importiert, wo sie gebraucht werden. Aufrufe mit --help oder ungültigen Argumenten
+kommen damit ohne sie aus.
+"""
+from snapshot_cache import SnapshotCache
+from inspection_state import InspectionState
+from session_cache import SessionCache
+from run_metrics import RunMetrics
 
 class App(object):
     u"""
@@ -71,19 +77,31 @@ class App(object):
     _instance, _session, _session_id, _sf_instance, _session_id, _sf_instance = (None,)*6
     _loggingLevels = { logging.NOTSET: "NOTSET", logging.DEBUG: "DEBUG", logging.INFO: "INFO",
             logging.WARNING: "WARNING", logging.ERROR: "ERROR", logging.CRITICAL: "CRITICAL" }
-    __swdb = (None,)
+    _salesforceLock = threading.Lock()
+    __swdb, __writeback = (None,)*2
 
     """ public """
-    config, logger, options, args, session, salesforce, postgresql = (None,)*7
+    config, logger, options, args, session, salesforce, postgresql, snapshotCache, tourDates, lastError = (None,)*10
+    sessionCache, metrics, inspectionState, salesforceTransport = (None,)*4
 
     def __init__(self):
+        self.metrics = RunMetrics()
         self.initConfig()
         self.initOptionParser()
         self.initLogging()
         self.checkArguments()
-        self.initSalesforce()
-        self.initPostgresql()
-        self.dispatch()
+        self.initSnapshotCache()
+        self.initInspectionState()
+        self.initConnections()
+        if self.options.checkSchema:
+            self.checkSchema()
+        elif self.options.daemon:
+            from sync_daemon import SyncDaemon
+            SyncDaemon(self).run()
+        elif self.options.profile:
+            self.profileDispatch()
+        else:
+            self.dispatch()
 
 
     def initConfig(self):
@@ -102,13 +120,64 @@ class App(object):
                 soapSecurityToken = <SALESFORCE-SECURITY-TOKEN>
                 soapSandbox = False|True
                 soapVersion = <VERSION> ; aktuell 38.0
+                sessionCache = <DATEI> ; optional, Default <SCRIPTNAME>.session
+                sessionLifetime = <SEKUNDEN> ; optional, Default 7200
+                fetchEngine = rest|bulk|auto ; optional, Default auto
+                bulkThreshold = <ANZAHL> ; optional, Default 10000
+                fetchWorkers = <ANZAHL> ; optional, parallele Abrufe bei mehreren Tourdaten, Default 4
+                poolSize = <ANZAHL> ; optional, Keep-Alive-Verbindungen im Pool, Default 10
+                retries = <ANZAHL> ; optional, Wiederholungen idempotenter Aufrufe, Default 5
+                backoff = <SEKUNDEN> ; optional, Basis der exponentiellen Wartezeit, Default 0.5
+                timeout = <SEKUNDEN> ; optional, Lese-Timeout je Aufruf, Default 120
+                quotaReserve = <ANTEIL> ; optional, Reserve des täglichen API-Limits, Default 0.1
+                throttleDelay = <SEKUNDEN> ; optional, Verzögerung je Aufruf in der Reserve, Default 1.0
+
+                [postgresql]
+                database = <DATENBANK>
+                host = <HOST>
+                user = <BENUTZER>
+                password = <PASSWORT>
+                shards = <ANZAHL> ; optional, paralleler Abgleich auf mehreren Verbindungen, Default 1
+                activePharmaciesView = True|False ; optional, Sicht active_pharmacies_mv pflegen, Default True
+                applyBatchSize = <ANZAHL> ; optional, Apotheken je Savepoint, Default 100
+                rejectFile = <DATEI> ; optional, Quarantäne für --resume, Default <SCRIPTNAME>.rejects.json
+
+                [writeback]
+                statusField = <FELD> ; Feld der Inspektion, das nach dem Commit gesetzt wird
+                statusValue = <WERT> ; optional, Default: Zeitpunkt des Abgleichs
+                outletIdField = <FELD> ; optional, Feld für die Outlet-Id der SWDB
+                batchSize = <ANZAHL> ; optional, höchstens 200
+                retries = <ANZAHL> ; optional, Default 3
 
                 [logging]
                 formatstring = %%(asctime)s - %%(filename)s - %%(funcName)s - %%(levelname)s - %%(message)s
+
+                [daemon]
+                interval = <MINUTEN> ; Default 15
+                socket = <PFAD> ; Default <SCRIPTNAME>.sock
+
+                [metrics]
+                jsonfile = <DATEI> ; optional, Kennzahlen als JSON
+                promfile = <DATEI> ; optional, Kennzahlen für den Prometheus-Textfile-Collector
+
+                [incremental]
+                directory = <VERZEICHNIS> ; letzter Stand der Inspektionen je Tourdatum
+                margin = <SEKUNDEN> ; optional, Überlappung vor der Watermark, Default 300
+
+                [cache]
+                directory = <VERZEICHNIS>
+                ttl = <SEKUNDEN> ; Default 3600
+                maxsize = <BYTES> ; Default 52428800
             </pre>
 
             Der Abschnitt 'salesforce' enthält die Zugangsdaten zum Salesforce-Server von Bayer. Im Abschnitt
-            [logging] wird das Format des Log-Strings definiert.
+            [logging] wird das Format des Log-Strings definiert. Der optionale Abschnitt [cache] aktiviert
+            den Zwischenspeicher für die Salesforce-Abfragen, der Abschnitt [daemon] konfiguriert den
+            Daemon-Modus. Mit dem Abschnitt [incremental] werden nach dem ersten Abruf eines
+            Tourdatums nur noch geänderte und gelöschte Inspektionen aus Salesforce geholt und
+            mit dem zuletzt bekannten Stand zusammengeführt. Ist der Abschnitt [writeback]
+            vorhanden, werden die verarbeiteten Inspektionen nach einem Commit in Salesforce
+            markiert.
         """
         self.config = SafeConfigParser()
         self.config.readfp(open(self.APPNAME + '.cfg'))
@@ -169,11 +238,106 @@ class App(object):
                     outlet_id_seq wird für neu anzulegende Outlets inkrementiert. Der Wert
                     für die nächste ID wird bei einem Rollback jedoch nicht auf den vorherigen
                     Wert zurückgesetzt. Dies ist ein dokumentiertes Verhalten von PostreSQL
+                    Mit --commit wird vor der Ausgabe übernommen und anschließend die
+                    materialisierte Sicht active_pharmacies_mv aktualisiert, aus der
+                    Ausgabe und Export dann lesen. Beim Abgleich ohne --bulk und --shards
+                    wird der Änderungsplan sofort nach dem Ausführen übernommen.
 
                 -o, --outfile
-                    Ausgabe der Apotheken in eine CSV-Datei
+                    Ausgabe der aktiven Apotheken in eine CSV-Datei bzw. bei der Endung
+                    .xlsx in eine Excel-Datei
+
+                -r, --refresh
+                    Vorhandenen Snapshot im Cache ignorieren und die Daten neu aus
+                    Salesforce abrufen
+
+                --full
+                    Mit [incremental]: den gespeicherten Stand ignorieren, alle Inspektionen
+                    des Tourdatums abrufen und den Stand neu aufbauen
+
+                -e, --engine <ENGINE>
+                    Abruf der Daten aus Salesforce über die REST-API ('rest'), als
+                    Bulk API 2.0 Query-Job ('bulk') oder abhängig von der Anzahl der
+                    Datensätze ('auto'). Bei 'auto' entscheidet totalSize der ersten
+                    REST-Seite, es wird nicht vorab gezählt. Überschreibt salesforce.fetchEngine.
+
+                -b, --bulk
+                    Mengenbasierter Abgleich: Alle Datensätze werden per COPY in eine
+                    temporäre Tabelle geladen und mit wenigen Statements abgeglichen,
+                    statt jede Apotheke einzeln abzufragen und anzulegen.
+
+                --plan
+                    Nur den Änderungsplan berechnen (neue, abgewiesene, zu aktivierende und
+                    zu deaktivierende Apotheken) und ausgeben, ohne die SWDB zu ändern
+
+                --save-plan <DATEI>
+                    Änderungsplan zusätzlich als JSON speichern
+
+                --resume
+                    Statt der Inspektionen der Tourdaten nur die Datensätze aus der Quarantäne
+                    (postgresql.rejectFile) erneut abgleichen. Dort landen mit --commit neue
+                    Apotheken mit fehlerhafter Account_Information__c und Apotheken, deren
+                    Anlage oder Aktualisierung fehlgeschlagen ist. Es wird nichts deaktiviert.
+
+                --seed-digests
+                    Vorhandene Apotheken ohne gespeicherte Prüfsumme (sf_sync_digest) nicht
+                    aktualisieren, sondern nur ihre Prüfsumme speichern. Einmalig nach dem
+                    Anlegen der Tabelle, wenn die SWDB auf dem Stand von Salesforce ist.
+                    Sonst schreibt der erste Abgleich alle vorhandenen Apotheken neu.
+
+                --shards <ANZAHL>
+                    Paralleler Abgleich: die Datensätze werden nach Shopper_Contract__c auf
+                    <ANZAHL> Verbindungen verteilt und in einer gemeinsamen Two-Phase-Commit-
+                    Transaktion übernommen oder verworfen. Überschreibt postgresql.shards.
+                    Setzt max_prepared_transactions >= <ANZAHL> auf dem Server voraus.
+
+                -s, --summary
+                    Nach dem Abgleich nur die Anzahl der aktiven Apotheken je Status
+                    ausgeben statt der Tabelle aller aktiven Apotheken
+
+                --limit <ANZAHL>
+                    Höchstens <ANZAHL> aktive Apotheken ausgeben
+
+                --page-size <ANZAHL>
+                    Tabellenkopf alle <ANZAHL> Zeilen wiederholen
+
+                -p, --progress
+                    Fortschrittsbalken mit Durchsatz statt der einzelnen Datensätze anzeigen
+
+                --metrics-json <DATEI>
+                    Kennzahlen des Laufs (Dauer je Stufe, SQL-Statements, Zeilen, API-Aufrufe,
+                    angelegte/aktivierte/deaktivierte Apotheken) als JSON schreiben
+
+                --metrics-prom <DATEI>
+                    Kennzahlen für den Textfile-Collector des Prometheus node_exporter schreiben
+
+                --profile <DATEI>
+                    Den Abgleich mit cProfile ausführen und die Statistik im pstats-Format
+                    in <DATEI> schreiben. Ausgegeben werden die Funktionen mit der höchsten
+                    kumulierten Laufzeit und für jedes SQL-Statement aus SWDB Anzahl,
+                    Gesamtdauer und 95. Perzentil je Abfragetext.
+
+                --profile-top <ANZAHL>
+                    Anzahl der ausgegebenen Funktionen und Statements, Default 30
+
+                --check-schema
+                    Kein Abgleich: prüft die Indizes der vom Abgleich genutzten Tabellen
+                    (pg_indexes), meldet fehlende und nie verwendete Indizes und prüft die
+                    Abfragen aus SWDB mit EXPLAIN. Prüft außerdem, ob die Tabelle der
+                    Prüfsummen (sf_sync_digest) existiert, ohne sie bricht der Abgleich ab.
+                    Exit-Status 1 bei fehlenden Indizes oder Tabellen.
+
+                --create-indexes
+                    Mit --check-schema: fehlende Indizes mit CREATE INDEX CONCURRENTLY und
+                    die Tabelle sf_sync_digest anlegen
+
+                -d, --daemon
+                    Als Daemon laufen: Salesforce-Session und Datenbankverbindung bleiben
+                    bestehen, der Abgleich für das aktuelle Datum wird im Intervall aus
+                    daemon.interval ausgeführt und kann zusätzlich über den Unix-Socket
+                    daemon.socket oder das Signal SIGUSR1 angestoßen werden.
         """
-        USAGE = "usage: %prog [options] tourdate"
+        USAGE = "usage: %prog [options] tourdate[-tourdate] [tourdate[-tourdate] ...]"
         DESCRIPTION = u"""
         """
         VERSION = u"Version {0} vom {1}".format(self.APPVERSION, self.APPDATE)
@@ -186,155 +350,731 @@ class App(object):
                 help="Name und Pfad der Logdatei")
         parser.add_option("-q", "--quiet", dest="quiet", action="store_true", help=u"Unterdrücke Ausgaben auf die Kommandozeile")
         parser.add_option("-o", "--outfile", dest="outfile", 
-                help=u"Zusätzliche Ausgabe der neuen Apotheken in eine CSV-Datei")
+                help=u"Zusätzliche Ausgabe der aktiven Apotheken in eine CSV- oder XLSX-Datei (nach Endung)")
         parser.add_option("-c", "--commit", dest="commit", action="store_true", default=False,
                 help=u"""Transaktion mit commit beenden und Änderungen in die Datenbank übernehmen. Andernfalls
 werden die Änderungen wieder zurückgerollt. Bei einem Fehler werden die Änderungen
 ebenfalls wieder zurückgerollt.""")
+        parser.add_option("-r", "--refresh", dest="refresh", action="store_true", default=False,
+                help=u"Snapshot im Cache ignorieren und Daten neu aus Salesforce abrufen")
+        parser.add_option("--full", dest="full", action="store_true", default=False,
+                help=u"Inkrementellen Stand ignorieren und alle Inspektionen neu abrufen")
+        parser.add_option("-e", "--engine", dest="engine", choices=['rest', 'bulk', 'auto'],
+                help=u"Abruf aus Salesforce: [rest, bulk, auto]")
+        parser.add_option("-b", "--bulk", dest="bulk", action="store_true", default=False,
+                help=u"Mengenbasierter Abgleich über eine temporäre Staging-Tabelle")
+
+        parser.add_option("--plan", dest="planOnly", action="store_true", default=False,
+                help=u"Nur den Änderungsplan berechnen und ausgeben, nichts ändern")
+        parser.add_option("--save-plan", dest="savePlan",
+                help=u"Änderungsplan als JSON in diese Datei schreiben")
+        parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                help=u"Nur die Datensätze aus der Quarantäne erneut abgleichen")
+        parser.add_option("--seed-digests", dest="seedDigests", action="store_true", default=False,
+                help=u"Fehlende Prüfsummen vorhandener Apotheken nur speichern, ohne sie zu aktualisieren")
+        parser.add_option("--shards", dest="shards", type="int",
+                help=u"Abgleich parallel auf <ANZAHL> Verbindungen")
+        parser.add_option("-s", "--summary", dest="summary", action="store_true", default=False,
+                help=u"Nur eine Zusammenfassung der aktiven Apotheken ausgeben")
+        parser.add_option("--limit", dest="limit", type="int",
+                help=u"Höchstens diese Anzahl aktiver Apotheken ausgeben")
+        parser.add_option("--page-size", dest="pageSize", type="int", default=0,
+                help=u"Tabellenkopf alle <ANZAHL> Zeilen wiederholen")
+        parser.add_option("-p", "--progress", dest="progress", action="store_true", default=False,
+                help=u"Fortschrittsbalken mit Durchsatz anzeigen")
+        parser.add_option("--metrics-json", dest="metricsJson",
+                help=u"Kennzahlen des Laufs als JSON in diese Datei schreiben")
+        parser.add_option("--metrics-prom", dest="metricsProm",
+                help=u"Kennzahlen für den Prometheus-Textfile-Collector in diese Datei schreiben")
+        parser.add_option("--profile", dest="profile",
+                help=u"Abgleich mit cProfile ausführen und die Statistik in diese Datei schreiben")
+        parser.add_option("--profile-top", dest="profileTop", type="int", default=30,
+                help=u"Anzahl der ausgegebenen Funktionen und Statements mit --profile")
+        parser.add_option("--check-schema", dest="checkSchema", action="store_true", default=False,
+                help=u"Indizes und Ausführungspläne der SWDB prüfen, kein Abgleich")
+        parser.add_option("--create-indexes", dest="createIndexes", action="store_true", default=False,
+                help=u"Mit --check-schema fehlende Indizes und Tabellen anlegen")
+        parser.add_option("-d", "--daemon", dest="daemon", action="store_true", default=False,
+                help=u"Als Daemon laufen und den Abgleich zyklisch ausführen")
 
         (self.options, self.args) = parser.parse_args()
 
 
-    def initSalesforce(self):
+    def initConnections(self):
+        u"""
+            Meldet sich bei Salesforce an und verbindet sich mit der SWDB.
+
+            Beide Handshakes laufen gleichzeitig, die Anmeldung bei Salesforce in einem eigenen
+            Thread. Der Start dauert damit etwa so lange wie der langsamere der beiden statt
+            ihrer Summe. Ein Fehler bei der Anmeldung wird im Hauptthread erneut ausgelöst.
+
+            Für --check-schema wird nur die SWDB benötigt, die Anmeldung bei Salesforce entfällt.
+
+            @throws Exception
+        """
+        if self.options.checkSchema:
+            self.initPostgresql()
+            return
+
+        failure = []
+        def login():
+            try:
+                self.initSalesforce()
+            except BaseException:
+                failure.append(sys.exc_info())
+
+        thread = threading.Thread(target=login, name='salesforce-login')
+        thread.daemon = True
+        thread.start()
+        try:
+            self.initPostgresql()
+        finally:
+            thread.join()
+
+        if failure:
+            excType, excValue, excTraceback = failure[0]
+            raise excType, excValue, excTraceback
+
+
+    def initSalesforce(self, force=False):
         u"""
             Initialisiert die Salesforce-Verbindung
 
             Öffnet eine Verbindung zum Salesforce-Server und etabliert eine entsprechende Session.
             Zugriffe auf Salesforce können dann mit app.salesforce.<OBJECT>.<METHOD>() durchgeführt werden.
 
+            Eine noch gültige Session aus dem Session-Cache (salesforce.sessionCache, Default
+            <SCRIPTNAME>.session) wird wiederverwendet, statt sich erneut anzumelden. Mit
+            force=True wird die gespeicherte Session verworfen und immer neu angemeldet.
+
+            Die HTTP-Session wird einmal von SalesforceTransport erzeugt und bleibt über neue
+            Anmeldungen hinweg bestehen: Verbindungspool, gzip, Wiederholungen mit Backoff und
+            Drosselung bei knappem API-Kontingent (salesforce.poolSize, retries, backoff,
+            timeout, quotaReserve, throttleDelay).
+
             Beispiel:
                 app.salesforce.Shopper_Inspection__c.update(<INSPECTION_ID>, { <KEY>: <VALUE>[, <KEY>: <VALUE>[, ...]] })
                 führt ein Update auf einen Datensatz der Tabelle Shopper_Inspection__c durch.
         """
-        self.session = requests.Session()
-        try:
-            self._session_id, self._sf_instance = SalesforceLogin(username=self.config.get('salesforce', 'soapUsername'), \
-                    password=self.config.get('salesforce', 'soapPassword'),
-                    sf_version=self.config.get('salesforce', 'soapVersion'),
-                    sandbox=(self.config.get('salesforce', 'soapSandbox') == 'True'))
-        except SalesforceAuthenticationFailed as e:
-            self.logger.critical("login to salesforce failed: {:s}" . format(e.message))
-            print("Login to salesforce failed: {:s}" . format(e.message))
-            exit()
+        from simple_salesforce import Salesforce, SalesforceLogin, SalesforceAuthenticationFailed
+        from salesforce_transport import SalesforceTransport
+
+        username = self.config.get('salesforce', 'soapUsername')
+        version = self.config.get('salesforce', 'soapVersion')
+        sandbox = (self.config.get('salesforce', 'soapSandbox') == 'True')
+
+        if self.sessionCache is None:
+            path = self.config.get('salesforce', 'sessionCache') \
+                    if self.config.has_option('salesforce', 'sessionCache') else self.APPNAME + '.session'
+            maxAge = self.config.getint('salesforce', 'sessionLifetime') \
+                    if self.config.has_option('salesforce', 'sessionLifetime') else 7200
+            self.sessionCache = SessionCache(self, path, maxAge=maxAge)
+
+        if self.session is None:
+            self.salesforceTransport = SalesforceTransport(self)
+            self.session = self.salesforceTransport.createSession()
+
+        cached = None
+        if force:
+            self.sessionCache.invalidate(username, sandbox, version)
+        else:
+            cached = self.sessionCache.get(username, sandbox, version)
+
+        if cached:
+            self._session_id, self._sf_instance = cached
+            self.logger.debug('Reusing cached Salesforce session')
+        else:
+            try:
+                with self.metrics.stage(u'login'):
+                    self._session_id, self._sf_instance = SalesforceLogin(username=username, \
+                            password=self.config.get('salesforce', 'soapPassword'),
+                            sf_version=version,
+                            sandbox=sandbox)
+                self.metrics.count(u'salesforce_logins')
+            except SalesforceAuthenticationFailed as e:
+                self.logger.critical("login to salesforce failed: {:s}" . format(e.message))
+                print("Login to salesforce failed: {:s}" . format(e.message))
+                exit()
+            self.sessionCache.put(username, sandbox, version, self._session_id, self._sf_instance)
 
         self.salesforce = Salesforce(instance=self._sf_instance, session_id=self._session_id, session=self.session)
 
         self.logger.debug('Connection to Salesforce established')
 
 
+    def callSalesforce(self, method, *args, **kwargs):
+        u"""
+            Ruft app.salesforce.<method>(*args, **kwargs) auf. Weist Salesforce die Session als
+            abgelaufen zurück, wird neu angemeldet und der Aufruf einmal wiederholt. Melden
+            mehrere Threads gleichzeitig eine abgelaufene Session, meldet sich nur einer neu an.
+
+            Jeder Aufruf zählt als ein API-Request (salesforce_api_calls). Methoden, die intern
+            mehrere Requests absetzen wie query_all, werden daher nicht verwendet, Abfragen über
+            mehrere Seiten laufen seitenweise über query/query_more.
+        """
+        from simple_salesforce import SalesforceExpiredSession
+
+        salesforce = self.salesforce
+        try:
+            with self.metrics.stage(u'salesforce_' + method):
+                self.metrics.count(u'salesforce_api_calls')
+                return getattr(salesforce, method)(*args, **kwargs)
+        except SalesforceExpiredSession:
+            self.refreshSalesforce(salesforce)
+
+        with self.metrics.stage(u'salesforce_' + method):
+            self.metrics.count(u'salesforce_api_calls')
+            return getattr(self.salesforce, method)(*args, **kwargs)
+
+
+    def refreshSalesforce(self, expired):
+        u"""
+            Meldet sich neu an, sofern 'expired' noch die aktuelle Verbindung ist. Andernfalls hat
+            ein anderer Thread die Session bereits erneuert.
+        """
+        with self._salesforceLock:
+            if self.salesforce is expired:
+                self.logger.info('Salesforce session expired -> login')
+                self.initSalesforce(force=True)
+
+
+    def initSnapshotCache(self):
+        u"""
+            Initialisiert den Zwischenspeicher für Salesforce-Abfragen, sofern in der
+            Konfiguration ein Abschnitt [cache] vorhanden ist.
+        """
+        if not self.config.has_section('cache'):
+            return
+
+        ttl = self.config.getint('cache', 'ttl') if self.config.has_option('cache', 'ttl') else 3600
+        maxSize = self.config.getint('cache', 'maxsize') if self.config.has_option('cache', 'maxsize') else 50*1024*1024
+        self.snapshotCache = SnapshotCache(self, self.config.get('cache', 'directory'), ttl=ttl, maxSize=maxSize)
+
+        self.logger.debug('Snapshot cache initialized')
+
+
+    def initInspectionState(self):
+        u"""
+            Aktiviert den inkrementellen Abruf aus Salesforce, sofern in der Konfiguration ein
+            Abschnitt [incremental] vorhanden ist.
+        """
+        if not self.config.has_section('incremental'):
+            return
+
+        margin = self.config.getint('incremental', 'margin') \
+                if self.config.has_option('incremental', 'margin') else InspectionState.MARGIN
+        self.inspectionState = InspectionState(self, self.config.get('incremental', 'directory'), margin=margin)
+
+        self.logger.debug('Incremental fetch enabled')
+
+
     def initPostgresql(self):
-        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-        self.postgresql = psycopg2.connect(database=self.config.get('postgresql', 'database'), 
-                host=self.config.get('postgresql', 'host'),
-                user=self.config.get('postgresql', 'user'),
-                password=self.config.get('postgresql', 'password'))
-        self.postgresql.set_session(autocommit=False)
-        self.postgresql.set_client_encoding('UTF8')
-        self.postgresql.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-        
+        from swdb import SWDB
+
+        self.postgresql = self.connectPostgresql()
         self.logger.debug('Connection to PostgreSQL-Server established')
         self.__swdb = SWDB(self)
 
 
+    def connectPostgresql(self):
+        u"""
+            Öffnet eine neue Verbindung zur SWDB mit den Einstellungen aus dem Abschnitt
+            [postgresql]. Wird auch für die Shards des parallelen Abgleichs verwendet.
+
+            @return connection
+        """
+        import psycopg2, psycopg2.extensions
+
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+        with self.metrics.stage(u'connect'):
+            connection = psycopg2.connect(database=self.config.get('postgresql', 'database'), 
+                    host=self.config.get('postgresql', 'host'),
+                    user=self.config.get('postgresql', 'user'),
+                    password=self.config.get('postgresql', 'password'))
+        connection.set_session(autocommit=False)
+        connection.set_client_encoding('UTF8')
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+
+        return connection
+
+
     def checkArguments(self):
         u"""
         Checkt die Argumente auf Konsistenz und Format
+
+        Als Argumente werden ein oder mehrere Tourdaten im Format TT.MM.JJJJ oder Zeiträume
+        im Format TT.MM.JJJJ-TT.MM.JJJJ erwartet. Die Tourdaten werden sortiert und ohne
+        Duplikate in self.tourDates abgelegt. Im Daemon-Modus, mit --check-schema und mit --resume
+        sind keine Argumente nötig.
         """
-        if len(self.args) < 1:
+        if len(self.args) < 1 and not (self.options.daemon or self.options.checkSchema or self.options.resume):
             self.logger.critical('Zu wenig Argumente')
             sys.exit('Zu wenig Argumente')
 
+        if self.options.bulk and (self.options.shards or 1) > 1:
+            self.logger.critical('--bulk und --shards schliessen sich aus')
+            sys.exit('--bulk und --shards schliessen sich aus')
+
+        if (self.options.planOnly or self.options.savePlan) and (self.options.bulk or (self.options.shards or 1) > 1):
+            self.logger.critical('--plan und --save-plan sind mit --bulk und --shards nicht moeglich')
+            sys.exit('--plan und --save-plan sind mit --bulk und --shards nicht moeglich')
+
+        if self.options.profile and (self.options.daemon or self.options.checkSchema):
+            self.logger.critical('--profile ist mit --daemon und --check-schema nicht moeglich')
+            sys.exit('--profile ist mit --daemon und --check-schema nicht moeglich')
+
+        if self.options.seedDigests and (self.options.bulk or (self.options.shards or 1) > 1):
+            self.logger.critical('--seed-digests ist mit --bulk und --shards nicht moeglich')
+            sys.exit('--seed-digests ist mit --bulk und --shards nicht moeglich')
+
+        if self.options.resume and (self.options.bulk or (self.options.shards or 1) > 1 or self.options.daemon):
+            self.logger.critical('--resume ist mit --bulk, --shards und --daemon nicht moeglich')
+            sys.exit('--resume ist mit --bulk, --shards und --daemon nicht moeglich')
+
         try:
-            date = datetime.datetime.strptime(self.args[0], '%d.%m.%Y')
+            self.tourDates = self.parseTourDates(self.args)
         except ValueError, msg:
-            msg = '\'{:s}\' ist kein gültiges Datum' . format(self.args[0])
             self.logger.critical(msg)
             sys.exit(msg)
 
 
-    def dispatch(self):
-        inspections = GetInspections(self, self.args[0])
-        numberOfEntries = len(inspections.getInspections())
+    def parseTourDates(self, args):
+        u"""
+            Wandelt Tourdaten und Zeiträume in eine sortierte Liste von Tourdaten (TT.MM.JJJJ) um.
 
-        u"""Commit all pending queries to the database..."""
-        self.postgresql.commit()
+            @param args     - Liste von Tourdaten bzw. Zeiträumen
+            @return list
+            @throws ValueError
+        """
+        oneDay = datetime.timedelta(days=1)
+        dates = set()
+        for arg in args:
+            first, sep, last = arg.partition('-')
+            try:
+                date = datetime.datetime.strptime(first, '%d.%m.%Y')
+                end = datetime.datetime.strptime(last, '%d.%m.%Y') if sep else date
+            except ValueError:
+                raise ValueError('\'{:s}\' ist kein gültiges Datum' . format(arg))
 
-        try:
-            success = self.__swdb.setAllOutletsInactive()
-            u"""Show entries on console"""
-            for idx, entry in enumerate(inspections.getInspections()):
-                print(u"idx = {}, entry = {}".format(idx, entry))
-                if not self.options.quiet:
-                    print(u"-[{:4d}]-{:s}+{:s}+{:s}" . format(idx, "-"*22, "-"*19, "-"*80))
-                    inspections.printRecord(entry)
+            if end < date:
+                raise ValueError('\'{:s}\' ist kein gültiger Zeitraum' . format(arg))
 
-                if not self.__swdb.entryExists(entry[u'Shopper_Contract__c']):
-                    self.logger.debug(u"Entry does not exist -> create new entry...")
-                    newId = self.__swdb.insertOutlet(entry)
-                    self.__swdb.insertApoMasterdata(entry, newId)
+            while date <= end:
+                dates.add(date)
+                date += oneDay
 
-                self.__swdb.setOutletStatus(entry[u'Shopper_Contract__c'], True)
+        return [date.strftime('%d.%m.%Y') for date in sorted(dates)]
 
-            if not self.options.quiet:
-                self.writeActivePharmaciesToStdout()
 
-            if logging:
-                """Aus irgendeinem Grund wir hier eine Exception geworfen!"""
-                #self.exportAsCsv()
+    def dispatch(self):
+        u"""
+            Gleicht die Apotheken der Tourdaten in self.tourDates mit der SWDB ab.
+
+            Liefert True, wenn alle Abfragen erfolgreich waren. Schlägt der Abgleich fehl, wird
+            die Transaktion zurückgerollt, die Exception in self.lastError abgelegt und False
+            geliefert. Fehler nach dem Commit (Ausgabe, Sicht, Export) werden getrennt gemeldet:
+            die SWDB bleibt übernommen, das Zurückschreiben nach Salesforce läuft trotzdem,
+            geliefert wird ebenfalls False.
+        """
+        from get_inspections import GetInspections, MultiDayInspections
+
+        self.lastError = None
+        if self.options.resume:
+            from reject_file import RejectFile
+            inspections = RejectFile(self, self.getRejectFile())
+        elif len(self.tourDates) > 1:
+            workers = self.config.getint('salesforce', 'fetchWorkers') \
+                    if self.config.has_option('salesforce', 'fetchWorkers') else MultiDayInspections.WORKERS
+            inspections = MultiDayInspections(self, self.tourDates, workers=workers)
+        else:
+            inspections = GetInspections(self, self.tourDates[0])
+
+        reconciler, result = None, None
+        try:
+            u"""Commit all pending queries to the database..."""
+            self.postgresql.commit()
+            self.__swdb.useActivePharmaciesView(False)
+
+            if self.config.has_section('writeback') and self.options.commit and not self.options.planOnly:
+                from salesforce_writeback import SalesforceWriteback
+                self.__writeback = SalesforceWriteback(self)
+
+            if self.options.bulk:
+                result = self.__swdb.bulkReconcile(self.echoRecords(inspections))
+            elif self.getShards() > 1:
+                from sharded_reconciler import ShardedReconciler
+                reconciler = ShardedReconciler(self, self.__swdb, self.getShards())
+                result = reconciler.reconcile(self.echoRecords(inspections))
+                u"""Die Shards werden vor der Ausgabe abgeschlossen, damit sie den neuen Stand zeigt"""
+                with self.metrics.stage(u'commit'):
+                    reconciler.finish(self.options.commit)
+            else:
+                result = self.reconcileRecords(inspections)
+
+            u"""Übernehmen vor der Ausgabe, damit diese aus der aktualisierten Sicht lesen kann"""
+            if self.options.commit and not self.options.planOnly:
+                with self.metrics.stage(u'commit'):
+                    self.postgresql.commit()
 
         except Exception, msg:
-            self.postgresql.rollback()
+            self.lastError = msg
+            try:
+                self.postgresql.rollback()
+            except Exception, rollbackError:
+                self.logger.error(u"Rollback failed: {0}" . format(repr(rollbackError)))
+            if reconciler:
+                reconciler.finish(False)
             self.logger.critical(u"Exception: {0}" . format(repr(msg)))
             print(u"Exception occured -> rollback transaction {}".format(repr(msg)))
+            success = False
         else:
+            action = u"commit" if self.options.commit and not self.options.planOnly else u"rollback"
+            success = self.report(result)
+
+            u"""Mit --commit ist bereits übernommen, es endet nur noch die Lesetransaktion der Ausgabe"""
+            try:
+                self.postgresql.rollback()
+            except Exception, msg:
+                self.logger.error(u"Ending read transaction failed: {0}" . format(repr(msg)))
+            if success:
+                self.logger.debug(u"All queries successful -> {:s} transaction" . format(action))
+                print(u"All queries successful -> {:s} transaction" . format(action))
+
+            if self.__writeback:
+                self.writeBackToSalesforce()
+
+        self.__writeback = None
+
+        self.writeMetrics(success)
+        return success
+
+
+    def report(self, result):
+        u"""
+            Gibt das Ergebnis des Abgleichs aus, aktualisiert nach einem Commit die Sicht der
+            aktiven Apotheken und gibt diese aus bzw. exportiert sie. Mit --plan wird nur das
+            Ergebnis ausgegeben, die Apotheken sind unverändert. Die SWDB ist zu diesem
+            Zeitpunkt bereits übernommen oder zurückgerollt, ein Fehler wird daher nur
+            protokolliert, in self.lastError abgelegt und gezählt.
+
+            @param result   - Ergebnis des Abgleichs als OrderedDict
+            @return boolean - False, wenn ein Fehler aufgetreten ist
+        """
+        try:
+            self.logger.info(u"Reconciliation: {0}" . format(dict(result)))
+            for key, value in result.items():
+                self.metrics.count(u'pharmacies_' + key, value)
+            print(u", " . join(u"{0}: {1:d}" . format(key, value) for key, value in result.items()))
+
+            if self.options.planOnly:
+                return True
+
             if self.options.commit:
-                action = u"commit" 
-                self.postgresql.commit()
-            else:
-                action = u"rollback"
+                self.refreshActivePharmaciesView()
+
+            if not self.options.quiet:
+                self.writeActivePharmaciesToStdout()
+
+            if self.options.outfile:
+                self.exportActivePharmacies()
+        except Exception, msg:
+            self.lastError = msg
+            self.metrics.count(u'report_errors')
+            state = u"committed" if self.options.commit and not self.options.planOnly else u"not committed"
+            self.logger.error(u"Exception after reconciliation, changes {0}: {1}" . format(state, repr(msg)))
+            print(u"Exception occured after reconciliation, changes {0}: {1}" . format(state, repr(msg)))
+            return False
+
+        return True
+
+
+    def refreshActivePharmaciesView(self):
+        u"""
+            Aktualisiert nach dem Commit die materialisierte Sicht der aktiven Apotheken, aus
+            der Ausgabe, Export und andere Auswertungen lesen (postgresql.activePharmaciesView,
+            Default True). Schlägt das fehl, wird weiter direkt aus den Tabellen gelesen.
+        """
+        if self.config.has_option('postgresql', 'activePharmaciesView') \
+                and not self.config.getboolean('postgresql', 'activePharmaciesView'):
+            return
+
+        try:
+            with self.metrics.stage(u'refresh_view'):
+                self.__swdb.refreshActivePharmaciesView()
+        except Exception, msg:
+            self.logger.warning(u"Refreshing active pharmacies view failed, reading tables: {0}" . format(repr(msg)))
+
+
+    def writeBackToSalesforce(self):
+        u"""
+            Markiert nach dem Commit die verarbeiteten Inspektionen in Salesforce, siehe
+            Abschnitt [writeback]. Die SWDB ist zu diesem Zeitpunkt bereits übernommen, Fehler
+            beim Zurückschreiben werden daher nur protokolliert und gezählt.
+        """
+        try:
+            with self.metrics.stage(u'writeback'):
+                outletIds = self.__swdb.getOutletIds(self.__writeback.trackedSalesforceIds())
                 self.postgresql.rollback()
+                result = self.__writeback.writeBack(outletIds)
+        except Exception, msg:
+            self.logger.error(u"Writeback to Salesforce failed: {0}" . format(repr(msg)))
+            print(u"Writeback to Salesforce failed: {0}" . format(repr(msg)))
+            self.metrics.count(u'writeback_errors')
+            return
+
+        print(u"writeback: " + u", " . join(u"{0}: {1:d}" . format(key, value) for key, value in result.items()))
+        for key, value in result.items():
+            self.metrics.count(u'writeback_' + key, value)
+
+
+    def checkSchema(self):
+        u"""
+            Prüft Indizes und Ausführungspläne der SWDB (--check-schema) und beendet das Skript
+            mit Status 1, wenn ein empfohlener Index fehlt oder eine Abfrage des Abgleichs
+            nicht indexgestützt ist. Mit --create-indexes werden fehlende Indizes angelegt.
+        """
+        from schema_check import SchemaCheck
+
+        if not SchemaCheck(self, self.__swdb).run(createIndexes=self.options.createIndexes):
+            sys.exit(1)
+
+
+    def getShards(self):
+        u"""Anzahl der Shards für den parallelen Abgleich (--shards bzw. postgresql.shards)"""
+        if self.options.shards is not None:
+            return self.options.shards
+
+        return self.config.getint('postgresql', 'shards') if self.config.has_option('postgresql', 'shards') else 1
+
 
-            self.logger.debug(u"All queries successful -> {:s} transaction" . format(action))
-            print(u"All queries successful -> {:s} transaction" . format(action))
+    def writeMetrics(self, success):
+        u"""
+            Schreibt die Kennzahlen des Laufs als JSON (--metrics-json bzw. metrics.jsonfile) und für
+            den Prometheus-Textfile-Collector (--metrics-prom bzw. metrics.promfile). Danach
+            beginnt die Erfassung für den nächsten Lauf von vorn.
+        """
+        self.metrics.success = success
+        self.logger.debug(u"Metrics: {0}" . format(json.dumps(self.metrics.toDict())))
+
+        jsonFile = self.options.metricsJson or (self.config.get('metrics', 'jsonfile') \
+                if self.config.has_option('metrics', 'jsonfile') else None)
+        promFile = self.options.metricsProm or (self.config.get('metrics', 'promfile') \
+                if self.config.has_option('metrics', 'promfile') else None)
+        if self.options.profile:
+            self.printStatementStats()
+
+        try:
+            if jsonFile:
+                self.metrics.writeJson(jsonFile)
+            if promFile:
+                self.metrics.writePrometheus(promFile)
+        except (IOError, OSError) as msg:
+            self.logger.error(u"Writing metrics failed: {0}" . format(msg))
+
+        self.metrics = RunMetrics()
             
 
+    def profileDispatch(self):
+        u"""
+            Führt dispatch() unter cProfile aus (--profile). Die Statistik wird im pstats-Format
+            geschrieben, z.B. für 'python -m pstats <DATEI>' oder snakeviz, und die Funktionen
+            mit der höchsten kumulierten Laufzeit werden ausgegeben.
+        """
+        import cProfile, pstats
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.dispatch)
+        finally:
+            try:
+                profiler.dump_stats(self.options.profile)
+            except (IOError, OSError) as msg:
+                self.logger.error(u"Writing profile failed: {0}" . format(msg))
+
+            print(u"\n\nProfil ({0})" . format(self.options.profile))
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            stats.sort_stats('cumulative').print_stats(self.options.profileTop)
+
+
+    def printStatementStats(self):
+        u"""Gibt Anzahl, Gesamtdauer und 95. Perzentil der SQL-Statements je Abfragetext aus"""
+        print(u"\n\nSQL-Statements")
+        print(u"{0:>8s} {1:>10s} {2:>10s} {3:>10s}  {4}" . format(u"count", u"total [s]", u"mean [ms]", u"p95 [ms]",
+                u"query"))
+        for entry in self.metrics.statements()[:self.options.profileTop]:
+            print(u"{0:8d} {1:10.3f} {2:10.2f} {3:10.2f}  {4}" . format(entry[u'count'], entry[u'total'],
+                    entry[u'mean'] * 1000, entry[u'p95'] * 1000, entry[u'query'][:100]))
+
+
+    def reconcileRecords(self, inspections):
+        u"""
+            Gleicht die Apotheken in zwei Phasen mit der SWDB ab. Die Planung liest ein Abbild
+            der SWDB und berechnet aus den Datensätzen von Salesforce alle Änderungen, ohne
+            dabei eine Transaktion offen zu halten. Der Plan wird anschließend in einer kurzen
+            Transaktion ausgeführt, die mit --commit sofort übernommen wird. Mit --plan wird
+            der Plan nur ausgegeben, mit --save-plan zusätzlich als JSON gespeichert. Neue
+            Apotheken mit fehlerhafter Account_Information__c werden nicht angelegt. Vorhandene
+            Apotheken werden aktualisiert, wenn sich die Prüfsumme ihrer Felder seit dem letzten
+            Abgleich geändert hat.
+
+            Angelegt und aktualisiert wird blockweise unter Savepoints (postgresql.applyBatchSize),
+            ein fehlerhafter Datensatz verwirft nicht mehr den ganzen Lauf. Abgewiesene und
+            fehlgeschlagene Datensätze werden mit --commit in die Quarantäne geschrieben und
+            können mit --resume erneut abgeglichen werden. Mit --seed-digests werden für
+            vorhandene Apotheken ohne Prüfsumme nur die Prüfsummen gespeichert. Liefert die
+            Anzahl der angelegten, abgewiesenen, fehlgeschlagenen, aktualisierten, aktivierten,
+            deaktivierten und unveränderten Apotheken.
+        """
+        from reject_file import RejectFile
+        from swdb import SWDB
+
+        plan = self.__swdb.createPlan(seedDigests=self.options.seedDigests)
+        for entry in self.echoRecords(inspections):
+            plan.add(entry)
+        plan.finish(partial=self.options.resume)
+        if plan.seeds:
+            self.logger.info(u"Seeding digests of {0:d} pharmacies" . format(len(plan.seeds)))
+
+        for record in plan.rejects:
+            self.logger.warning(u"Entry does not exist and cannot be created: {0}" . format(record.error))
+
+        if self.options.savePlan:
+            plan.save(self.options.savePlan)
+
+        if self.options.planOnly:
+            if not self.options.quiet:
+                plan.render()
+            return plan.summary()
+
+        batchSize = self.config.getint('postgresql', 'applyBatchSize') \
+                if self.config.has_option('postgresql', 'applyBatchSize') else SWDB.APPLY_BATCH_SIZE
+        with self.metrics.stage(u'apply'):
+            result = self.__swdb.applyPlan(plan, batchSize=max(1, batchSize))
+        if self.options.commit:
+            with self.metrics.stage(u'commit'):
+                self.postgresql.commit()
+            try:
+                RejectFile(self, self.getRejectFile()).save(plan.rejects, plan.failed)
+            except (IOError, OSError) as msg:
+                self.logger.error(u"Writing reject file failed, changes are committed: {0}" . format(msg))
+
+        return result
+
+
+    def getRejectFile(self):
+        u"""Dateiname der Quarantäne: postgresql.rejectFile, Default <SCRIPTNAME>.rejects.json"""
+        return self.config.get('postgresql', 'rejectFile') \
+                if self.config.has_option('postgresql', 'rejectFile') else self.APPNAME + '.rejects.json'
+
+
+    def echoRecords(self, inspections):
+        u"""
+            Liefert die Apotheken aus Salesforce seitenweise und gibt sie dabei auf der Konsole aus.
+            Mit --progress wird stattdessen ein Fortschrittsbalken mit Durchsatz angezeigt.
+            Für das Zurückschreiben werden auch die Inspektionen vorgemerkt, die bei mehreren
+            Tourdaten als doppelte Verträge verworfen wurden.
+        """
+        start, idx = time.time(), 0
+        for idx, entry in enumerate(inspections.iterInspections(), 1):
+            if self.__writeback:
+                self.__writeback.track(entry)
+            if self.options.progress:
+                if idx % 100 == 0:
+                    self.showProgress(idx, getattr(inspections, 'totalSize', None), start)
+            elif not self.options.quiet:
+                print(u"-[{:4d}]-{:s}+{:s}+{:s}" . format(idx - 1, "-"*22, "-"*19, "-"*80))
+                inspections.printRecord(entry)
+
+            yield entry
+
+        if self.__writeback:
+            for entry in getattr(inspections, 'duplicates', ()):
+                self.__writeback.track(entry)
+        if self.options.progress:
+            self.showProgress(idx, idx, start)
+
+
+    def showProgress(self, done, total, start):
+        u"""Zeigt den Fortschritt und den Durchsatz in Datensätzen pro Sekunde"""
+        rate = u"{:.0f} rec/s" . format(done / max(time.time() - start, 0.001))
+        if total:
+            self.printProgressBar(min(done, total), total, prefix=u"Sync", suffix=rate)
+        else:
+            sys.stdout.write(u"\rSync {:d} records, {:s}" . format(done, rate))
+            sys.stdout.flush()
+
+
     def writeActivePharmaciesToStdout(self):
-        u"""Writes active pharmacies from swdb to console"""
-        activePharmacies = self.__swdb.getActivePharmacies()
-        print(u"\n\nAktive Datensätze in der Sit&Watch-Datenbank nach Abgleich mit Salesforce")
-        for cnt, pharmacy in enumerate(sorted(activePharmacies)):
-            print(u"-[{:4d}]-{:s}+{:s}+{:s}" . format(cnt, "-"*10, "-"*28, "-"*80))
-            for key in pharmacy.keys():
-                if type(pharmacy[key]) is int:
-                    print(u"{:17s} | {:26s} | {:d}" . format(key, type(pharmacy[key]), pharmacy[key]))
-                elif isinstance(pharmacy[key], (str, unicode)):
-                    print(u"{:17s} | {:26s} | {:s}" . format(key, type(pharmacy[key]), pharmacy[key]))
-                elif isinstance(pharmacy[key], (datetime.datetime,)):
-                    print(u"{:17s} | {:26s} | {:s}" . format(key, type(pharmacy[key]), 
-                            pharmacy[key].strftime("%Y-%m-%dT%H:%M:%SZ")))
-
-        print(u"\n\n{:d} rows found." . format(len(activePharmacies)))
+        u"""Writes active pharmacies from swdb to console, one row per pharmacy or as summary"""
+        from pharmacy_report import PharmacyReport
+
+        report = PharmacyReport(self, self.__swdb)
+        if self.options.summary:
+            report.renderSummary()
+        else:
+            report.render(limit=self.options.limit, pageSize=self.options.pageSize)
+
+
+    def exportActivePharmacies(self):
+        u"""
+            Exports active pharmacies to outfile. Files ending with .xlsx are written as Excel
+            workbook, all others as csv.
+
+            @params None
+            @returns None
+            @throws Exception
+        """
+        if self.options.outfile.lower().endswith('.xlsx'):
+            self.exportAsXlsx()
+        else:
+            self.exportAsCsv()
+
+        self.logger.debug(u"Active pharmacies exported to {0}" . format(self.options.outfile))
 
 
     def exportAsCsv(self):
         u"""
             Exports data from swdb as csv to outfile. Writes csv in utf-8
 
+            The rows are streamed by the database server via COPY directly into the file.
+
             @params None
             @returns None
             @throws Exception
         """
-        import unicodecsv as csv
+        with open(self.options.outfile, 'wb') as csvfile:
+            self.__swdb.copyActivePharmacies(csvfile)
 
-        activePharmacies = self.__swdb.getActivePharmaciesCursor()
 
-        with open(self.options.outfile, 'wb') as csvfile:
-            csvwriter = csv.writer(csvfile, dialect='excel')
-            u"""Write headings..."""
-            csvwriter.writerow([Column[0] for Column in activePharmacies.description])
-            u"""Write data rows..."""
-            for row in sorted(activePharmacies.fetchall()):
-                csvwriter.writerow(row)
+    def exportAsXlsx(self):
+        u"""
+            Exports data from swdb as Excel workbook to outfile
+
+            Rows are read from a server-side cursor and written row by row by a workbook in
+            constant-memory mode, so neither side holds the full result.
+
+            @params None
+            @returns None
+            @throws Exception
+        """
+        import xlsxwriter
+
+        activePharmacies = self.__swdb.getActivePharmaciesCursor(name='export_active_pharmacies')
+        workbook = xlsxwriter.Workbook(self.options.outfile, { 'constant_memory': True,
+                'default_date_format': 'dd.mm.yyyy hh:mm', 'remove_timezone': True })
+        try:
+            worksheet = workbook.add_worksheet(u'Apotheken')
+            u"""A named cursor knows its columns only after the first fetch"""
+            row = activePharmacies.fetchone()
+            worksheet.write_row(0, 0, [Column[0] for Column in activePharmacies.description])
+            cnt = 0
+            while row is not None:
+                cnt += 1
+                worksheet.write_row(cnt, 0, row)
+                row = next(activePharmacies, None)
+        finally:
+            workbook.close()
+            activePharmacies.close()
 
 
     def printProgressBar(self, iteration, total, prefix = '', suffix = '', decimals = 1, length = 70, fill = '#'):
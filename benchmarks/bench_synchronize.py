@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Offline-Benchmark für den Abgleich Salesforce -> SWDB
+
+Startet eine temporäre PostgreSQL-Instanz (initdb in einem temporären Verzeichnis), legt
+darin das Schema der SWDB-Tabellen outlet, apo_masterdata, bundeslaender,
+outlet_gebietsleiter und stammdaten sowie die Tabelle der Prüfsummen an und gleicht
+synthetische Salesforce-Antworten in der Form von query()/query_more() damit ab. Gemessen werden die Zeiten je Stufe sowie
+Anzahl und Dauer der SQL-Statements je Statement-Typ.
+
+Aufruf:
+
+    bench_synchronize.py [--sizes 100,1000,10000] [--existing-ratio 0.8] [--modes records,bulk]
+
+Benötigt initdb/pg_ctl im PATH (oder --pgbin) sowie die Abhängigkeiten des Skripts
+bayershopper_synchronize.py.
+"""
+
+from __future__ import print_function
+
+import os, sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+import collections, json, logging, shutil, socket, subprocess, tempfile, time
+
+from optparse import OptionParser, Values
+from ConfigParser import SafeConfigParser
+
+import psycopg2, psycopg2.extensions
+
+from bayershopper_synchronize import App
+from get_inspections import GetInspections
+from swdb import SWDB
+from run_metrics import RunMetrics
+
+SCHEMA = u"""
+    CREATE TABLE bundeslaender (code varchar(2) PRIMARY KEY, name text NOT NULL);
+    CREATE TABLE stammdaten (id serial PRIMARY KEY, firma1 text);
+    CREATE TABLE outlet (id serial PRIMARY KEY, name text NOT NULL, strasse text, plz varchar(10), ort text,
+        bundesland varchar(2), email text, telefon1 text, outletart text, route text,
+        aktiv boolean NOT NULL DEFAULT false, create_time timestamp with time zone NOT NULL DEFAULT now());
+    CREATE TABLE apo_masterdata (id integer PRIMARY KEY REFERENCES outlet (id), jansen_id integer,
+        byr_sap_id text, byr_salesforce_id text, byr_name text, byr_status text, byr_shelf_details text,
+        byr_contact_c text, byr_is_deleted boolean, byr_active boolean, byr_shopper_termination text,
+        byr_shopper_termination_reason text);
+    CREATE TABLE outlet_gebietsleiter (outlet integer REFERENCES outlet (id),
+        gebietsleiter integer REFERENCES stammdaten (id));
+"""
+
+INDEXES = u"""
+    CREATE INDEX apo_masterdata_byr_salesforce_id_idx ON apo_masterdata (byr_salesforce_id);
+    CREATE INDEX outlet_outletart_idx ON outlet (outletart);
+    CREATE INDEX outlet_gebietsleiter_outlet_idx ON outlet_gebietsleiter (outlet);
+"""
+
+BUNDESLAENDER = [(u'BW', u'Baden-Württemberg'), (u'BY', u'Bayern'), (u'BE', u'Berlin'), (u'BB', u'Brandenburg'),
+        (u'HB', u'Bremen'), (u'HH', u'Hamburg'), (u'HE', u'Hessen'), (u'MV', u'Mecklenburg-Vorpommern'),
+        (u'NI', u'Niedersachsen'), (u'NW', u'Nordrhein-Westfalen'), (u'RP', u'Rheinland-Pfalz'),
+        (u'SL', u'Saarland'), (u'SN', u'Sachsen'), (u'ST', u'Sachsen-Anhalt'), (u'SH', u'Schleswig-Holstein'),
+        (u'TH', u'Thüringen')]
+
+TOUR_DATE = '01.08.2018'
+
+
+class TempPostgres(object):
+    u"""Temporäre PostgreSQL-Instanz in einem eigenen Verzeichnis, erreichbar über einen Unix-Socket"""
+
+    def __init__(self, pgbin=None, settings=None):
+        u"""
+            @param pgbin    - Verzeichnis mit initdb und pg_ctl, None für PATH
+            @param settings - zusätzliche Parameter des Servers, z.B. { 'max_prepared_transactions': 4 }
+        """
+        self.pgbin = pgbin
+        self.settings = settings or {}
+        self.directory = tempfile.mkdtemp(prefix='swdb-bench-')
+        self.datadir = os.path.join(self.directory, 'data')
+        self.port = self.__freePort()
+
+
+    def start(self):
+        self.__run('initdb', '-D', self.datadir, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-locale')
+        self.__run('pg_ctl', '-D', self.datadir, '-w', '-l', os.path.join(self.directory, 'postgres.log'),
+                '-o', "-F -p {0} -k {1} -c listen_addresses=''" . format(self.port, self.directory) +
+                u'' . join(" -c {0}={1}" . format(key, value) for key, value in sorted(self.settings.items())), 'start')
+
+
+    def stop(self):
+        try:
+            self.__run('pg_ctl', '-D', self.datadir, '-w', '-m', 'fast', 'stop')
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+    def connect(self, database='postgres'):
+        return psycopg2.connect(database=database, host=self.directory, port=self.port, user='postgres')
+
+
+    def __run(self, command, *args):
+        if self.pgbin:
+            command = os.path.join(self.pgbin, command)
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call((command,) + args, stdout=devnull)
+
+
+    def __freePort(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+class FakeSalesforce(object):
+    u"""
+        Liefert synthetische Inspektionen seitenweise wie Salesforce.query()/query_more(). Die
+        letzten 'malformed' Datensätze haben eine unvollständige Account_Information__c.
+    """
+
+    PAGE_SIZE = 2000
+
+    def __init__(self, count, malformed=0):
+        self.count = count
+        self.malformed = malformed
+        self.calls = 0
+
+
+    def query(self, query):
+        return self.__page(0)
+
+
+    def query_more(self, url, identifier_is_url=False):
+        return self.__page(int(url.rsplit('-', 1)[1]))
+
+
+    def query_all(self, query):
+        return { 'totalSize': self.count, 'done': True, 'records': [self.record(i) for i in xrange(self.count)] }
+
+
+    def record(self, i):
+        contract = collections.OrderedDict([
+            (u'attributes', { u'type': u'Shopper_Contract__c' }),
+            (u'Account_Information__c', u"Apotheke {0:d}<br>{0:07d}<br>Hauptstraße {1:d}<br>{2:05d} Musterstadt<br>"
+                    u"DE Bayern<br><br>E-Mail: apo{0:d}@example.com<br>Telefon: 089 {0:d}" .
+                    format(i, i % 200 + 1, 10000 + i % 90000)),
+            (u'Status__c', u'Active'), (u'Shelf_Details__c', None), (u'Shopper_Termination__c', None),
+            (u'Shopper_Termination_Reason__c', None), (u'Contact__c', u'003{0:012d}' . format(i)),
+            (u'IsDeleted', False), (u'Active__c', True), (u'Shelf_Length__c', 1.5), (u'Shelf_Width__c', 0.5)])
+        if i >= self.count - self.malformed:
+            contract[u'Account_Information__c'] = u"Apotheke {0:d}<br>{0:07d}" . format(i)
+        return collections.OrderedDict([
+            (u'attributes', { u'type': u'Shopper_Inspection__c' }),
+            (u'Shopper_Contract__c', u'a0B{0:012d}' . format(i)), (u'Id', u'a0C{0:012d}' . format(i)),
+            (u'Name', u'SI-{0:06d}' . format(i)), (u'Shopper_Contract__r', contract)])
+
+
+    def __page(self, start):
+        self.calls += 1
+        end = min(start + self.PAGE_SIZE, self.count)
+        result = { 'totalSize': self.count, 'done': end >= self.count,
+                'records': [self.record(i) for i in xrange(start, end)] }
+        if not result['done']:
+            result['nextRecordsUrl'] = '/services/data/v38.0/query/01g-{0:d}' . format(end)
+        return result
+
+
+class CountingCursor(object):
+    u"""Cursor-Proxy, der Anzahl und Dauer der Statements je Statement-Typ erfasst"""
+
+    def __init__(self, cursor, stats):
+        self.__cursor = cursor
+        self.__stats = stats
+
+
+    def execute(self, query, params=None):
+        return self.__measure(query, self.__cursor.execute, query, params)
+
+
+    def copy_expert(self, query, fileobj, *args):
+        return self.__measure(query, self.__cursor.copy_expert, query, fileobj, *args)
+
+
+    def __measure(self, query, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            stat = self.__stats[query.split(None, 1)[0].upper()]
+            stat[0] += 1
+            stat[1] += time.time() - start
+
+
+    def __iter__(self):
+        return iter(self.__cursor)
+
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)
+
+
+class CountingConnection(object):
+    u"""Verbindungs-Proxy, dessen Cursor die Statements zählen"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.stats = collections.defaultdict(lambda: [0, 0.0])
+
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.connection.cursor(*args, **kwargs), self.stats)
+
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def createDatabase(server, name, size, existingRatio, indexes):
+    u"""Legt die Datenbank an und füllt sie mit vorhandenen und veralteten Apotheken"""
+    admin = server.connect()
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute(u"DROP DATABASE IF EXISTS {0}" . format(name))
+    cur.execute(u"CREATE DATABASE {0}" . format(name))
+    admin.close()
+
+    existing = int(size * existingRatio)
+    stale = max(1, size // 10)
+
+    conn = server.connect(name)
+    cur = conn.cursor()
+    cur.execute(SCHEMA)
+    cur.execute(SWDB.DIGEST_TABLE_DEFINITION)
+    if indexes:
+        cur.execute(INDEXES)
+    cur.executemany(u"INSERT INTO bundeslaender (code, name) VALUES (%s, %s)", BUNDESLAENDER)
+    cur.execute(u"""INSERT INTO stammdaten (firma1) SELECT 'Citymanager ' || g FROM generate_series(1, 20) g""")
+    cur.execute(u"""INSERT INTO outlet (id, name, strasse, plz, ort, bundesland, outletart, aktiv)
+        SELECT g, 'Apotheke ' || (g - 1), 'Hauptstraße 1', '80331', 'Musterstadt', 'BY', 'apotheke', g %% 3 = 0
+        FROM generate_series(1, %(total)s) g""", { 'total': existing + stale })
+    cur.execute(u"""INSERT INTO apo_masterdata (id, byr_salesforce_id, byr_name, byr_status)
+        SELECT g, CASE WHEN g <= %(existing)s THEN 'a0B' || lpad((g - 1)::text, 12, '0') ELSE 'stale' || g END,
+            'SI-' || g, 'Active'
+        FROM generate_series(1, %(total)s) g""", { 'existing': existing, 'total': existing + stale })
+    cur.execute(u"""INSERT INTO outlet_gebietsleiter (outlet, gebietsleiter)
+        SELECT id, 1 + id % 20 FROM outlet""")
+    cur.execute(u"""SELECT setval('outlet_id_seq', (SELECT max(id) FROM outlet))""")
+    cur.execute(u"ANALYZE")
+    conn.commit()
+    conn.close()
+
+    return existing, stale
+
+
+def createApp(server, database, salesforce, bulk):
+    u"""Erzeugt eine App-Instanz ohne Konstruktor mit den für den Abgleich nötigen Attributen"""
+    config = SafeConfigParser()
+    config.add_section('salesforce')
+    config.set('salesforce', 'fetchEngine', 'rest')
+
+    app = object.__new__(App)
+    app.config = config
+    app.options = Values({ 'quiet': True, 'bulk': bulk, 'refresh': False, 'engine': None, 'progress': False,
+            'commit': False, 'planOnly': False, 'savePlan': None, 'resume': False,
+            'seedDigests': False })
+    app.logger = logging.getLogger('bench_synchronize')
+    app.salesforce = salesforce
+    app.snapshotCache = None
+    app.metrics = RunMetrics()
+
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+    app.postgresql = CountingConnection(server.connect(database))
+    app._App__swdb = SWDB(app)
+    return app
+
+
+def runMode(server, database, size, mode):
+    u"""Führt einen Abgleich aus und liefert die Zeiten je Stufe und die Statement-Statistik"""
+    salesforce = FakeSalesforce(size)
+    app = createApp(server, database, salesforce, mode == 'bulk')
+    timings = collections.OrderedDict()
+
+    start = time.time()
+    inspections = GetInspections(app, TOUR_DATE)
+    inspections.getInspections()
+    timings['fetch'] = time.time() - start
+
+    start = time.time()
+    if mode == 'bulk':
+        result = app._App__swdb.bulkReconcile(inspections.iterInspections())
+    else:
+        result = app.reconcileRecords(inspections)
+    timings['reconcile'] = time.time() - start
+
+    start = time.time()
+    app.postgresql.rollback()
+    timings['rollback'] = time.time() - start
+    app.postgresql.close()
+
+    timings.update((u'metrics.' + stage, seconds) for stage, seconds in app.metrics.toDict()[u'stages'].items())
+    return timings, dict(app.postgresql.stats), result, salesforce.calls
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", default="100,1000,10000",
+            help=u"Anzahl der Apotheken je Lauf, kommagetrennt (100 bis 100000)")
+    parser.add_option("--existing-ratio", dest="existingRatio", type="float", default=0.8,
+            help=u"Anteil der Apotheken, die bereits in der SWDB vorhanden sind")
+    parser.add_option("--modes", dest="modes", default="records,bulk",
+            help=u"Abgleichsmodi: records, bulk")
+    parser.add_option("--no-indexes", dest="indexes", action="store_false", default=True,
+            help=u"Schema ohne Indizes auf den Suchspalten anlegen")
+    parser.add_option("--pgbin", dest="pgbin", help=u"Verzeichnis mit initdb und pg_ctl")
+    parser.add_option("--json", dest="json", help=u"Ergebnisse zusätzlich als JSON in diese Datei schreiben")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    modes = [mode.strip() for mode in options.modes.split(',')]
+    results = []
+
+    server = TempPostgres(options.pgbin)
+    server.start()
+    try:
+        for size in sizes:
+            existing, stale = createDatabase(server, 'swdb_bench', size, options.existingRatio, options.indexes)
+            for mode in modes:
+                timings, stats, result, apiCalls = runMode(server, 'swdb_bench', size, mode)
+                results.append({ 'size': size, 'existing': existing, 'stale': stale, 'mode': mode,
+                        'timings': timings, 'statements': stats, 'result': dict(result), 'api_calls': apiCalls })
+
+                print(u"\n{0:d} pharmacies ({1:d} existing, {2:d} stale), mode {3}, {4:d} API calls" .
+                        format(size, existing, stale, mode, apiCalls))
+                for stage, seconds in timings.items():
+                    print(u"    {0:<12s} {1:10.3f}s" . format(stage, seconds))
+                for kind, (count, seconds) in sorted(stats.items()):
+                    print(u"    {0:<12s} {1:10.3f}s {2:8d} statements" . format(kind, seconds, count))
+                print(u"    {0:<12s} {1:>11d} statements" . format(u'total', sum(count for count, seconds in stats.values())))
+                print(u"    " + u", " . join(u"{0}: {1}" . format(key, value) for key, value in result.items()))
+    finally:
+        server.stop()
+
+    if options.json:
+        with open(options.json, 'wb') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Führt SOQL-Abfragen als Bulk API 2.0 Query-Job aus.
+
+Der Job wird angelegt, bis zur Fertigstellung abgefragt und das Ergebnis anschließend
+in CSV-Blöcken abgeholt. Jeder Block wird in Datensätze in der Form umgewandelt, die
+auch query()/query_all() der REST-API liefern, damit die Weiterverarbeitung mit
+flattenRecord/splitAccountInformation unverändert bleibt.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, io, collections
+
+class BulkQueryError(Exception):
+    u"""Der Bulk-Job ist fehlgeschlagen oder wurde abgebrochen"""
+    pass
+
+
+class BulkQuery(object):
+
+    """const"""
+    MIN_VERSION = 47.0
+    POLL_INTERVAL = 2.0
+    MAX_POLL_INTERVAL = 30.0
+    MAX_RECORDS = 10000
+    SOBJECT = u'Shopper_Inspection__c'
+
+    """private"""
+    __app = (None,)*1
+
+    def __init__(self, app):
+        if not hasattr(app, 'salesforce'):
+            raise AttributeError(u'Object \'app\' has no attribute \'salesforce\'')
+
+        self.__app = app
+
+
+    def iterPages(self, query):
+        u"""
+            Generator yielding the records of query in chunks of at most MAX_RECORDS
+
+            @param query    - SOQL-Abfrage
+            @throws BulkQueryError
+        """
+        jobId = self.createJob(query)
+        self.waitForJob(jobId)
+
+        for page in self.iterResults(jobId):
+            yield page
+
+
+    def createJob(self, query):
+        u"""
+            string createJob(query)
+
+            Legt einen Query-Job an und liefert dessen Id.
+
+            @param query    - SOQL-Abfrage
+            @return string
+        """
+        response = self.__request('POST', u'', json={ u'operation': u'query', u'query': query,
+                u'contentType': u'CSV', u'columnDelimiter': u'COMMA', u'lineEnding': u'LF' })
+        jobId = response.json()[u'id']
+
+        self.__app.logger.debug(u"bulk query job {0} created" . format(jobId))
+        return jobId
+
+
+    def waitForJob(self, jobId):
+        u"""
+            void waitForJob(jobId)
+
+            Fragt den Status des Jobs ab, bis er abgeschlossen ist. Das Intervall zwischen
+            zwei Abfragen wird bis MAX_POLL_INTERVAL verdoppelt.
+
+            @param jobId    - Id des Jobs
+            @throws BulkQueryError
+        """
+        interval = self.POLL_INTERVAL
+        while True:
+            job = self.__request('GET', u'/' + jobId).json()
+            state = job[u'state']
+            self.__app.logger.debug(u"bulk query job {0}: {1}" . format(jobId, state))
+
+            if state == u'JobComplete':
+                return
+            elif state in (u'Failed', u'Aborted'):
+                raise BulkQueryError(u"bulk query job {0} {1}: {2}" . format(jobId, state.lower(),
+                        job.get(u'errorMessage')))
+
+            time.sleep(interval)
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+
+    def iterResults(self, jobId):
+        u"""
+            Generator yielding the result of job as list of records per CSV chunk
+
+            Folgt dem Header Sforce-Locator, bis alle Blöcke abgeholt wurden.
+
+            @param jobId    - Id des Jobs
+        """
+        import unicodecsv as csv
+
+        locator = None
+        while True:
+            params = { u'maxRecords': self.MAX_RECORDS }
+            if locator:
+                params[u'locator'] = locator
+
+            response = self.__request('GET', u'/{0}/results' . format(jobId), params=params)
+            reader = csv.DictReader(io.BytesIO(response.content), encoding='utf-8')
+            yield [self.nestRecord(row, reader.fieldnames) for row in reader]
+
+            locator = response.headers.get('Sforce-Locator')
+            if not locator or locator == u'null':
+                break
+
+
+    def nestRecord(self, row, fieldnames):
+        u"""
+            OrderedDict nestRecord(row, fieldnames)
+
+            Wandelt eine CSV-Zeile in einen Datensatz wie von der REST-API um: Spalten der Form
+            Beziehung.Feld werden in ein eigenes OrderedDict verschoben, leere Werte werden zu
+            None und 'true'/'false' zu booleschen Werten.
+
+            @param row          - CSV-Zeile als dict
+            @param fieldnames   - Spaltennamen in der Reihenfolge der Abfrage
+            @return OrderedDict
+        """
+        record = collections.OrderedDict([(u'attributes', { u'type': self.SOBJECT })])
+        for field in fieldnames:
+            value = self.__convert(row[field])
+            relation, dot, name = field.rpartition(u'.')
+            if dot:
+                if relation not in record:
+                    record[relation] = collections.OrderedDict([(u'attributes', { u'type': relation })])
+                record[relation][name] = value
+            else:
+                record[name] = value
+
+        return record
+
+
+    def __convert(self, value):
+        if value == u'':
+            return None
+        elif value == u'true':
+            return True
+        elif value == u'false':
+            return False
+
+        return value
+
+
+    def __request(self, method, path, **kwargs):
+        u"""Sendet eine Anfrage an die Bulk API. Bei abgelaufener Session wird einmal neu angemeldet"""
+        salesforce = self.__app.salesforce
+        response = self.__send(salesforce, method, path, **kwargs)
+        if response.status_code == 401:
+            self.__app.refreshSalesforce(salesforce)
+            response = self.__send(self.__app.salesforce, method, path, **kwargs)
+
+        if response.status_code >= 300:
+            raise BulkQueryError(u"{0} {1} failed with status {2}: {3}" . format(method, response.url,
+                    response.status_code, response.text))
+
+        return response
+
+
+    def __send(self, salesforce, method, path, **kwargs):
+        version = max(float(salesforce.sf_version), self.MIN_VERSION)
+        url = u'https://{0}/services/data/v{1:.1f}/jobs/query{2}' . format(salesforce.sf_instance, version, path)
+
+        with self.__app.metrics.stage(u'salesforce_bulk'):
+            self.__app.metrics.count(u'salesforce_api_calls')
+            return salesforce.session.request(method, url, headers=salesforce.headers, **kwargs)
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -9,21 +9,28 @@ Datenstruktur auf.
 from __future__ import print_function
 
 import os, sys, datetime, exceptions, collections, copy
-import pprint
+import pprint, threading, Queue
+from multiprocessing.pool import ThreadPool
 
 from swdb import SWDB
+from bulk_query import BulkQuery
+from pharmacy_record import PharmacyRecord
 
 class GetInspections(object):
 
     """const"""
     SOQL_DATEFORMAT = '%Y-%m-%dT%H:%M:%SZ'
+    PREFETCH_PAGES = 2
+    ENGINES = ('rest', 'bulk', 'auto')
+    BULK_THRESHOLD = 10000
+    STATUS_OPEN = u'Open'
 
     """private"""
-    __app, __tour_date, __from_date, __to_date = (None,)*4
+    __app, __tour_date, __from_date, __to_date, __records = (None,)*5
     __one_day = datetime.timedelta(days=1)
 
     """public"""
-    pharmacies = (None,)*1
+    pharmacies, totalSize = (None,)*2
 
     def __init__(self, app, tour_date):
         if not hasattr(app, 'salesforce'):
@@ -39,36 +46,292 @@ class GetInspections(object):
 
 
     def getInspections(self):
-        u"""Gets inspections from salesforce and creates data structure. Returns list of objects"""
-        result = []
-        query = u"""
-            SELECT Shopper_Contract__c, Id, Name,
+        u"""
+            Gets inspections from salesforce and creates data structure. Returns list of objects
+
+            The result is fetched once per instance. If the app provides a snapshot cache, a
+            valid snapshot for tour date and query is used instead of querying salesforce.
+        """
+        if self.__records is None:
+            self.__records = list(self.iterInspections())
+
+        return self.__records
+
+
+    def iterInspections(self):
+        u"""
+            Generator yielding flattened inspections page by page
+
+            Pages are downloaded by a background thread while the caller processes the
+            previous page, so at most PREFETCH_PAGES pages are held in memory. Without a
+            snapshot cache the result is not kept; with a cache the records are collected,
+            stored as snapshot and memoized once the last page has been processed.
+        """
+        if self.__records is not None:
+            for record in self.__records:
+                yield record
+            return
+
+        query = self.buildQuery()
+        state = getattr(self.__app, 'inspectionState', None)
+        if state and not getattr(self.__app.options, 'full', False):
+            known = state.load(self.__tour_date, query)
+            if known is not None:
+                for record in self.iterIncremental(query, *known):
+                    yield record
+                return
+
+        cache = getattr(self.__app, 'snapshotCache', None)
+        key = cache.key(self.__tour_date, query) if cache else None
+
+        if cache and not getattr(self.__app.options, 'refresh', False):
+            snapshot = cache.get(key)
+            if snapshot is not None:
+                self.__records = [PharmacyRecord.fromDict(record) for record in snapshot]
+                for record in self.__records:
+                    yield record
+                return
+
+        collected = [] if cache or state else None
+        watermark = None
+        for page in self.iterPages(query):
+            for record in page:
+                watermark = max(watermark, self.getModstamp(record))
+                with self.__app.metrics.stage(u'flatten'):
+                    record = self.flattenRecord(record)
+                if collected is not None:
+                    collected.append(record)
+                yield record
+
+        if cache:
+            cache.put(key, [record.toDict() for record in collected])
+            self.__records = collected
+
+        if state and watermark:
+            state.save(self.__tour_date, query, watermark,
+                    collections.OrderedDict((record.Id, record.toDict()) for record in collected))
+
+
+    def iterIncremental(self, query, watermark, known):
+        u"""
+            Generator yielding the inspections of the tour date from the last known state
+
+            Only inspections of the CreatedDate window whose SystemModstamp (or that of their
+            contract) is newer than the watermark are fetched, plus deleted ones via the
+            queryAll endpoint. Changed open inspections replace their known version, inspections
+            that are no longer open or were deleted are dropped. The merged state is saved with the new
+            watermark and memoized.
+        """
+        state = self.__app.inspectionState
+        since = state.since(watermark) + u'Z'
+        changed = self.buildQuery(u"{0} AND (SystemModstamp > {1} OR Shopper_Contract__r.SystemModstamp > {1})" .
+                format(self.buildWindowClause(), since), fields=u"Status__c")
+
+        updated, removed = 0, 0
+        for page in self.iterRestPages(changed):
+            for record in page:
+                watermark = max(watermark, self.getModstamp(record))
+                status = record.pop(u'Status__c', None)
+                if status == self.STATUS_OPEN:
+                    with self.__app.metrics.stage(u'flatten'):
+                        known[record[u'Id']] = self.flattenRecord(record).toDict()
+                    updated += 1
+                elif known.pop(record[u'Id'], None) is not None:
+                    removed += 1
+
+        deleted = u"""SELECT Id, SystemModstamp FROM Shopper_Inspection__c
+                WHERE IsDeleted = true AND SystemModstamp > {0} AND {1}""" . format(since, self.buildWindowClause())
+        for page in self.iterRestPages(deleted, includeDeleted=True):
+            for record in page:
+                watermark = max(watermark, self.getModstamp(record))
+                if known.pop(record[u'Id'], None) is not None:
+                    removed += 1
+
+        self.__app.logger.debug(u"incremental fetch since {0}: {1:d} updated, {2:d} removed, {3:d} total" .
+                format(since, updated, removed, len(known)))
+        self.__app.metrics.count(u'incremental_updated', updated)
+        self.__app.metrics.count(u'incremental_removed', removed)
+
+        state.save(self.__tour_date, query, watermark, known)
+        self.totalSize = len(known)
+        self.__records = [PharmacyRecord.fromDict(record) for record in known.values()]
+        for record in self.__records:
+            yield record
+
+
+    def getModstamp(self, record):
+        u"""
+            Returns the newer SystemModstamp of an inspection and its contract as
+            YYYY-MM-DDThh:mm:ss (UTC), None if the record has none
+        """
+        stamps = [record.get(u'SystemModstamp'), (record.get(u'Shopper_Contract__r') or {}).get(u'SystemModstamp')]
+        stamps = [stamp[:19] for stamp in stamps if stamp]
+
+        return max(stamps) if stamps else None
+
+
+    def buildQuery(self, whereClause=None, fields=None):
+        u"""
+            Returns the SOQL query for the inspections of the tour date
+
+            @param whereClause  - condition, default: buildWhereClause()
+            @param fields       - additional fields of the inspection
+        """
+        return u"""
+            SELECT Shopper_Contract__c, Id, Name, SystemModstamp, {fields}
                     Shopper_Contract__r.Account_Information__c, Shopper_Contract__r.Status__c,
                     Shopper_Contract__r.Shelf_Details__c, Shopper_Contract__r.Shopper_Termination__c,
                     Shopper_Contract__r.Shopper_Termination_Reason__c, Shopper_Contract__r.Contact__c,
                     Shopper_Contract__r.IsDeleted, Shopper_Contract__r.Active__c,
-                    Shopper_Contract__r.Shelf_Length__c, Shopper_Contract__r.Shelf_Width__c
+                    Shopper_Contract__r.Shelf_Length__c, Shopper_Contract__r.Shelf_Width__c,
+                    Shopper_Contract__r.SystemModstamp
                 FROM Shopper_Inspection__c
-                WHERE CreatedDate > {:1} AND CreatedDate < {:2} AND Status__c = 'Open'
-        """ . format(self.__from_date.strftime(self.SOQL_DATEFORMAT), self.__to_date.strftime(self.SOQL_DATEFORMAT))
+                WHERE {where}
+        """ . format(fields=fields + u', ' if fields else u'', where=whereClause or self.buildWhereClause())
+
+
+    def buildWhereClause(self):
+        u"""Returns the SOQL condition selecting the open inspections of the tour date"""
+        return u"{0} AND Status__c = '{1}'" . format(self.buildWindowClause(), self.STATUS_OPEN)
+
+
+    def buildWindowClause(self):
+        u"""Returns the SOQL condition selecting the inspections created around the tour date"""
+        return u"CreatedDate > {:1} AND CreatedDate < {:2}" . format(
+                self.__from_date.strftime(self.SOQL_DATEFORMAT), self.__to_date.strftime(self.SOQL_DATEFORMAT))
+
+
+    def selectEngine(self):
+        u"""
+            Returns the fetch engine, 'rest', 'bulk' or 'auto'
+
+            The engine is taken from option --engine or config key salesforce.fetchEngine
+            (default 'auto'). 'auto' is resolved by iterAutoPages without an extra API call.
+        """
+        config = self.__app.config
+        engine = getattr(self.__app.options, 'engine', None)
+        if not engine:
+            engine = config.get('salesforce', 'fetchEngine') if config.has_option('salesforce', 'fetchEngine') else 'auto'
+
+        if engine not in self.ENGINES:
+            raise ValueError(u"unknown fetch engine '{0}'" . format(engine))
+
+        return engine
 
-        records = self.__app.salesforce.query_all(query)
 
-        for record in records['records']:
-            self.flattenRecord(record)
-            result.append(record)
+    def iterAutoPages(self, query):
+        u"""
+            Generator yielding the records of query per page, engine 'auto'
 
-        return result
+            The first REST page is fetched as usual. If its totalSize exceeds
+            salesforce.bulkThreshold and more pages are pending, the page is dropped and the
+            query runs as Bulk API 2.0 job instead. Small runs thus need no extra API call,
+            large runs one.
+        """
+        config = self.__app.config
+        threshold = config.getint('salesforce', 'bulkThreshold') \
+                if config.has_option('salesforce', 'bulkThreshold') else self.BULK_THRESHOLD
+
+        result = self.__app.callSalesforce('query', query)
+        if result['done'] or result['totalSize'] <= threshold:
+            pages = self.iterRestPages(query, result)
+        else:
+            self.__app.logger.debug(u"{0} inspections, threshold {1} -> engine bulk" . format(result['totalSize'],
+                    threshold))
+            self.totalSize = result['totalSize']
+            pages = BulkQuery(self.__app).iterPages(query)
+
+        for page in pages:
+            yield page
+
+
+    def iterPages(self, query):
+        u"""
+            Generator yielding the raw records of query page by page
+
+            The pages are fetched by a background thread, either from the REST API or from a
+            Bulk API 2.0 query job (see selectEngine). Errors of the thread are re-raised in
+            the caller. If the caller stops iterating, the thread is stopped as well.
+        """
+        pages = Queue.Queue(maxsize=self.PREFETCH_PAGES)
+        stop = threading.Event()
+
+        def fetch():
+            try:
+                engine = self.selectEngine()
+                if engine == 'bulk':
+                    source = BulkQuery(self.__app).iterPages(query)
+                elif engine == 'auto':
+                    source = self.iterAutoPages(query)
+                else:
+                    source = self.iterRestPages(query)
+                for page in source:
+                    if not self.__put(pages, stop, (u'page', page)):
+                        source.close()
+                        return
+                self.__put(pages, stop, (u'done', None))
+            except Exception:
+                self.__put(pages, stop, (u'error', sys.exc_info()))
+
+        fetcher = threading.Thread(target=fetch, name='salesforce-fetch')
+        fetcher.daemon = True
+        fetcher.start()
+
+        try:
+            while True:
+                kind, payload = pages.get()
+                if kind == u'page':
+                    yield payload
+                elif kind == u'error':
+                    raise payload[0], payload[1], payload[2]
+                else:
+                    break
+        finally:
+            stop.set()
+
+
+    def iterRestPages(self, query, result=None, includeDeleted=False):
+        u"""
+            Generator yielding the records of query per REST page, following nextRecordsUrl
+
+            Every page is fetched by its own callSalesforce() call, so each API request is
+            counted. Use this instead of query_all, which pages internally.
+
+            @param result           - first page if it was already fetched
+            @param includeDeleted   - query deleted records as well (queryAll endpoint)
+        """
+        kwargs = { 'include_deleted': True } if includeDeleted else {}
+        if result is None:
+            result = self.__app.callSalesforce('query', query, **kwargs)
+        self.totalSize = result['totalSize']
+        self.__app.logger.debug(u"query returned {0} records" . format(self.totalSize))
+        yield result['records']
+
+        while not result['done']:
+            result = self.__app.callSalesforce('query_more', result['nextRecordsUrl'], identifier_is_url=True,
+                    **kwargs)
+            yield result['records']
+
+
+    def __put(self, pages, stop, item):
+        u"""Puts item into queue unless the consumer stopped. Returns False if stopped"""
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
 
 
     def flattenRecord(self, record):
-        u"""Flattens record and removes unwanted entries"""
-        del record[u'attributes']
-        pharmacy = record.pop(u'Shopper_Contract__r')
-        del pharmacy[u'attributes']
-        record.update(pharmacy)
-    
-        self.splitAccountInformation(record)
+        u"""Flattens record into a PharmacyRecord. Records with malformed Account_Information__c are logged"""
+        pharmacy = PharmacyRecord.fromSalesforce(record)
+        if not pharmacy.valid:
+            self.__app.logger.warning(u"{0}: {1}" . format(pharmacy.Shopper_Contract__c, pharmacy.error))
+
+        return pharmacy
 
 
     def printRecord(self, record, depth=0, maxDepth=5):
@@ -83,27 +346,13 @@ class GetInspections(object):
 
 
     def splitAccountInformation(self, record):
-        try:
-            parts = record[u'Account_Information__c'].split('<br>')
-        except AttributeError, msg:
-            self.__app.logger.debug(msg)
-            parts = record[u'Account_Information__c']
-
-        if isinstance(parts, list) and len(parts) > 7:
-            d = collections.OrderedDict()
-            d[u'pharmacy'] = parts[0]
-            d[u'sap_id'] = parts[1]
-            d[u'strasse'] = parts[2]
-            d[u'plz'], void, d[u'ort'] = parts[3].partition(u' ')
-            d[u'state'], void, d[u'country'] = parts[4].partition(u' ')
-            d[u'extra'] = parts[5]
-            void, void, d[u'email'] = parts[6].partition(u' ')
-            void, void, d[u'phone'] = parts[7].partition(u' ')
-            record.update(d)
-            del record[u'Account_Information__c']
+        u"""Splits Account_Information__c of a PharmacyRecord. Returns False if it is malformed"""
+        return record.parseAccountInformation()
 
 
     def getMetadata(self):
+        if not self.__allowOptional(u'getMetadata'):
+            return
         meta = self.__app.salesforce.Shopper_Contract__c.metadata()
         pp = pprint.PrettyPrinter(indent=4)
         for record in meta['objectDescribe']:
@@ -111,11 +360,97 @@ class GetInspections(object):
 
 
     def getDescription(self):
+        if not self.__allowOptional(u'getDescription'):
+            return
         descr = self.__app.salesforce.Shopper_Contract__c.describe()
         for field in descr['fields']:
             print(field)
 
 
+    def __allowOptional(self, name):
+        u"""Verzichtbare Aufrufe entfallen, wenn das API-Kontingent knapp ist, siehe SalesforceTransport"""
+        transport = getattr(self.__app, 'salesforceTransport', None)
+        return transport is None or transport.allowOptional(name)
+
+
+class MultiDayInspections(object):
+    u"""
+    Inspektionen mehrerer Tourdaten
+
+    Ruft die Zeitfenster der einzelnen Tourdaten parallel mit einem begrenzten Thread-Pool
+    aus Salesforce ab. Da sich die Zeitfenster benachbarter Tage überschneiden, wird jeder
+    Vertrag (Shopper_Contract__c) nur einmal geliefert. Die dabei verworfenen Inspektionen
+    stehen danach in duplicates, damit sie ebenfalls zurückgeschrieben werden können. Bietet
+    dieselbe Schnittstelle wie GetInspections.
+    """
+
+    """const"""
+    WORKERS = 4
+
+    """private"""
+    __app, __days, __workers, __records, __duplicates = (None,)*5
+
+    def __init__(self, app, tour_dates, workers=WORKERS):
+        if not hasattr(app, 'salesforce'):
+            raise AttributeError(u'Object \'app\' has no attribute \'salesforce\'')
+
+        self.__app = app
+        self.__days = [GetInspections(app, tour_date) for tour_date in tour_dates]
+        self.__workers = max(1, min(workers, len(self.__days)))
+        self.__duplicates = []
+
+
+    @property
+    def duplicates(self):
+        u"""Inspektionen, deren Vertrag bereits an einem anderen Tourdatum geliefert wurde"""
+        return self.__duplicates
+
+
+    def getInspections(self):
+        u"""Gets de-duplicated inspections of all tour dates. Returns list of objects"""
+        if self.__records is None:
+            self.__records = list(self.iterInspections())
+
+        return self.__records
+
+
+    def iterInspections(self):
+        u"""
+            Generator yielding de-duplicated inspections of all tour dates
+
+            The days are fetched concurrently; records are yielded in order of the tour dates
+            as soon as the respective day is complete.
+        """
+        if self.__records is not None:
+            for record in self.__records:
+                yield record
+            return
+
+        seen = set()
+        self.__duplicates = []
+        pool = ThreadPool(self.__workers)
+        try:
+            for records in pool.imap(self.__fetchDay, self.__days):
+                for record in records:
+                    if record[u'Shopper_Contract__c'] in seen:
+                        self.__duplicates.append(record)
+                        continue
+                    seen.add(record[u'Shopper_Contract__c'])
+                    yield record
+        finally:
+            pool.terminate()
+
+        self.__app.logger.debug(u"{0} tour dates, {1} distinct contracts" . format(len(self.__days), len(seen)))
+
+
+    def printRecord(self, record, depth=0, maxDepth=5):
+        self.__days[0].printRecord(record, depth=depth, maxDepth=maxDepth)
+
+
+    def __fetchDay(self, day):
+        return day.getInspections()
+
+
 if __name__ == '__main__':
     sys.exit("This module is not for execution")
 
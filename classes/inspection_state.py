@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Zuletzt bekannter Stand der Inspektionen je Tourdatum für den inkrementellen Abruf.
+
+Pro Tourdatum wird eine JSON-Datei mit den offenen Inspektionen und dem höchsten
+SystemModstamp (Watermark) des letzten Abrufs abgelegt. Folgende Läufe holen nur noch
+Inspektionen, die seitdem geändert oder gelöscht wurden, und führen sie mit diesem Stand
+zusammen. Gehört der Stand zu einer anderen Abfrage, wird er verworfen.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, datetime, json, hashlib, collections, tempfile
+
+class InspectionState(object):
+
+    """const"""
+    PREFIX = 'inspections-'
+    SUFFIX = '.json'
+    MARGIN = 300
+    DATEFORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    """private"""
+    __app, __directory, __margin = (None,)*3
+
+    def __init__(self, app, directory, margin=MARGIN):
+        u"""
+            @param app          - Applikation
+            @param directory    - Verzeichnis der Zustandsdateien
+            @param margin       - Sekunden, um die vor der Watermark erneut abgefragt wird. Fängt
+                                  Änderungen ab, die Salesforce verzögert sichtbar macht.
+        """
+        if not hasattr(app, 'logger'):
+            raise AttributeError(u'Object \'app\' has no attribute \'logger\'')
+
+        self.__app = app
+        self.__directory = directory
+        self.__margin = datetime.timedelta(seconds=margin)
+
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory, 0o700)
+
+
+    def load(self, tourDate, query):
+        u"""
+            tuple load(tourDate, query)
+
+            Liefert den gespeicherten Stand des Tourdatums oder None, wenn keiner vorhanden ist
+            oder er zu einer anderen Abfrage gehört.
+
+            @param tourDate - Tourdatum als datetime
+            @param query    - Text der SOQL-Abfrage
+            @return tuple|None  - Watermark (YYYY-MM-DDThh:mm:ss, UTC) und OrderedDict
+                                  Inspektions-Id -> Datensatz als dict
+        """
+        path = self.__path(tourDate)
+        try:
+            with open(path, 'rb') as fp:
+                state = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        except IOError:
+            return None
+        except ValueError as msg:
+            self.__app.logger.warning(u"state {0} unreadable: {1}" . format(path, msg))
+            return None
+
+        if state.get(u'query') != self.__digest(query) or not state.get(u'watermark'):
+            self.__app.logger.debug(u"state {0} belongs to another query" . format(path))
+            return None
+
+        self.__app.logger.debug(u"state {0} loaded, watermark {1}, {2:d} records" . format(path,
+                state[u'watermark'], len(state[u'records'])))
+        return state[u'watermark'], state[u'records']
+
+
+    def save(self, tourDate, query, watermark, records):
+        u"""
+            void save(tourDate, query, watermark, records)
+
+            Speichert den Stand des Tourdatums. Die Datei wird unter einem temporären Namen
+            geschrieben und umbenannt.
+
+            @param tourDate     - Tourdatum als datetime
+            @param query        - Text der SOQL-Abfrage
+            @param watermark    - höchster SystemModstamp der Datensätze
+            @param records      - OrderedDict Inspektions-Id -> Datensatz als dict
+        """
+        state = collections.OrderedDict([(u'query', self.__digest(query)), (u'watermark', watermark),
+                (u'saved', time.time()), (u'records', records)])
+
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.__directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(state, fp)
+            os.rename(tmpPath, self.__path(tourDate))
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+    def since(self, watermark):
+        u"""
+            string since(watermark)
+
+            Liefert den Zeitpunkt, ab dem Änderungen abgefragt werden: die Watermark abzüglich
+            der Sicherheitsspanne, im Format YYYY-MM-DDThh:mm:ss (UTC).
+
+            @param watermark    - Watermark im Format YYYY-MM-DDThh:mm:ss
+            @return string
+        """
+        return (datetime.datetime.strptime(watermark, self.DATEFORMAT) - self.__margin).strftime(self.DATEFORMAT)
+
+
+    def __path(self, tourDate):
+        return os.path.join(self.__directory, self.PREFIX + tourDate.strftime('%Y-%m-%d') + self.SUFFIX)
+
+
+    def __digest(self, query):
+        return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
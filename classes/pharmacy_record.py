@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Datensatz einer markierten Apotheke aus Salesforce.
+
+PharmacyRecord wird in einem Durchgang aus der JSON-Antwort von Salesforce aufgebaut und
+enthält die Felder der Inspektion, des Vertrags (Shopper_Contract__r) und die aus
+Account_Information__c zerlegten Adressdaten. Die Klasse verwendet __slots__ und verhält
+sich nach außen wie ein dict, die Datensätze können daher direkt als Parameter an die
+Abfragen in SWDB übergeben werden.
+"""
+
+from __future__ import print_function
+
+import os, sys, json, hashlib, collections
+
+class PharmacyRecord(object):
+
+    """const"""
+    SALESFORCE_FIELDS = (u'Shopper_Contract__c', u'Id', u'Name', u'Account_Information__c', u'Status__c',
+            u'Shelf_Details__c', u'Shopper_Termination__c', u'Shopper_Termination_Reason__c', u'Contact__c',
+            u'IsDeleted', u'Active__c', u'Shelf_Length__c', u'Shelf_Width__c')
+    ACCOUNT_FIELDS = (u'pharmacy', u'sap_id', u'strasse', u'plz', u'ort', u'state', u'country', u'extra',
+            u'email', u'phone')
+    FIELDS = SALESFORCE_FIELDS + ACCOUNT_FIELDS + (u'id', u'error')
+    ACCOUNT_PARTS = 8
+    SEPARATOR = u'<br>'
+    u"""Felder, die nach outlet und apo_masterdata übernommen werden, siehe digest()"""
+    SYNCED_FIELDS = (u'pharmacy', u'strasse', u'plz', u'ort', u'country', u'email', u'phone', u'sap_id', u'Name',
+            u'Status__c', u'Shelf_Details__c', u'Contact__c', u'IsDeleted', u'Active__c', u'Shopper_Termination__c',
+            u'Shopper_Termination_Reason__c')
+
+    __slots__ = tuple(str(field) for field in FIELDS)
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, None)
+
+
+    @classmethod
+    def fromSalesforce(cls, record):
+        u"""
+            PharmacyRecord fromSalesforce(record)
+
+            Baut den Datensatz aus einer Inspektion, wie sie query()/query_all() liefern. Die
+            Felder von Shopper_Contract__r werden übernommen, Account_Information__c wird
+            zerlegt. Der übergebene record wird nicht verändert.
+
+            @param record   - Inspektion als dict
+            @return PharmacyRecord
+        """
+        self = cls()
+        for source in (record, record.get(u'Shopper_Contract__r') or {}):
+            for key, value in source.items():
+                if key in cls.SALESFORCE_FIELDS:
+                    setattr(self, key, value)
+
+        self.parseAccountInformation()
+        return self
+
+
+    @classmethod
+    def fromDict(cls, record):
+        u"""
+            PharmacyRecord fromDict(record)
+
+            Baut den Datensatz aus einem bereits flachen dict, z.B. aus einem Snapshot.
+            Unbekannte Schlüssel werden ignoriert.
+
+            @param record   - Datensatz als dict
+            @return PharmacyRecord
+        """
+        self = cls()
+        for key, value in record.items():
+            if key in cls.FIELDS:
+                setattr(self, key, value)
+
+        return self
+
+
+    def parseAccountInformation(self):
+        u"""
+            boolean parseAccountInformation()
+
+            Zerlegt Account_Information__c in Name, SAP-Id, Straße, PLZ/Ort, Bundesland/Land,
+            Zusatz, E-Mail und Telefon. Getrennt wird genau an SEPARATOR, die Teile werden
+            unverändert übernommen (kein <BR> oder <br/>, kein Entfernen von Leerzeichen).
+            Bei Erfolg wird das Feld Account_Information__c geleert.
+            Fehlt das Feld oder hat es weniger als ACCOUNT_PARTS Teile, bleibt es erhalten,
+            vorhandene Teile werden übernommen und 'error' beschreibt das Problem.
+
+            @return boolean - True, wenn das Feld vollständig zerlegt wurde
+        """
+        blob = self.Account_Information__c
+        if not isinstance(blob, basestring):
+            self.error = u"Account_Information__c missing"
+            return False
+
+        parts = blob.split(self.SEPARATOR)
+        count = len(parts)
+        parts += [u''] * (self.ACCOUNT_PARTS - count)
+
+        self.pharmacy, self.sap_id, self.strasse = parts[0:3]
+        self.plz, void, self.ort = parts[3].partition(u' ')
+        self.state, void, self.country = parts[4].partition(u' ')
+        self.extra = parts[5]
+        self.email = parts[6].partition(u' ')[2]
+        self.phone = parts[7].partition(u' ')[2]
+
+        if count < self.ACCOUNT_PARTS:
+            self.error = u"Account_Information__c has {0:d} of {1:d} parts" . format(count, self.ACCOUNT_PARTS)
+            return False
+
+        self.Account_Information__c = None
+        return True
+
+
+    @property
+    def valid(self):
+        u"""True, wenn der Datensatz fehlerfrei zerlegt wurde und angelegt werden kann"""
+        return self.error is None
+
+
+    def outletParams(self):
+        u"""Parameter für SWDB.insertOutlet"""
+        return dict((field, getattr(self, field)) for field in (u'pharmacy', u'strasse', u'plz', u'ort',
+                u'country', u'email', u'phone'))
+
+
+    def masterdataParams(self):
+        u"""Parameter für SWDB.insertApoMasterdata"""
+        return dict((field, getattr(self, field)) for field in (u'id', u'sap_id', u'Shopper_Contract__c', u'Name',
+                u'Status__c', u'Shelf_Details__c', u'Contact__c', u'IsDeleted', u'Active__c',
+                u'Shopper_Termination__c', u'Shopper_Termination_Reason__c'))
+
+
+    def digest(self):
+        u"""
+            string digest()
+
+            Prüfsumme (SHA-1) über die Felder, die in die SWDB übernommen werden. Weicht sie von
+            der beim letzten Abgleich gespeicherten ab, müssen die Stammdaten aktualisiert werden.
+
+            @return string
+        """
+        values = [getattr(self, field) for field in self.SYNCED_FIELDS]
+        return hashlib.sha1(json.dumps(values, separators=(',', ':'))).hexdigest()
+
+
+    def toDict(self):
+        u"""Liefert den Datensatz als OrderedDict, z.B. für JSON"""
+        return collections.OrderedDict(self.items())
+
+
+    u"""dict-Schnittstelle"""
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS or key == u'valid' else default
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.FIELDS]
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def __repr__(self):
+        return u"PharmacyRecord({0!r}, {1!r})" . format(self.Shopper_Contract__c, self.pharmacy)
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
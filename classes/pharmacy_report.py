@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Gibt die aktiven Apotheken der SWDB als kompakte Tabelle auf der Konsole aus.
+
+Pro Apotheke wird eine Zeile geschrieben. Die Zeilen kommen aus einem serverseitigen
+Cursor und werden gepuffert ausgegeben, Speicherbedarf und Laufzeit bleiben damit auch
+bei mehreren tausend Apotheken gering.
+"""
+
+from __future__ import print_function
+
+import os, sys, codecs
+
+class PharmacyReport(object):
+
+    """const"""
+    COLUMNS = (
+        (u'id', u'Id', 7),
+        (u'name', u'Name', 32),
+        (u'strasse', u'Straße', 26),
+        (u'plz', u'PLZ', 5),
+        (u'ort', u'Ort', 20),
+        (u'byr_status', u'Status', 12),
+        (u'citymanager', u'Citymanager', 20),
+    )
+    FLUSH_LINES = 500
+
+    """private"""
+    __app, __swdb, __stream = (None,)*3
+
+    def __init__(self, app, swdb, stream=None):
+        if not hasattr(app, 'logger'):
+            raise AttributeError(u'Object \'app\' has no attribute \'logger\'')
+
+        self.__app = app
+        self.__swdb = swdb
+        self.__stream = stream or codecs.getwriter('utf-8')(sys.stdout)
+
+
+    def render(self, limit=None, pageSize=0):
+        u"""
+            integer render(limit, pageSize)
+
+            Schreibt die Tabelle der aktiven Apotheken. Bei pageSize > 0 wird der Tabellenkopf
+            alle pageSize Zeilen wiederholt.
+
+            @param limit    - maximale Anzahl Zeilen, None für alle
+            @param pageSize - Zeilen pro Seite, 0 für keine Seiten
+            @return integer - Anzahl der ausgegebenen Zeilen
+        """
+        lines = [u"\n\nAktive Datensätze in der Sit&Watch-Datenbank nach Abgleich mit Salesforce\n"]
+        cnt = 0
+        for cnt, pharmacy in enumerate(self.__swdb.iterActivePharmacies(limit=limit), 1):
+            if cnt == 1 or (pageSize and (cnt - 1) % pageSize == 0):
+                lines.extend(self.__header())
+            lines.append(u' | ' . join(self.__cell(pharmacy[key], width) for key, title, width in self.COLUMNS))
+            lines.append(u"\n")
+
+            if len(lines) >= self.FLUSH_LINES:
+                self.__write(lines)
+
+        lines.append(u"\n{:d} rows shown.\n" . format(cnt))
+        self.__write(lines)
+        self.__stream.flush()
+
+        return cnt
+
+
+    def renderSummary(self):
+        u"""
+            integer renderSummary()
+
+            Schreibt nur die Anzahl der aktiven Apotheken je Status und insgesamt.
+
+            @return integer - Anzahl der aktiven Apotheken
+        """
+        summary = self.__swdb.getActivePharmaciesSummary()
+        total = sum(count for status, count in summary)
+
+        lines = [u"\n\nAktive Datensätze in der Sit&Watch-Datenbank nach Abgleich mit Salesforce\n"]
+        for status, count in summary:
+            lines.append(u"{:<20s} {:>7d}\n" . format(status or u'-', count))
+        lines.append(u"{:<20s} {:>7d}\n" . format(u'Gesamt', total))
+        self.__write(lines)
+        self.__stream.flush()
+
+        return total
+
+
+    def __header(self):
+        titles = u' | ' . join(self.__cell(title, width) for key, title, width in self.COLUMNS)
+        separator = u'-+-' . join(u'-' * width for key, title, width in self.COLUMNS)
+        return [u"\n", titles, u"\n", separator, u"\n"]
+
+
+    def __cell(self, value, width):
+        if value is None:
+            value = u''
+        elif not isinstance(value, unicode):
+            value = unicode(value) if not isinstance(value, str) else value.decode('utf-8')
+
+        return u"{0:<{1}.{1}}" . format(value, width)
+
+
+    def __write(self, lines):
+        self.__stream.write(u'' . join(lines))
+        del lines[:]
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
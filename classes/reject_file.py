@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Quarantäne für Datensätze, die beim Abgleich nicht übernommen werden konnten.
+
+Abgewiesen werden neue Apotheken mit fehlerhafter Account_Information__c (Planung) und
+Apotheken, deren Anlage oder Aktualisierung in der SWDB fehlgeschlagen ist (Ausführung).
+Die Datensätze werden mit dem Fehler als JSON gespeichert. Mit --resume werden nur diese
+Datensätze erneut abgeglichen, ohne die Inspektionen aus Salesforce neu abzurufen. Die Datei
+kann vorher von Hand korrigiert werden, Account_Information__c wird beim Laden erneut zerlegt.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, json, tempfile, collections
+
+from pharmacy_record import PharmacyRecord
+
+class RejectFile(object):
+
+    """const"""
+    STAGE_PARSE = u'parse'
+    STAGE_APPLY = u'apply'
+
+    """private"""
+    __app, __path = (None,)*2
+
+    def __init__(self, app, path):
+        u"""
+            @param app      - Applikation
+            @param path     - Dateiname der Quarantäne
+        """
+        if not hasattr(app, 'logger'):
+            raise AttributeError(u'Object \'app\' has no attribute \'logger\'')
+
+        self.__app = app
+        self.__path = path
+
+
+    @property
+    def path(self):
+        return self.__path
+
+
+    def save(self, rejects, failed):
+        u"""
+            void save(rejects, failed)
+
+            Ersetzt den Inhalt der Quarantäne. Ohne Datensätze wird die Datei gelöscht. Die Datei
+            wird unter einem temporären Namen geschrieben und umbenannt.
+
+            @param rejects  - bei der Planung abgewiesene Datensätze als PharmacyRecord
+            @param failed   - bei der Ausführung fehlgeschlagene Datensätze als PharmacyRecord
+            @throws IOError
+        """
+        entries = [self.__entry(self.STAGE_PARSE, record) for record in rejects] + \
+                [self.__entry(self.STAGE_APPLY, record) for record in failed]
+        if not entries:
+            if os.path.exists(self.__path):
+                os.remove(self.__path)
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(collections.OrderedDict([(u'saved', time.time()), (u'records', entries)]), fp, indent=2)
+            os.rename(tmpPath, self.__path)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        self.__app.logger.warning(u"{0:d} records quarantined in {1}" . format(len(entries), self.__path))
+
+
+    def load(self):
+        u"""
+            list load()
+
+            Liest die Datensätze der Quarantäne. Bei der Planung abgewiesene Datensätze werden
+            erneut zerlegt, bei der Ausführung fehlgeschlagene unverändert wieder freigegeben.
+
+            @return list    - Datensätze als PharmacyRecord, leer, wenn keine Datei vorhanden ist
+            @throws ValueError
+        """
+        try:
+            with open(self.__path, 'rb') as fp:
+                state = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        except IOError:
+            return []
+
+        records = []
+        for entry in state[u'records']:
+            record = PharmacyRecord.fromDict(entry[u'record'])
+            record.error = None
+            if entry[u'stage'] == self.STAGE_PARSE:
+                record.parseAccountInformation()
+            records.append(record)
+
+        self.__app.logger.debug(u"{0:d} records loaded from {1}" . format(len(records), self.__path))
+        return records
+
+
+    def iterInspections(self):
+        u"""Liefert die Datensätze der Quarantäne, Schnittstelle wie GetInspections.iterInspections()"""
+        for record in self.load():
+            yield record
+
+
+    def printRecord(self, record):
+        for key, value in record.items():
+            if value is not None:
+                print(u"{0:29s} | {1:17s} | {2:}" . format(key, type(value), value))
+
+
+    def __entry(self, stage, record):
+        return collections.OrderedDict([(u'stage', stage), (u'error', record.error), (u'record', record.toDict())])
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Kennzahlen eines Abgleichs.
+
+Erfasst die Dauer einzelner Stufen (Login, Abruf aus Salesforce, Aufbereitung, SQL je
+Operation, Commit) und Zähler (SQL-Statements, betroffene Zeilen, angelegte/aktivierte/
+deaktivierte Apotheken, Salesforce-API-Aufrufe) sowie die Laufzeit jedes SQL-Statements
+je Abfragetext. Die Kennzahlen werden als JSON und im Textformat für den Textfile-Collector
+des Prometheus node_exporter geschrieben, die Statements nur als JSON.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, math, json, threading, tempfile, collections, contextlib
+
+class RunMetrics(object):
+
+    """const"""
+    PROMETHEUS_PREFIX = u'bayershopper_sync'
+
+    """private"""
+    __lock, __started, __stages, __counters, __statements = (None,)*5
+
+    """public"""
+    success = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__stages = collections.OrderedDict()
+        self.__counters = collections.OrderedDict()
+        self.__statements = collections.OrderedDict()
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        u"""
+            Kontextmanager, der die Dauer des Blocks zur Stufe 'name' addiert.
+
+            Beispiel:
+                with app.metrics.stage('commit'):
+                    app.postgresql.commit()
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.time() - start)
+
+
+    def addTime(self, name, seconds):
+        u"""Addiert seconds zur Dauer der Stufe name"""
+        with self.__lock:
+            self.__stages[name] = self.__stages.get(name, 0.0) + seconds
+
+
+    def count(self, name, value=1):
+        u"""Erhöht den Zähler name um value"""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+
+    def addStatement(self, query, seconds):
+        u"""Erfasst die Laufzeit eines SQL-Statements, Leerraum im Abfragetext wird zusammengefasst"""
+        key = u" " . join((query.decode('utf-8') if isinstance(query, str) else query).split())
+        with self.__lock:
+            self.__statements.setdefault(key, []).append(seconds)
+
+
+    def statements(self):
+        u"""
+            list statements()
+
+            @return list    - OrderedDict mit Abfragetext, Anzahl, Gesamtdauer, Mittelwert und
+                              95. Perzentil (Sekunden) je Abfrage, nach Gesamtdauer absteigend
+        """
+        with self.__lock:
+            timings = [(query, sorted(durations)) for query, durations in self.__statements.items()]
+
+        result = [collections.OrderedDict([(u'query', query), (u'count', len(durations)),
+                (u'total', sum(durations)), (u'mean', sum(durations) / len(durations)),
+                (u'p95', durations[int(math.ceil(0.95 * len(durations))) - 1])]) for query, durations in timings]
+        return sorted(result, key=lambda entry: entry[u'total'], reverse=True)
+
+
+    def set(self, name, value):
+        u"""Setzt den Zähler name auf value, z.B. für Stände wie das verbrauchte API-Kontingent"""
+        with self.__lock:
+            self.__counters[name] = value
+
+
+    def get(self, name):
+        u"""Liefert den Wert des Zählers name"""
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+
+    def toDict(self):
+        u"""Liefert alle Kennzahlen als OrderedDict"""
+        statements = self.statements()
+        with self.__lock:
+            return collections.OrderedDict([
+                (u'started', self.__started),
+                (u'duration', time.time() - self.__started),
+                (u'success', self.success),
+                (u'stages', collections.OrderedDict(self.__stages)),
+                (u'counters', collections.OrderedDict(self.__counters)),
+                (u'statements', statements),
+            ])
+
+
+    def writeJson(self, path):
+        u"""Schreibt die Kennzahlen als JSON nach path"""
+        self.__writeAtomic(path, json.dumps(self.toDict(), indent=2))
+
+
+    def writePrometheus(self, path):
+        u"""
+            Schreibt die Kennzahlen im Prometheus-Textformat nach path. Die Datei wird unter
+            einem temporären Namen geschrieben und umbenannt, damit der node_exporter nie
+            eine halb geschriebene Datei liest.
+        """
+        data = self.toDict()
+        prefix = self.PROMETHEUS_PREFIX
+        lines = [
+            u"# HELP {0}_stage_seconds Time spent per stage of the last run" . format(prefix),
+            u"# TYPE {0}_stage_seconds gauge" . format(prefix),
+        ]
+        for name, seconds in data[u'stages'].items():
+            lines.append(u'{0}_stage_seconds{{stage="{1}"}} {2:.6f}' . format(prefix, name, seconds))
+
+        lines += [
+            u"# HELP {0}_count Counters of the last run" . format(prefix),
+            u"# TYPE {0}_count gauge" . format(prefix),
+        ]
+        for name, value in data[u'counters'].items():
+            lines.append(u'{0}_count{{counter="{1}"}} {2}' . format(prefix, name, value))
+
+        lines += [
+            u"# HELP {0}_duration_seconds Duration of the last run" . format(prefix),
+            u"# TYPE {0}_duration_seconds gauge" . format(prefix),
+            u"{0}_duration_seconds {1:.6f}" . format(prefix, data[u'duration']),
+            u"# HELP {0}_success Whether the last run succeeded" . format(prefix),
+            u"# TYPE {0}_success gauge" . format(prefix),
+            u"{0}_success {1:d}" . format(prefix, 1 if data[u'success'] else 0),
+            u"# HELP {0}_last_run_timestamp_seconds Start of the last run" . format(prefix),
+            u"# TYPE {0}_last_run_timestamp_seconds gauge" . format(prefix),
+            u"{0}_last_run_timestamp_seconds {1:.0f}" . format(prefix, data[u'started']),
+        ]
+        self.__writeAtomic(path, u"\n" . join(lines) + u"\n")
+
+
+    def __writeAtomic(self, path, content):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(content.encode('utf-8') if isinstance(content, unicode) else content)
+            os.chmod(tmpPath, 0o644)
+            os.rename(tmpPath, path)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
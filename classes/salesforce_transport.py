@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+HTTP-Transport für die Salesforce-Aufrufe.
+
+Alle Aufrufe (REST, Bulk API 2.0, sObject Collections) laufen über eine requests.Session
+mit einem Pool von Keep-Alive-Verbindungen, dessen Größe zu den parallelen Abrufen passt.
+Antworten werden gzip-komprimiert angefordert. Idempotente Aufrufe (GET, HEAD, OPTIONS)
+werden bei Verbindungsfehlern, Timeouts und den Status 500, 502, 503 und 504 mit
+exponentiell wachsender Wartezeit wiederholt, ein Header Retry-After wird beachtet.
+
+Aus dem Header Sforce-Limit-Info jeder Antwort wird der Verbrauch des täglichen API-Limits
+gelesen. Unterschreitet das verbleibende Kontingent die Reserve, werden weitere Aufrufe
+verzögert und verzichtbare Aufrufe (getMetadata, getDescription) ausgelassen.
+
+Konfiguration im Abschnitt [salesforce]:
+
+    poolSize = <ANZAHL>         ; optional, Verbindungen im Pool, Default 10
+    retries = <ANZAHL>          ; optional, Wiederholungen idempotenter Aufrufe, Default 5
+    backoff = <SEKUNDEN>        ; optional, Basis der Wartezeit, Default 0.5
+    timeout = <SEKUNDEN>        ; optional, Lese-Timeout, Default 120
+    quotaReserve = <ANTEIL>     ; optional, Reserve des Tageslimits, Default 0.1
+    throttleDelay = <SEKUNDEN>  ; optional, Verzögerung je Aufruf in der Reserve, Default 1.0
+"""
+
+from __future__ import print_function
+
+import os, sys, re, time, threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+class TransportAdapter(HTTPAdapter):
+    u"""HTTPAdapter, der vor jedem Aufruf drosselt und einen Default-Timeout setzt"""
+
+    """private"""
+    __transport = None
+
+    def __init__(self, transport, **kwargs):
+        self.__transport = transport
+        HTTPAdapter.__init__(self, **kwargs)
+
+
+    def send(self, request, **kwargs):
+        self.__transport.throttle()
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.__transport.timeout
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+class SalesforceTransport(object):
+
+    """const"""
+    POOL_SIZE = 10
+    RETRIES = 5
+    BACKOFF = 0.5
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 120
+    QUOTA_RESERVE = 0.1
+    THROTTLE_DELAY = 1.0
+    RETRY_STATUS = (500, 502, 503, 504)
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    LIMIT_HEADER = 'Sforce-Limit-Info'
+
+    """private"""
+    __app, __poolSize, __retries, __backoff, __timeout, __reserve, __delay = (None,)*7
+    __lock, __used, __limit = (None,)*3
+    _apiUsage = re.compile(r'api-usage=(\d+)/(\d+)')
+
+    def __init__(self, app):
+        if not hasattr(app, 'config'):
+            raise AttributeError(u'Object \'app\' has no attribute \'config\'')
+
+        self.__app = app
+        config = app.config
+        self.__poolSize = config.getint('salesforce', 'poolSize') \
+                if config.has_option('salesforce', 'poolSize') else self.POOL_SIZE
+        self.__retries = config.getint('salesforce', 'retries') \
+                if config.has_option('salesforce', 'retries') else self.RETRIES
+        self.__backoff = config.getfloat('salesforce', 'backoff') \
+                if config.has_option('salesforce', 'backoff') else self.BACKOFF
+        self.__timeout = (self.CONNECT_TIMEOUT, config.getfloat('salesforce', 'timeout') \
+                if config.has_option('salesforce', 'timeout') else self.READ_TIMEOUT)
+        self.__reserve = config.getfloat('salesforce', 'quotaReserve') \
+                if config.has_option('salesforce', 'quotaReserve') else self.QUOTA_RESERVE
+        self.__delay = config.getfloat('salesforce', 'throttleDelay') \
+                if config.has_option('salesforce', 'throttleDelay') else self.THROTTLE_DELAY
+        self.__lock = threading.Lock()
+
+
+    @property
+    def timeout(self):
+        u"""Default-Timeout (Verbindung, Lesen) in Sekunden"""
+        return self.__timeout
+
+
+    def createSession(self):
+        u"""
+            Session createSession()
+
+            Erzeugt die Session für simple_salesforce und die eigenen Aufrufe der Bulk API und
+            der sObject Collections.
+
+            @return requests.Session
+        """
+        session = requests.Session()
+        adapter = TransportAdapter(self, pool_connections=self.__poolSize, pool_maxsize=self.__poolSize,
+                max_retries=self.createRetry())
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip'
+        session.hooks['response'].append(self.__onResponse)
+
+        return session
+
+
+    def createRetry(self):
+        u"""
+            Retry createRetry()
+
+            Wiederholungen für Verbindungsfehler, Timeouts und vorübergehende Fehler des Servers.
+            Nicht idempotente Aufrufe werden nur wiederholt, wenn die Verbindung nicht aufgebaut
+            werden konnte, die Anfrage also nicht gesendet wurde. Nach der letzten Wiederholung
+            wird die Antwort geliefert, die Auswertung bleibt beim Aufrufer.
+
+            @return Retry
+        """
+        kwargs = dict(total=self.__retries, connect=self.__retries, read=self.__retries, status=self.__retries,
+                backoff_factor=self.__backoff, status_forcelist=self.RETRY_STATUS, raise_on_status=False)
+        try:
+            return Retry(allowed_methods=self.IDEMPOTENT_METHODS, **kwargs)
+        except TypeError:
+            u"""urllib3 < 1.26"""
+            return Retry(method_whitelist=self.IDEMPOTENT_METHODS, **kwargs)
+
+
+    def apiUsage(self):
+        u"""
+            tuple apiUsage()
+
+            @return tuple   - verbrauchte Aufrufe und Tageslimit laut der letzten Antwort,
+                              (None, None), solange keine Antwort den Header enthielt
+        """
+        with self.__lock:
+            return self.__used, self.__limit
+
+
+    def isLow(self):
+        u"""True, wenn das verbleibende Tageskontingent die Reserve unterschreitet"""
+        used, limit = self.apiUsage()
+        return bool(limit) and limit - used < limit * self.__reserve
+
+
+    def throttle(self):
+        u"""Verzögert den nächsten Aufruf, solange das Kontingent in der Reserve liegt"""
+        if self.isLow():
+            self.__app.metrics.count(u'salesforce_throttled')
+            time.sleep(self.__delay)
+
+
+    def allowOptional(self, name):
+        u"""
+            boolean allowOptional(name)
+
+            Prüft, ob ein verzichtbarer Aufruf ausgeführt werden soll.
+
+            @param name     - Name des Aufrufs für das Log
+            @return boolean - False, wenn das Kontingent in der Reserve liegt
+        """
+        if not self.isLow():
+            return True
+
+        used, limit = self.apiUsage()
+        self.__app.logger.warning(u"API quota low ({0:d}/{1:d}), skipping {2}" . format(used, limit, name))
+        return False
+
+
+    def __onResponse(self, response, *args, **kwargs):
+        u"""Hook der Session: liest Sforce-Limit-Info und zählt die Wiederholungen"""
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            self.__app.metrics.count(u'salesforce_retries', len(retries.history))
+
+        match = self._apiUsage.search(response.headers.get(self.LIMIT_HEADER, ''))
+        if not match:
+            return
+
+        used, limit = int(match.group(1)), int(match.group(2))
+        with self.__lock:
+            wasLow = bool(self.__limit) and self.__limit - self.__used < self.__limit * self.__reserve
+            self.__used, self.__limit = used, limit
+        self.__app.metrics.set(u'salesforce_api_usage', used)
+        self.__app.metrics.set(u'salesforce_api_limit', limit)
+
+        if not wasLow and self.isLow():
+            self.__app.logger.warning(u"API quota low ({0:d}/{1:d}), throttling calls" . format(used, limit))
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
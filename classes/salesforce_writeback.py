@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Schreibt das Ergebnis des Abgleichs nach Salesforce zurück.
+
+Nach einem erfolgreichen Commit werden die verarbeiteten Inspektionen markiert und auf
+Wunsch die Outlet-Id der SWDB eingetragen. Die Updates werden über die sObject Collections
+API in Blöcken von bis zu 200 Datensätzen pro Aufruf gesendet statt einzeln über
+Shopper_Inspection__c.update(). Fehler werden je Datensatz gemeldet, vorübergehende Fehler
+werden mit wachsender Wartezeit wiederholt.
+
+Konfiguration im Abschnitt [writeback]:
+
+    statusField = <FELD>        ; Feld, das gesetzt wird, z.B. SWDB_Synchronized__c
+    statusValue = <WERT>        ; optional, Default: Zeitpunkt des Abgleichs (ISO 8601)
+    outletIdField = <FELD>      ; optional, Feld für die Outlet-Id der SWDB
+    batchSize = <ANZAHL>        ; optional, höchstens 200
+    retries = <ANZAHL>          ; optional, Default 3
+"""
+
+from __future__ import print_function
+
+import os, sys, time, datetime, json, collections
+
+class SalesforceWritebackError(Exception):
+    u"""Ein Block konnte auch nach allen Wiederholungen nicht gesendet werden"""
+    pass
+
+
+class SalesforceWriteback(object):
+
+    """const"""
+    MIN_VERSION = 42.0
+    BATCH_SIZE = 200
+    RETRIES = 3
+    BACKOFF = 2.0
+    SOBJECT = u'Shopper_Inspection__c'
+    RETRY_CODES = (u'UNABLE_TO_LOCK_ROW', u'SERVER_UNAVAILABLE', u'REQUEST_RUNNING_TOO_LONG')
+
+    """private"""
+    __app, __statusField, __statusValue, __outletIdField, __batchSize, __retries, __inspections = (None,)*7
+
+    def __init__(self, app):
+        if not hasattr(app, 'callSalesforce'):
+            raise AttributeError(u'Object \'app\' has no attribute \'callSalesforce\'')
+
+        self.__app = app
+        config = app.config
+        self.__statusField = config.get('writeback', 'statusField')
+        self.__statusValue = config.get('writeback', 'statusValue') \
+                if config.has_option('writeback', 'statusValue') else None
+        self.__outletIdField = config.get('writeback', 'outletIdField') \
+                if config.has_option('writeback', 'outletIdField') else None
+        self.__batchSize = min(self.BATCH_SIZE, config.getint('writeback', 'batchSize') \
+                if config.has_option('writeback', 'batchSize') else self.BATCH_SIZE)
+        self.__retries = config.getint('writeback', 'retries') \
+                if config.has_option('writeback', 'retries') else self.RETRIES
+        self.__inspections = collections.OrderedDict()
+
+
+    def track(self, record):
+        u"""
+            void track(record)
+
+            Merkt die Inspektion eines verarbeiteten Datensatzes für das Zurückschreiben vor.
+
+            @param record   - Datensatz als PharmacyRecord
+        """
+        self.__inspections[record.Id] = record.Shopper_Contract__c
+
+
+    def trackedSalesforceIds(self):
+        u"""Salesforce-Ids der Apotheken aller vorgemerkten Inspektionen"""
+        return set(self.__inspections.values())
+
+
+    def writeBack(self, outletIds):
+        u"""
+            OrderedDict writeBack(outletIds)
+
+            Aktualisiert alle vorgemerkten Inspektionen, deren Apotheke in der SWDB vorhanden
+            ist. Inspektionen ohne Outlet-Id wurden abgewiesen und werden übersprungen.
+
+            @param outletIds    - dict Salesforce-Id -> Outlet-Id, siehe SWDB.getOutletIds()
+            @return OrderedDict - Anzahl der aktualisierten, übersprungenen und fehlgeschlagenen Inspektionen
+        """
+        value = self.__statusValue or datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        records = []
+        for inspectionId, salesforceId in self.__inspections.items():
+            if outletIds.get(salesforceId) is None:
+                continue
+            record = collections.OrderedDict([(u'attributes', { u'type': self.SOBJECT }), (u'id', inspectionId),
+                    (self.__statusField, value)])
+            if self.__outletIdField:
+                record[self.__outletIdField] = outletIds[salesforceId]
+            records.append(record)
+
+        result = collections.OrderedDict([(u'updated', 0), (u'skipped', len(self.__inspections) - len(records)),
+                (u'failed', 0)])
+        for start in xrange(0, len(records), self.__batchSize):
+            updated, failed = self.__sendBatch(records[start:start + self.__batchSize])
+            result[u'updated'] += updated
+            result[u'failed'] += failed
+
+        self.__inspections.clear()
+        self.__app.logger.info(u"writeback: {0}" . format(dict(result)))
+        return result
+
+
+    def __sendBatch(self, records):
+        u"""
+            Sendet einen Block und wiederholt die Datensätze mit vorübergehenden Fehlern.
+            Liefert die Anzahl der aktualisierten und der endgültig fehlgeschlagenen Datensätze.
+        """
+        updated, failed = 0, 0
+        for attempt in xrange(self.__retries + 1):
+            if attempt:
+                time.sleep(self.BACKOFF ** attempt)
+
+            try:
+                results = self.__request(records)
+            except SalesforceWritebackError as msg:
+                self.__app.logger.warning(u"writeback batch failed (attempt {0:d}): {1}" . format(attempt + 1, msg))
+                continue
+
+            retry = []
+            for record, status in zip(records, results):
+                if status.get(u'success'):
+                    updated += 1
+                    continue
+                errors = status.get(u'errors') or []
+                if any(error.get(u'statusCode') in self.RETRY_CODES for error in errors) and attempt < self.__retries:
+                    retry.append(record)
+                else:
+                    failed += 1
+                    self.__app.logger.error(u"writeback of {0} failed: {1}" . format(record[u'id'],
+                            u'; ' . join(u"{0}: {1}" . format(error.get(u'statusCode'), error.get(u'message'))
+                                    for error in errors)))
+
+            records = retry
+            if not records:
+                break
+        else:
+            failed += len(records)
+            self.__app.logger.error(u"writeback of {0:d} inspections failed after {1:d} attempts" .
+                    format(len(records), self.__retries + 1))
+
+        return updated, failed
+
+
+    def __request(self, records):
+        u"""Sendet ein PATCH an /composite/sobjects. Bei abgelaufener Session wird einmal neu angemeldet"""
+        body = json.dumps({ u'allOrNone': False, u'records': records })
+        salesforce = self.__app.salesforce
+        response = self.__send(salesforce, body)
+        if response.status_code == 401:
+            self.__app.refreshSalesforce(salesforce)
+            response = self.__send(self.__app.salesforce, body)
+
+        if response.status_code >= 300:
+            raise SalesforceWritebackError(u"PATCH {0} failed with status {1}: {2}" . format(response.url,
+                    response.status_code, response.text))
+
+        return response.json()
+
+
+    def __send(self, salesforce, body):
+        version = max(float(salesforce.sf_version), self.MIN_VERSION)
+        url = u'https://{0}/services/data/v{1:.1f}/composite/sobjects' . format(salesforce.sf_instance, version)
+
+        with self.__app.metrics.stage(u'salesforce_writeback'):
+            self.__app.metrics.count(u'salesforce_api_calls')
+            return salesforce.session.request('PATCH', url, headers=salesforce.headers, data=body)
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
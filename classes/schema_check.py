@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Prüft Indizes und Ausführungspläne der Tabellen, die der Abgleich liest und schreibt.
+
+Alle Abfragen des Abgleichs filtern auf apo_masterdata.byr_salesforce_id, outlet.outletart
+und outlet_gebietsleiter.outlet. Fehlt dort ein Index, werden die Abfragen zu sequentiellen
+Scans. SchemaCheck liest die vorhandenen Indizes aus pg_indexes, meldet fehlende und nie
+verwendete Indizes und prüft die Pläne der Abfragen aus SWDB mit EXPLAIN. Auf Wunsch werden
+die fehlenden Indizes mit CREATE INDEX CONCURRENTLY angelegt, ohne die Tabellen zu sperren.
+
+Außerdem wird geprüft, ob die Tabellen existieren, die der Abgleich zusätzlich zum Schema
+der SWDB benötigt (REQUIRED_TABLES). Der Abgleich legt sie nicht selbst an, sie werden hier
+auf Wunsch angelegt.
+"""
+
+from __future__ import print_function
+
+import os, sys, re, collections
+
+from swdb import SWDB
+
+class SchemaCheck(object):
+
+    """const"""
+    u"""Empfohlene Indizes: (Tabelle, Spalte, Name des Index)"""
+    RECOMMENDED_INDEXES = (
+        (u'apo_masterdata', u'byr_salesforce_id', u'apo_masterdata_byr_salesforce_id_idx'),
+        (u'outlet', u'outletart', u'outlet_outletart_idx'),
+        (u'outlet_gebietsleiter', u'outlet', u'outlet_gebietsleiter_outlet_idx'),
+    )
+    TABLES = (u'apo_masterdata', u'outlet', u'outlet_gebietsleiter', u'bundeslaender', u'stammdaten')
+
+    u"""Vom Abgleich benötigte Tabellen außerhalb des Schemas der SWDB: (Name, Definition)"""
+    REQUIRED_TABLES = (
+        (SWDB.DIGEST_TABLE, SWDB.DIGEST_TABLE_DEFINITION),
+    )
+
+    u"""
+        Abfragen aus SWDB mit Beispielparametern: (Name, Abfrage, Parameter, Tabellen, die
+        per Index gelesen werden sollen). Die übrigen Abfragen lesen ohnehin alle Apotheken,
+        ein Seq Scan wird für sie nur angezeigt.
+    """
+    STATEMENTS = (
+        (u'entryExists', SWDB.ENTRY_EXISTS_QUERY, { u'salesforce_id': u'' }, (u'apo_masterdata',)),
+        (u'getOutletIds', SWDB.OUTLET_IDS_QUERY, { u'ids': [u''] }, (u'apo_masterdata',)),
+        (u'setOutletsStatus', SWDB.SET_OUTLETS_STATUS_QUERY, { u'ids': [0], u'active': True }, (u'outlet',)),
+        (u'createPlan', SWDB.OUTLET_STATUS_QUERY, {}, ()),
+        (u'activePharmacies', SWDB.ACTIVE_PHARMACIES_QUERY, {}, ()),
+        (u'exportActivePharmacies', SWDB.ACTIVE_PHARMACIES_EXPORT_QUERY, {}, ()),
+    )
+
+    INDEX_QUERY = u"""SELECT i.tablename, i.indexname, i.indexdef, s.idx_scan
+        FROM pg_indexes i
+            LEFT JOIN pg_stat_user_indexes s ON s.schemaname = i.schemaname AND s.indexrelname = i.indexname
+        WHERE i.schemaname = current_schema() AND i.tablename = ANY(%(tables)s)
+        ORDER BY i.tablename, i.indexname"""
+
+    """private"""
+    __app, __swdb = (None,)*2
+    _leadingColumn = re.compile(r'USING \w+ \(\s*"?(\w+)"?', re.IGNORECASE)
+
+    def __init__(self, app, swdb):
+        if not hasattr(app, 'postgresql'):
+            raise AttributeError(u'Object \'app\' has no attribute \'postgresql\'')
+
+        self.__app = app
+        self.__swdb = swdb
+
+
+    def run(self, createIndexes=False):
+        u"""
+            boolean run(createIndexes)
+
+            Führt alle Prüfungen aus und gibt das Ergebnis auf der Konsole aus.
+
+            @param createIndexes    - fehlende Tabellen und Indizes (CREATE INDEX CONCURRENTLY) anlegen
+            @return boolean         - True, wenn keine benötigte Tabelle und kein empfohlener Index
+                                      fehlt und keine Abfrage eine per Index zu lesende Tabelle
+                                      sequentiell liest
+        """
+        missingTables = self.findMissingTables()
+        print(u"Fehlende Tabellen")
+        for name, definition in missingTables:
+            print(u"  {0}" . format(name))
+        if not missingTables:
+            print(u"  keine")
+
+        if missingTables and createIndexes:
+            print(u"\nLege fehlende Tabellen an")
+            self.createTables(missingTables)
+            missingTables = self.findMissingTables()
+
+        indexes = self.getIndexes()
+        missing = self.findMissingIndexes(indexes)
+
+        print(u"\nIndizes")
+        for table, name, definition, scans in indexes:
+            print(u"  {0:<24s} {1:<44s} {2:>10s} scans" . format(table, name, u'-' if scans is None else unicode(scans)))
+
+        print(u"\nFehlende Indizes")
+        for table, column, name in missing:
+            print(u"  {0}.{1} -> {2}" . format(table, column, self.createIndexStatement(table, column, name)))
+        if not missing:
+            print(u"  keine")
+
+        print(u"\nNicht verwendete Indizes (idx_scan = 0, ohne UNIQUE)")
+        unused = self.findUnusedIndexes(indexes)
+        for table, name in unused:
+            print(u"  {0}.{1}" . format(table, name))
+        if not unused:
+            print(u"  keine")
+
+        print(u"\nAusführungspläne")
+        seqScans = 0
+        for name, scans, unexpected in self.explainStatements():
+            seqScans += len(unexpected)
+            status = u"FEHLT INDEX" if unexpected else u"ok"
+            print(u"  {0:<24s} {1:<12s} {2}" . format(name, status, u"Seq Scan auf " + u", " . join(scans) if scans else u""))
+        self.__app.postgresql.rollback()
+
+        if missing and createIndexes:
+            print(u"\nLege fehlende Indizes an")
+            self.createIndexes(missing)
+            missing = self.findMissingIndexes(self.getIndexes())
+
+        return not missingTables and not missing and not seqScans
+
+
+    def findMissingTables(self):
+        u"""
+            list findMissingTables()
+
+            @return list    - (Name, Definition) der fehlenden Tabellen aus REQUIRED_TABLES
+        """
+        missing = []
+        cur = self.__app.postgresql.cursor()
+        try:
+            for name, definition in self.REQUIRED_TABLES:
+                cur.execute(u"SELECT to_regclass(%(table)s) IS NOT NULL", { u'table': name })
+                if not cur.fetchone()[0]:
+                    missing.append((name, definition))
+        finally:
+            cur.close()
+            self.__app.postgresql.rollback()
+
+        return missing
+
+
+    def getIndexes(self):
+        u"""
+            list getIndexes()
+
+            @return list    - (Tabelle, Name, Definition, Anzahl Scans) je Index der geprüften Tabellen
+        """
+        cur = self.__app.postgresql.cursor()
+        try:
+            cur.execute(self.INDEX_QUERY, { u'tables': list(self.TABLES) })
+            res = cur.fetchall()
+        finally:
+            cur.close()
+
+        return res
+
+
+    def findMissingIndexes(self, indexes):
+        u"""
+            list findMissingIndexes(indexes)
+
+            Ein empfohlener Index gilt als vorhanden, wenn ein Index der Tabelle mit der
+            Spalte beginnt, unabhängig von seinem Namen.
+
+            @param indexes  - Ergebnis von getIndexes()
+            @return list    - (Tabelle, Spalte, Name) der fehlenden Indizes
+        """
+        leading = set()
+        for table, name, definition, scans in indexes:
+            match = self._leadingColumn.search(definition)
+            if match:
+                leading.add((table, match.group(1)))
+
+        return [(table, column, name) for table, column, name in self.RECOMMENDED_INDEXES
+                if (table, column) not in leading]
+
+
+    def findUnusedIndexes(self, indexes):
+        u"""
+            list findUnusedIndexes(indexes)
+
+            Indizes ohne einen einzigen Scan seit dem letzten Zurücksetzen der Statistik.
+            UNIQUE-Indizes werden übergangen, sie sichern Constraints ab.
+
+            @param indexes  - Ergebnis von getIndexes()
+            @return list    - (Tabelle, Name)
+        """
+        return [(table, name) for table, name, definition, scans in indexes
+                if scans == 0 and not definition.upper().startswith(u'CREATE UNIQUE')]
+
+
+    def explainStatements(self):
+        u"""
+            Generator yielding (Name, Tabellen mit Seq Scan, davon unerwartet) je Abfrage aus STATEMENTS
+
+            Unerwartet ist ein Seq Scan auf einer Tabelle, die per Index gelesen werden soll.
+            Auf sehr kleinen Tabellen wählt der Planer auch bei vorhandenem Index einen Seq Scan.
+            Solche Abfragen werden daher mit enable_seqscan = off erneut geplant, unerwartet
+            ist der Seq Scan nur, wenn der Planer auch dann keinen Index verwenden kann.
+            Die Einstellung gilt nur bis zum Ende der Transaktion.
+        """
+        for name, query, params, indexed in self.STATEMENTS:
+            scans = sorted(set(self.__seqScans(self.__swdb.explain(query, params))))
+            unexpected = [relation for relation in scans if relation in indexed]
+            if unexpected:
+                self.__setSeqScan(False)
+                try:
+                    forced = set(self.__seqScans(self.__swdb.explain(query, params)))
+                finally:
+                    self.__setSeqScan(True)
+                unexpected = [relation for relation in unexpected if relation in forced]
+            yield name, scans, unexpected
+
+
+    def createIndexStatement(self, table, column, name):
+        u"""Liefert das CREATE INDEX CONCURRENTLY-Statement für einen empfohlenen Index"""
+        return u"CREATE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} ({2})" . format(name, table, column)
+
+
+    def createIndexes(self, missing):
+        u"""
+            void createIndexes(missing)
+
+            Legt Indizes mit CREATE INDEX CONCURRENTLY an. Das ist nur außerhalb einer
+            Transaktion möglich, dafür wird eine eigene Verbindung im Autocommit-Modus geöffnet.
+
+            @param missing  - Ergebnis von findMissingIndexes()
+            @throws Exception
+        """
+        self.__executeAutocommit([self.createIndexStatement(table, column, name) for table, column, name in missing])
+
+
+    def createTables(self, missing):
+        u"""
+            void createTables(missing)
+
+            Legt die fehlenden Tabellen mit ihrer Definition aus REQUIRED_TABLES an.
+
+            @param missing  - Ergebnis von findMissingTables()
+            @throws Exception
+        """
+        self.__executeAutocommit([definition for name, definition in missing])
+
+
+    def __executeAutocommit(self, statements):
+        connection = self.__app.connectPostgresql()
+        try:
+            connection.autocommit = True
+            cur = connection.cursor()
+            for statement in statements:
+                print(u"  " + statement)
+                self.__app.logger.info(statement)
+                cur.execute(statement)
+            cur.close()
+        finally:
+            connection.close()
+
+
+    def __setSeqScan(self, enabled):
+        cur = self.__app.postgresql.cursor()
+        try:
+            cur.execute(u"SET LOCAL enable_seqscan = " + (u"on" if enabled else u"off"))
+        finally:
+            cur.close()
+
+
+    def __seqScans(self, node):
+        if node.get(u'Node Type') == u'Seq Scan':
+            yield node.get(u'Relation Name')
+        for child in node.get(u'Plans', []):
+            for relation in self.__seqScans(child):
+                yield relation
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Speichert Salesforce-Sessions zwischen zwei Aufrufen.
+
+Session-Id und Instanz werden in einer JSON-Datei abgelegt, die nur für den Besitzer
+lesbar ist (0600). Der Schlüssel eines Eintrags wird aus Benutzer, Sandbox-Flag und
+API-Version gebildet. Einträge, die älter als maxAge sind, werden nicht mehr verwendet.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, json, hashlib, tempfile
+
+class SessionCache(object):
+
+    """private"""
+    __app, __path, __maxAge = (None,)*3
+
+    def __init__(self, app, path, maxAge=7200):
+        if not hasattr(app, 'logger'):
+            raise AttributeError(u'Object \'app\' has no attribute \'logger\'')
+
+        self.__app = app
+        self.__path = path
+        self.__maxAge = maxAge
+
+
+    def get(self, username, sandbox, version):
+        u"""
+            tuple get(username, sandbox, version)
+
+            Liefert (session_id, instance) der gespeicherten Session oder None, wenn keine
+            gültige Session vorhanden ist.
+
+            @param username - Salesforce-Benutzer
+            @param sandbox  - boolean, Sandbox oder Produktion
+            @param version  - API-Version
+            @return tuple|None
+        """
+        entry = self.__load().get(self.__key(username, sandbox, version))
+        if not entry:
+            return None
+
+        age = time.time() - entry[u'created']
+        if age > self.__maxAge:
+            self.__app.logger.debug(u"cached salesforce session expired ({0:.0f}s old)" . format(age))
+            return None
+
+        return entry[u'session_id'], entry[u'instance']
+
+
+    def put(self, username, sandbox, version, sessionId, instance):
+        u"""
+            void put(username, sandbox, version, sessionId, instance)
+
+            Speichert die Session. Die Datei wird mit den Rechten 0600 neu geschrieben.
+        """
+        entries = self.__load()
+        entries[self.__key(username, sandbox, version)] = { u'session_id': sessionId, u'instance': instance,
+                u'created': time.time() }
+        self.__save(entries)
+
+
+    def invalidate(self, username, sandbox, version):
+        u"""
+            void invalidate(username, sandbox, version)
+
+            Entfernt die gespeicherte Session, z.B. nachdem Salesforce sie als abgelaufen
+            zurückgewiesen hat.
+        """
+        entries = self.__load()
+        if entries.pop(self.__key(username, sandbox, version), None) is not None:
+            self.__save(entries)
+
+
+    def __key(self, username, sandbox, version):
+        return hashlib.sha1(u"{0}|{1}|{2}" . format(username, bool(sandbox), version).encode('utf-8')).hexdigest()
+
+
+    def __load(self):
+        try:
+            with open(self.__path, 'rb') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+
+    def __save(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.__path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(entries, fp)
+            os.rename(tmpPath, self.__path)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Paralleler Abgleich über mehrere Verbindungen zur SWDB.
+
+Die Datensätze aus Salesforce werden nach einem Hash von Shopper_Contract__c auf mehrere
+Shards verteilt. Jeder Shard legt auf einer eigenen Verbindung die neuen Apotheken an und
+aktiviert die markierten, während Salesforce weitere Seiten liefert. Anschließend
+deaktivieren die Shards parallel die nicht markierten Apotheken, aufgeteilt nach Outlet-Id.
+Die Shards schreiben damit nie dieselben Zeilen und sperren sich nicht gegenseitig.
+
+Jeder Shard läuft in einer Two-Phase-Commit-Transaktion. Übernommen wird erst, wenn alle
+Shards vorbereitet sind (PREPARE TRANSACTION), andernfalls werden alle zurückgerollt. Der
+Lauf wird damit wie bisher als Ganzes übernommen oder verworfen. Der Server benötigt dafür
+max_prepared_transactions >= Anzahl der Shards, das wird vor dem Start der Shards geprüft.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, zlib, threading, Queue, collections
+from multiprocessing.pool import ThreadPool
+
+from swdb import SWDB, SWDBError
+
+class ShardedReconciler(object):
+
+    """const"""
+    SHARDS = 4
+    QUEUE_SIZE = 1000
+
+    """private"""
+    __app, __swdb, __shards, __connections = (None,)*4
+
+    def __init__(self, app, swdb, shards=SHARDS):
+        if not hasattr(app, 'connectPostgresql'):
+            raise AttributeError(u'Object \'app\' has no attribute \'connectPostgresql\'')
+
+        self.__app = app
+        self.__swdb = swdb
+        self.__shards = max(1, shards)
+        self.__connections = []
+
+
+    def reconcile(self, records):
+        u"""
+            OrderedDict reconcile(records)
+
+            Gleicht die Datensätze parallel mit der SWDB ab. Die Transaktionen der Shards
+            bleiben offen, bis finish() aufgerufen wird.
+
+            @param records  - Iterable mit Datensätzen als PharmacyRecord
+            @return OrderedDict - Anzahl der neu angelegten, abgewiesenen, aktivierten,
+                                  deaktivierten und unveränderten Apotheken
+            @throws SWDBError   - der Server erlaubt zu wenige vorbereitete Transaktionen
+            @throws Exception
+        """
+        self.__checkPreparedTransactions()
+        self.__swdb.loadIndexes()
+        total = self.__swdb.countPharmacyOutlets()
+
+        shards = []
+        gtrid = u"{0}-{1:d}-{2:d}" . format(os.path.basename(self.__app.APPNAME), os.getpid(), int(time.time()))
+        for idx in xrange(self.__shards):
+            connection = self.__app.connectPostgresql()
+            self.__connections.append(connection)
+            connection.tpc_begin(connection.xid(0, gtrid, u"shard-{0:d}" . format(idx)))
+            swdb = SWDB(self.__app, connection)
+            swdb.shareIndexes(self.__swdb)
+            shards.append(swdb)
+
+        results = self.__runShards(shards, records)
+        outletIds = [id for result in results for id in result[u'outletIds']]
+
+        pool = ThreadPool(self.__shards)
+        try:
+            deactivated = sum(pool.map(lambda (idx, swdb): swdb.deactivateOutlets(outletIds, idx, self.__shards),
+                    enumerate(shards)))
+        finally:
+            pool.terminate()
+
+        result = collections.OrderedDict((key, sum(shard[key] for shard in results))
+                for key in (u'created', u'rejected', u'activated'))
+        result[u'deactivated'] = deactivated
+        result[u'unchanged'] = total - result[u'activated'] - deactivated
+
+        self.__app.logger.debug(u"sharded reconciliation ({0:d} shards): {1}" . format(self.__shards, dict(result)))
+        return result
+
+
+    def finish(self, commit):
+        u"""
+            void finish(commit)
+
+            Schließt die Transaktionen aller Shards ab. Bei commit werden zuerst alle Shards
+            vorbereitet und erst danach committet; schlägt die Vorbereitung eines Shards fehl,
+            werden alle zurückgerollt. Kann gefahrlos mehrfach aufgerufen werden.
+
+            @param commit   - True für commit, False für rollback
+            @throws Exception
+        """
+        connections, self.__connections = self.__connections, []
+        try:
+            if commit:
+                try:
+                    for connection in connections:
+                        connection.tpc_prepare()
+                except Exception:
+                    self.__rollback(connections)
+                    raise
+
+                for connection in connections:
+                    try:
+                        connection.tpc_commit()
+                    except Exception as msg:
+                        self.__app.logger.critical(u"COMMIT PREPARED failed, resolve manually via pg_prepared_xacts: {0}" .
+                                format(msg))
+                        raise
+            else:
+                self.__rollback(connections)
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+    def __checkPreparedTransactions(self):
+        u"""Jeder Shard belegt beim Commit eine vorbereitete Transaktion auf dem Server"""
+        cur = self.__app.postgresql.cursor()
+        try:
+            cur.execute(u"SHOW max_prepared_transactions")
+            maximum = int(cur.fetchone()[0])
+        finally:
+            cur.close()
+
+        if maximum < self.__shards:
+            raise SWDBError(u"{0:d} shards need max_prepared_transactions >= {0:d}, the server allows {1:d}" .
+                    format(self.__shards, maximum))
+
+
+    def __runShards(self, shards, records):
+        u"""Verteilt die Datensätze auf die Shards und wartet, bis alle abgearbeitet sind"""
+        queues = [Queue.Queue(self.QUEUE_SIZE) for swdb in shards]
+        results = [collections.OrderedDict([(u'created', 0), (u'rejected', 0), (u'activated', 0),
+                (u'outletIds', []), (u'error', None)]) for swdb in shards]
+        threads = [threading.Thread(target=self.__reconcileShard, args=(swdb, queue, result),
+                name=u"shard-{0:d}" . format(idx)) for idx, (swdb, queue, result) in enumerate(zip(shards, queues, results))]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for record in records:
+                key = (record[u'Shopper_Contract__c'] or u'').encode('utf-8')
+                queues[(zlib.crc32(key) & 0xffffffff) % len(queues)].put(record)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        for result in results:
+            if result[u'error']:
+                excType, excValue, excTraceback = result[u'error']
+                raise excType, excValue, excTraceback
+
+        return results
+
+
+    def __reconcileShard(self, swdb, queue, result):
+        u"""
+            Legt die neuen Apotheken eines Shards an und aktiviert die markierten. Nach einem
+            Fehler wird die Queue weiter geleert, damit der Verteiler nicht blockiert.
+        """
+        salesforceIds = set()
+        while True:
+            entry = queue.get()
+            if entry is None:
+                break
+            if result[u'error']:
+                continue
+
+            try:
+                salesforceIds.add(entry.Shopper_Contract__c)
+                if not swdb.entryExists(entry.Shopper_Contract__c):
+                    if not entry.valid:
+                        self.__app.logger.warning(u"Entry does not exist and cannot be created: {0}" . format(entry.error))
+                        result[u'rejected'] += 1
+                        continue
+                    newId = swdb.insertOutlet(entry)
+                    swdb.insertApoMasterdata(entry, newId)
+                    result[u'created'] += 1
+            except Exception:
+                result[u'error'] = sys.exc_info()
+
+        if result[u'error']:
+            return
+
+        try:
+            result[u'activated'], result[u'outletIds'] = swdb.activateOutlets(salesforceIds)
+        except Exception:
+            result[u'error'] = sys.exc_info()
+
+
+    def __rollback(self, connections):
+        for connection in connections:
+            try:
+                connection.tpc_rollback()
+            except Exception as msg:
+                self.__app.logger.error(u"rollback of shard failed: {0}" . format(msg))
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
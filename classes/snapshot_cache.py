@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Zwischenspeicher für Salesforce-Abfragen auf der Festplatte.
+
+Die Ergebnisse einer Abfrage werden als JSON-Datei abgelegt. Der Schlüssel setzt sich aus
+dem Tourdatum und dem Text der SOQL-Abfrage zusammen. Snapshots verfallen nach einer
+einstellbaren Zeit (TTL), außerdem wird die Gesamtgröße des Verzeichnisses begrenzt: sind
+die Snapshots zusammen größer als erlaubt, werden die ältesten zuerst gelöscht.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, json, hashlib, collections, tempfile
+
+class SnapshotCache(object):
+
+    """const"""
+    SUFFIX = '.json'
+
+    """private"""
+    __app, __directory, __ttl, __maxSize = (None,)*4
+
+    def __init__(self, app, directory, ttl=3600, maxSize=50*1024*1024):
+        if not hasattr(app, 'logger'):
+            raise AttributeError(u'Object \'app\' has no attribute \'logger\'')
+
+        self.__app = app
+        self.__directory = directory
+        self.__ttl = ttl
+        self.__maxSize = maxSize
+
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory, 0o700)
+
+
+    def key(self, tourDate, query):
+        u"""
+            string key(tourDate, query)
+
+            Liefert den Schlüssel eines Snapshots für Tourdatum und Abfrage.
+
+            @param tourDate - Tourdatum als datetime
+            @param query    - Text der SOQL-Abfrage
+            @return string
+        """
+        digest = hashlib.sha1()
+        digest.update(tourDate.strftime('%Y-%m-%d'))
+        digest.update(query.encode('utf-8'))
+        return digest.hexdigest()
+
+
+    def get(self, key):
+        u"""
+            list get(key)
+
+            Liefert die gespeicherten Datensätze oder None, wenn kein gültiger Snapshot
+            vorhanden ist. Abgelaufene Snapshots werden dabei gelöscht.
+
+            @param key      - Schlüssel des Snapshots
+            @return list|None
+        """
+        path = self.__path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return None
+
+        if age > self.__ttl:
+            self.__app.logger.debug(u"snapshot {0} expired ({1:.0f}s old)" . format(key, age))
+            self.__remove(path)
+            return None
+
+        try:
+            with open(path, 'rb') as fp:
+                records = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        except (IOError, ValueError) as msg:
+            self.__app.logger.warning(u"snapshot {0} unreadable: {1}" . format(key, msg))
+            self.__remove(path)
+            return None
+
+        self.__app.logger.debug(u"snapshot {0} loaded, {1:d} records" . format(key, len(records)))
+        return records
+
+
+    def put(self, key, records):
+        u"""
+            void put(key, records)
+
+            Speichert die Datensätze unter dem Schlüssel. Die Datei wird zuerst unter einem
+            temporären Namen geschrieben und dann umbenannt, damit parallele Läufe nie einen
+            halb geschriebenen Snapshot lesen. Anschließend wird der Cache aufgeräumt.
+
+            @param key      - Schlüssel des Snapshots
+            @param records  - Liste der Datensätze
+        """
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.__directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(records, fp)
+            os.rename(tmpPath, self.__path(key))
+        except Exception:
+            self.__remove(tmpPath)
+            raise
+
+        self.evict()
+
+
+    def evict(self):
+        u"""
+            void evict()
+
+            Löscht abgelaufene Snapshots und anschließend so lange die ältesten, bis die
+            Gesamtgröße unter maxSize liegt.
+        """
+        now = time.time()
+        snapshots = []
+        for name in os.listdir(self.__directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.__directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.__ttl:
+                self.__remove(path)
+            else:
+                snapshots.append((stat.st_mtime, stat.st_size, path))
+
+        totalSize = sum(size for mtime, size, path in snapshots)
+        for mtime, size, path in sorted(snapshots):
+            if totalSize <= self.__maxSize:
+                break
+            self.__app.logger.debug(u"evicting snapshot {0}" . format(path))
+            self.__remove(path)
+            totalSize -= size
+
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key + self.SUFFIX)
+
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -8,20 +8,243 @@ zur Verfügung
 
 from __future__ import print_function
 
-import os, sys, datetime, exceptions
+import os, sys, time, datetime, exceptions, json, collections
 
 import psycopg2, psycopg2.extensions, psycopg2.extras
 
+from sync_plan import SyncPlan
+
+class SWDBError(Exception):
+    u"""Die SWDB erfüllt eine Voraussetzung des Abgleichs nicht"""
+    pass
+
+
+class CopyStream(object):
+    u"""
+    Dateiobjekt für COPY ... FROM STDIN, das die Zeilen erst beim Lesen aus einem Iterator
+    holt. copy_expert() liest blockweise, im Speicher liegt daher nur der aktuelle Block.
+    Eine Exception des Iterators bricht COPY ab, psycopg2 meldet sie nur als Text. Sie wird
+    daher in error festgehalten, damit der Aufrufer sie unverändert weitergeben kann.
+    """
+
+    """private"""
+    __lines, __chunks, __size, __error = (None,)*4
+
+    def __init__(self, lines):
+        u"""
+            @param lines    - Iterable mit den Zeilen als UTF-8-kodierte str, jeweils mit Zeilenende
+        """
+        self.__lines = iter(lines)
+        self.__chunks = []
+        self.__size = 0
+
+
+    @property
+    def error(self):
+        u"""sys.exc_info() der Exception des Iterators, None, wenn keine aufgetreten ist"""
+        return self.__error
+
+
+    def read(self, size=-1):
+        while size < 0 or self.__size < size:
+            try:
+                line = next(self.__lines, None)
+            except Exception:
+                self.__error = sys.exc_info()
+                raise
+            if line is None:
+                break
+            self.__chunks.append(line)
+            self.__size += len(line)
+
+        data = b''.join(self.__chunks)
+        if size < 0 or len(data) <= size:
+            self.__chunks, self.__size = [], 0
+            return data
+
+        self.__chunks, self.__size = [data[size:]], len(data) - size
+        return data[:size]
+
+
 class SWDB(object):
 
+    u"""const"""
+    STAGING_TABLE = u'sf_staging'
+    DIGEST_TABLE = u'sf_sync_digest'
+
+    u"""
+        Tabelle der Prüfsummen, siehe storeDigests(). Sie gehört nicht zum Schema der SWDB
+        und wird einmalig mit --check-schema --create-indexes oder von Hand angelegt, der
+        Abgleich selbst führt kein DDL aus.
+    """
+    DIGEST_TABLE_DEFINITION = u"""CREATE TABLE IF NOT EXISTS sf_sync_digest (
+        outlet_id integer PRIMARY KEY REFERENCES outlet (id) ON DELETE CASCADE,
+        digest text NOT NULL,
+        synced timestamp with time zone NOT NULL)"""
+    APPLY_BATCH_SIZE = 100
+    OUTLET_SEQUENCE = u'outlet_id_seq'
+
+    u"""
+        Spalten der Staging-Tabelle und die zugehörigen Schlüssel im record-Objekt.
+        Die Reihenfolge entspricht der Reihenfolge der Spalten im COPY-Datenstrom.
+    """
+    STAGING_COLUMNS = (
+        (u'byr_salesforce_id', u'Shopper_Contract__c'),
+        (u'byr_sap_id', u'sap_id'),
+        (u'name', u'pharmacy'),
+        (u'strasse', u'strasse'),
+        (u'plz', u'plz'),
+        (u'ort', u'ort'),
+        (u'bundesland', u'country'),
+        (u'email', u'email'),
+        (u'telefon1', u'phone'),
+        (u'byr_name', u'Name'),
+        (u'byr_status', u'Status__c'),
+        (u'byr_shelf_details', u'Shelf_Details__c'),
+        (u'byr_contact_c', u'Contact__c'),
+        (u'byr_is_deleted', u'IsDeleted'),
+        (u'byr_active', u'Active__c'),
+        (u'byr_shopper_termination', u'Shopper_Termination__c'),
+        (u'byr_shopper_termination_reason', u'Shopper_Termination_Reason__c'),
+        (u'is_valid', u'valid'),
+    )
+
+    u"""Aktive Apotheken für die Ausgabe auf der Konsole"""
+    ACTIVE_PHARMACIES_QUERY = u"""SELECT o.id, o.name, o.strasse, o.plz, o.ort, o.email, 
+                o.telefon1, o.outletart, am.byr_salesforce_id, am.byr_name, am.byr_status,
+                am.byr_shelf_details, am.byr_contact_c, am.byr_is_deleted, am.byr_active,
+                cm.firma1 AS citymanager, o.create_time
+            FROM apo_masterdata am 
+                LEFT JOIN outlet o ON o.id = am.id
+                LEFT JOIN outlet_gebietsleiter og ON og.outlet = o.id
+                LEFT JOIN stammdaten cm ON cm.id = og.gebietsleiter
+            WHERE o.aktiv
+            ORDER BY o.ort, o.name"""
+
+    u"""Aktive Apotheken für den Export"""
+    ACTIVE_PHARMACIES_EXPORT_QUERY = u"""SELECT o.id, am.jansen_id, cm.firma1 AS citymanager, cm.id AS citymanager_id, 
+                o.route, o.name, o.strasse, o.plz, o.ort, o.email, o.telefon1, 
+                am.byr_salesforce_id, am.byr_status, am.byr_contact_c, 
+                o.create_time
+            FROM apo_masterdata am 
+                LEFT JOIN outlet o ON o.id = am.id
+                LEFT JOIN outlet_gebietsleiter og ON og.outlet = o.id
+                LEFT JOIN stammdaten cm ON cm.id = og.gebietsleiter
+            WHERE o.aktiv
+            ORDER BY o.ort, o.name"""
+
+    u"""
+        Materialisierte Sicht der aktiven Apotheken mit allen Spalten der Ausgabe und des
+        Exports. Wird nach jedem Commit aktualisiert, siehe refreshActivePharmaciesView().
+
+        Das Schema verhindert nicht, dass eine Apotheke in outlet_gebietsleiter mehrfach demselben
+        Gebietsleiter zugeordnet ist. Alle Spalten außer denen des Gebietsleiters hängen nur
+        von der Outlet-Id ab, mit DISTINCT ist (id, citymanager_key) daher eindeutig und trägt
+        den für REFRESH ... CONCURRENTLY nötigen eindeutigen Index. Doppelte Zuordnungen
+        erscheinen in der Sicht, anders als in den Abfragen auf die Tabellen, nur einmal.
+    """
+    ACTIVE_PHARMACIES_VIEW = u'active_pharmacies_mv'
+    ACTIVE_PHARMACIES_VIEW_DEFINITION = u"""SELECT DISTINCT o.id, am.jansen_id, o.name, o.strasse, o.plz, o.ort,
+                o.email, o.telefon1, o.outletart, o.route, am.byr_salesforce_id, am.byr_name, am.byr_status,
+                am.byr_shelf_details, am.byr_contact_c, am.byr_is_deleted, am.byr_active,
+                cm.firma1 AS citymanager, cm.id AS citymanager_id, coalesce(cm.id, 0) AS citymanager_key,
+                o.create_time
+            FROM apo_masterdata am
+                JOIN outlet o ON o.id = am.id
+                LEFT JOIN outlet_gebietsleiter og ON og.outlet = o.id
+                LEFT JOIN stammdaten cm ON cm.id = og.gebietsleiter
+            WHERE o.aktiv"""
+    ACTIVE_PHARMACIES_VIEW_QUERY = u"""SELECT id, name, strasse, plz, ort, email, telefon1, outletart,
+                byr_salesforce_id, byr_name, byr_status, byr_shelf_details, byr_contact_c, byr_is_deleted,
+                byr_active, citymanager, create_time
+            FROM {view}
+            ORDER BY ort, name""" . format(view=ACTIVE_PHARMACIES_VIEW)
+    ACTIVE_PHARMACIES_VIEW_EXPORT_QUERY = u"""SELECT id, jansen_id, citymanager, citymanager_id, route, name,
+                strasse, plz, ort, email, telefon1, byr_salesforce_id, byr_status, byr_contact_c, create_time
+            FROM {view}
+            ORDER BY ort, name""" . format(view=ACTIVE_PHARMACIES_VIEW)
+
+    u"""Aktualisierung vorhandener Apotheken, Parameter aus PharmacyRecord.outletParams()/masterdataParams()"""
+    UPDATE_OUTLET_QUERY = u"""UPDATE outlet SET name = %(pharmacy)s, strasse = %(strasse)s, plz = %(plz)s,
+                ort = %(ort)s, bundesland = %(bundesland)s, email = %(email)s, telefon1 = %(phone)s
+            WHERE id = %(id)s"""
+    UPDATE_MASTERDATA_QUERY = u"""UPDATE apo_masterdata SET byr_sap_id = %(sap_id)s, byr_name = %(Name)s,
+                byr_status = %(Status__c)s, byr_shelf_details = %(Shelf_Details__c)s, byr_contact_c = %(Contact__c)s,
+                byr_is_deleted = %(IsDeleted)s, byr_active = %(Active__c)s,
+                byr_shopper_termination = %(Shopper_Termination__c)s,
+                byr_shopper_termination_reason = %(Shopper_Termination_Reason__c)s
+            WHERE id = %(id)s"""
+
+    u"""Abfragen des Abgleichs, siehe auch SchemaCheck"""
+    ENTRY_EXISTS_QUERY = u"""SELECT id FROM apo_masterdata WHERE byr_salesforce_id = %(salesforce_id)s"""
+    OUTLET_IDS_QUERY = u"""SELECT byr_salesforce_id, id FROM apo_masterdata WHERE byr_salesforce_id = ANY(%(ids)s)"""
+    OUTLET_STATUS_QUERY = u"""SELECT id, aktiv IS TRUE FROM outlet
+            WHERE id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke'"""
+    SET_OUTLETS_STATUS_QUERY = u"""UPDATE outlet SET aktiv = %(active)s
+            WHERE aktiv IS DISTINCT FROM %(active)s AND id = ANY(%(ids)s::integer[])"""
+
     u"""private"""
-    __app = (None,)*1
+    __app, __connection, __outletIds, __bundeslaender = (None,)*4
+    __useView = False
+    __copyEscapes = { u'\\': u'\\\\', u'\t': u'\\t', u'\n': u'\\n', u'\r': u'\\r' }
 
-    def __init__(self, app):
+    def __init__(self, app, connection=None):
+        u"""
+            @param app          - Applikation
+            @param connection   - eigene Verbindung zur SWDB, Default: app.postgresql
+        """
         if not hasattr(app, 'postgresql'):
             raise AttributeError(u'Object \'app\' has no attribute \'postgresql\'')
 
         self.__app = app
+        self.__connection = connection
+
+
+    @property
+    def __postgresql(self):
+        return self.__connection if self.__connection is not None else self.__app.postgresql
+
+
+    def loadIndexes(self):
+        u"""
+            void loadIndexes()
+
+            Lädt die Zuordnung Salesforce-Id -> Outlet-Id und Bundesland -> Code mit je einer
+            Abfrage in den Speicher. Danach werden entryExists(), insertOutlet() und
+            activateOutlets() ohne weitere Abfragen auf apo_masterdata bzw. bundeslaender
+            beantwortet. Neu angelegte Apotheken werden in den Index übernommen.
+
+            @throws Exception
+        """
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'loadIndexes',
+                    u"""SELECT byr_salesforce_id, id FROM apo_masterdata WHERE byr_salesforce_id IS NOT NULL""")
+            self.__outletIds = dict(cur.fetchall())
+            self.__execute(cur, u'loadIndexes', u"""SELECT name, code FROM bundeslaender""")
+            self.__bundeslaender = dict(cur.fetchall())
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        self.__app.logger.debug(u"indexes loaded: {0} outlets, {1} bundeslaender" .
+                format(len(self.__outletIds), len(self.__bundeslaender)))
+
+
+    def shareIndexes(self, other):
+        u"""
+            void shareIndexes(other)
+
+            Übernimmt die mit loadIndexes() geladenen Indizes einer anderen SWDB-Instanz, z.B.
+            für die Shards des parallelen Abgleichs. Die Indizes werden nicht kopiert, neu
+            angelegte Apotheken landen also in beiden Instanzen.
+
+            @param other    - SWDB-Instanz mit geladenen Indizes
+        """
+        self.__outletIds = other.__outletIds
+        self.__bundeslaender = other.__bundeslaender
 
 
     def entryExists(self, id):
@@ -34,11 +257,12 @@ class SWDB(object):
             @param id   - Salesforce-id der Apotheke
             @return boolean
         """
-        query = u"""SELECT id FROM apo_masterdata WHERE byr_salesforce_id = %(salesforce_id)s"""
+        if self.__outletIds is not None:
+            return id in self.__outletIds
 
         try:
-            cur = self.__app.postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute(query, { u'salesforce_id': id })
+            cur = self.__postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            self.__execute(cur, u'entryExists', self.ENTRY_EXISTS_QUERY, { u'salesforce_id': id })
         except Exception as msg:
             self.__app.logger.error(msg)
             sys.exit(u'Exception occured: {}' . format(msg))
@@ -48,96 +272,170 @@ class SWDB(object):
         return cur.rowcount > 0
 
 
-    def getActivePharmacies(self):
-        u"""Gets all active pharmacies
+    def getOutletIds(self, salesforceIds):
+        u"""
+            dict getOutletIds(salesforceIds)
 
-            @return pharmacies[]
-        """
-        res = []
-        query = u"""SELECT o.id, o.name, o.strasse, o.plz, o.ort, o.email, 
-                o.telefon1, o.outletart, am.byr_salesforce_id, am.byr_name, am.byr_status,
-                am.byr_shelf_details, am.byr_contact_c, am.byr_is_deleted, am.byr_active,
-                cm.firma1 AS citymanager, o.create_time
-            FROM apo_masterdata am 
-                LEFT JOIN outlet o ON o.id = am.id
-                LEFT JOIN outlet_gebietsleiter og ON og.outlet = o.id
-                LEFT JOIN stammdaten cm ON cm.id = og.gebietsleiter
-            WHERE o.aktiv
-            ORDER BY o.ort, o.name"""
+            Liefert die Outlet-Ids der Apotheken mit den angegebenen Salesforce-Ids mit einer
+            einzigen Abfrage. Nicht vorhandene Apotheken fehlen im Ergebnis.
 
+            @param salesforceIds    - Salesforce-Ids
+            @return dict            - Salesforce-Id -> Outlet-Id
+            @throws Exception
+        """
+        cur = self.__postgresql.cursor()
         try:
-            cur = self.__app.postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute(query, {})
-            res = cur.fetchall()
+            self.__execute(cur, u'getOutletIds', self.OUTLET_IDS_QUERY, { u'ids': list(salesforceIds) })
+            res = dict(cur.fetchall())
         except Exception as msg:
             self.__app.logger.error(msg)
+            raise
         finally:
             cur.close()
 
         return res
 
 
-    def getActivePharmaciesCursor(self):
-        u"""Gets all active pharmacies and returns cursor. For csv export"""
-        query = u"""SELECT o.id, am.jansen_id, cm.firma1 AS citymanager, cm.id AS citymanager_id, 
-                o.route, o.name, o.strasse, o.plz, o.ort, o.email, o.telefon1, 
-                am.byr_salesforce_id, am.byr_status, am.byr_contact_c, 
-                o.create_time
-            FROM apo_masterdata am 
-                LEFT JOIN outlet o ON o.id = am.id
-                LEFT JOIN outlet_gebietsleiter og ON og.outlet = o.id
-                LEFT JOIN stammdaten cm ON cm.id = og.gebietsleiter
-            WHERE o.aktiv
-            ORDER BY o.ort, o.name"""
+    def useActivePharmaciesView(self, enabled):
+        u"""
+            void useActivePharmaciesView(enabled)
 
-        cur = self.__app.postgresql.cursor()
-        cur.execute(query, {})
+            Legt fest, ob die aktiven Apotheken aus der materialisierten Sicht oder direkt aus
+            den Tabellen gelesen werden. Die Sicht zeigt nur übernommene Daten, bei einem
+            Probelauf ohne Commit muss daher direkt gelesen werden.
 
-        return cur
+            @param enabled  - True für die Sicht
+        """
+        self.__useView = enabled
 
 
-    def setOutletStatus(self, id, active):
+    def refreshActivePharmaciesView(self):
         u"""
-            void __setOutletStatus(boolean)
+            void refreshActivePharmaciesView()
 
-            Setzt den Status 'aktiv' des Outlets. Als id wird dabei die
-            Salesforce-Id erwartet.
+            Aktualisiert die materialisierte Sicht der aktiven Apotheken mit REFRESH MATERIALIZED
+            VIEW CONCURRENTLY, Leser der Sicht werden dabei nicht blockiert. Existiert die Sicht
+            noch nicht, wird sie mit dem nötigen eindeutigen Index angelegt. Eine Sicht aus einer
+            älteren Version ohne DISTINCT wird dabei ersetzt. Die Transaktion wird abgeschlossen,
+            danach lesen die Methoden für die aktiven Apotheken aus der Sicht.
 
-            @param text     - Salesforce-Id
-            @param bool     - Status
             @throws Exception
         """
-        query = u"""UPDATE outlet SET aktiv = %(active)s 
-                WHERE id = (SELECT id FROM apo_masterdata WHERE byr_salesforce_id = %(id)s)"""
+        params = { u'view': self.ACTIVE_PHARMACIES_VIEW }
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'refreshActivePharmaciesView', u"""SELECT ispopulated, definition FROM pg_matviews
+                WHERE schemaname = current_schema() AND matviewname = %(view)s""", params)
+            row = cur.fetchone()
+            if row is not None and u'DISTINCT' not in row[1].upper():
+                self.__execute(cur, u'refreshActivePharmaciesView', u"""DROP MATERIALIZED VIEW {view}""" .
+                        format(view=self.ACTIVE_PHARMACIES_VIEW))
+                row = None
+            if row is None:
+                self.__execute(cur, u'refreshActivePharmaciesView', u"""CREATE MATERIALIZED VIEW {view} AS {query}""" .
+                        format(view=self.ACTIVE_PHARMACIES_VIEW, query=self.ACTIVE_PHARMACIES_VIEW_DEFINITION))
+                self.__execute(cur, u'refreshActivePharmaciesView',
+                        u"""CREATE UNIQUE INDEX {view}_key_idx ON {view} (id, citymanager_key)""" .
+                        format(view=self.ACTIVE_PHARMACIES_VIEW))
+            else:
+                self.__execute(cur, u'refreshActivePharmaciesView', u"""REFRESH MATERIALIZED VIEW {concurrently} {view}""" .
+                        format(view=self.ACTIVE_PHARMACIES_VIEW, concurrently=u'CONCURRENTLY' if row[0] else u''))
+            self.__postgresql.commit()
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            self.__postgresql.rollback()
+            raise
+        finally:
+            cur.close()
+
+        self.__useView = True
+
+
+    def iterActivePharmacies(self, limit=None, itersize=2000):
+        u"""Generator yielding active pharmacies from a server-side cursor
+
+            Die Zeilen werden blockweise (itersize) vom Server geholt, es liegt also nie das
+            ganze Ergebnis im Speicher.
+
+            @param limit    - maximale Anzahl Zeilen, None für alle
+            @param itersize - Anzahl der Zeilen pro Block
+        """
+        cur = self.__postgresql.cursor(name='active_pharmacies', cursor_factory=psycopg2.extras.DictCursor)
+        cur.itersize = itersize
+        try:
+            for row in self.__iterate(cur, u'iterActivePharmacies',
+                    self.__activePharmaciesQuery() + u" LIMIT %(limit)s", { u'limit': limit }):
+                yield row
+        finally:
+            cur.close()
+
+
+    def getActivePharmaciesSummary(self):
+        u"""Counts active pharmacies per Salesforce status
+
+            @return list of (status, count)
+        """
+        query = u"""SELECT am.byr_status, count(*)
+            FROM apo_masterdata am JOIN outlet o ON o.id = am.id
+            WHERE o.aktiv
+            GROUP BY am.byr_status
+            ORDER BY am.byr_status"""
+        if self.__useView:
+            query = u"""SELECT byr_status, count(DISTINCT id) FROM {view}
+                GROUP BY byr_status
+                ORDER BY byr_status""" . format(view=self.ACTIVE_PHARMACIES_VIEW)
 
+        cur = self.__postgresql.cursor()
         try:
-            cur = self.__app.postgresql.cursor()
-            cur.execute(query, { u'active': active, u'id': id })
-        except Exception, msg:
+            self.__execute(cur, u'getActivePharmaciesSummary', query)
+            res = cur.fetchall()
+        except Exception as msg:
             self.__app.logger.error(msg)
-            raise msg
+            raise
         finally:
             cur.close()
 
+        return res
+
+
+    def getActivePharmaciesCursor(self, name=None, itersize=2000):
+        u"""Gets all active pharmacies and returns cursor. For csv export
 
-    def setAllOutletsInactive(self):
+            @param name     - Name eines serverseitigen Cursors. Damit werden die Zeilen
+                              blockweise (itersize) vom Server geholt. Die Abfrage fehlt dann
+                              in RunMetrics.statements(), siehe __execute()
+            @param itersize - Anzahl der Zeilen pro Block beim serverseitigen Cursor
+            @return cursor
+        """
+        if name:
+            cur = self.__postgresql.cursor(name=name)
+            cur.itersize = itersize
+        else:
+            cur = self.__postgresql.cursor()
+        self.__execute(cur, u'getActivePharmaciesCursor', self.__activePharmaciesQuery(export=True), {})
+
+        return cur
+
+
+    def copyActivePharmacies(self, fileobj):
         u"""
-            void __setAllOutletsInactive()
+            void copyActivePharmacies(fileobj)
 
-            Setzt alle Outlets, die einen Eintrag in apo_masterdata haben oder als Outletart 
-            das Markmal 'apotheke' in der Datenbank auf inaktiv. 
-            Gehört zur Vorbereitung des Abgleichs.
+            Schreibt alle aktiven Apotheken als CSV mit Überschriften in fileobj. Die Datei
+            wird vom Server per COPY ... TO STDOUT erzeugt und direkt durchgereicht.
 
+            @param fileobj  - Datei, in die geschrieben wird
             @throws Exception
         """
-        query = u"""UPDATE outlet SET aktiv = false WHERE id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke'"""
+        query = u"""COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, ENCODING 'UTF8')""" . format(
+                query=self.__activePharmaciesQuery(export=True))
 
+        cur = self.__postgresql.cursor()
         try:
-            cur = self.__app.postgresql.cursor()
-            cur.execute(query, {})
-        except Exception, msg:
-            successful = False
-            self.__app.logger.error(u"Exception: {0}: {1}" . format(type(msg), msg.args))
+            self.__copy(cur, u'copyActivePharmacies', query, fileobj)
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
         finally:
             cur.close()
 
@@ -150,17 +448,24 @@ class SWDB(object):
             Erzeugt einen Eintrag in der Tabelle outlet. Die Daten werden dem record-Objekt
             entnommen. Als Rückgabewert wird die ID des neuen Datensatz zurückgeliefert.
 
-            @param record   - Daten als OrderedDict
+            @param record   - Daten als PharmacyRecord
             @return integer
             @throws Exception
         """
         query = u"""INSERT INTO outlet (name, strasse, plz, ort, bundesland, email, telefon1, outletart, aktiv)
             VALUES (%(pharmacy)s, %(strasse)s, %(plz)s, %(ort)s, (SELECT code FROM bundeslaender WHERE name = %(country)s),
                 %(email)s, %(phone)s, 'apotheke', true) RETURNING id"""
+        params = record.outletParams()
+
+        if self.__bundeslaender is not None:
+            query = u"""INSERT INTO outlet (name, strasse, plz, ort, bundesland, email, telefon1, outletart, aktiv)
+                VALUES (%(pharmacy)s, %(strasse)s, %(plz)s, %(ort)s, %(bundesland)s,
+                    %(email)s, %(phone)s, 'apotheke', true) RETURNING id"""
+            params[u'bundesland'] = self.__bundeslaender.get(record.country)
 
-        cur = self.__app.postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur = self.__postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
         try:
-            cur.execute(query, record)
+            self.__execute(cur, u'insertOutlet', query, params)
             res = cur.fetchone()['id']
         except Exception as msg:
             self.__app.logger.error(msg)
@@ -173,14 +478,14 @@ class SWDB(object):
 
     def insertApoMasterdata(self, record, id):
         res = None
-        record.update({u'id': id})
+        record[u'id'] = id
         u"""
             integer __insertApoMasterdata(record)
 
             Erzeugt einen Eintrag in der Tabelle apo_masterdata. Die Daten werden dem record-Objekt
             entnommen. Als Rückgabewert wird die ID des neuen Datensatzes zurückgeliefert.
 
-            @param record   - Daten als OrderedDict
+            @param record   - Daten als PharmacyRecord
             @return integer
             @throws Exception
         """
@@ -191,19 +496,656 @@ class SWDB(object):
                 %(Shelf_Details__c)s, %(Contact__c)s, %(IsDeleted)s, %(Active__c)s,
                 %(Shopper_Termination__c)s, %(Shopper_Termination_Reason__c)s) RETURNING id"""
 
-        cur = self.__app.postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur = self.__postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
         try:
-            cur.execute(query, record)
+            self.__execute(cur, u'insertApoMasterdata', query, record.masterdataParams())
             res = cur.fetchone()['id']
         except Exception as msg:
-            self.__app.logger.error(msg)
-            print("record = ", record)
+            self.__app.logger.error(u"{0}: {1}" . format(record[u'Shopper_Contract__c'], msg))
             raise msg
         finally:
             cur.close()
 
+        if self.__outletIds is not None:
+            self.__outletIds[record[u'Shopper_Contract__c']] = res
+
+        return res
+
+
+    def bulkReconcile(self, records):
+        u"""
+            dict bulkReconcile(records)
+
+            Gleicht alle Datensätze aus Salesforce in einem Durchgang mit der SWDB ab. Die
+            Datensätze werden per COPY in eine temporäre Staging-Tabelle geladen, anschließend
+            werden neue Outlets und Stammdaten mit wenigen mengenbasierten Statements angelegt
+            und nur die Outlets umgeschaltet, deren Status sich ändert. Die Anzahl der
+            Statements ist unabhängig von der Anzahl der Apotheken.
+
+            @param records  - Iterable mit Datensätzen als PharmacyRecord
+            @return OrderedDict - Anzahl der geladenen ('staged'), neu angelegten ('created'),
+                                  wegen fehlerhafter Daten nicht angelegten ('rejected'),
+                                  aktivierten, deaktivierten und unveränderten Apotheken
+            @throws Exception
+        """
+        self.createStagingTable()
+        staged = self.loadStagingTable(records)
+        created, rejected = self.reconcileStagingTable()
+
+        result = collections.OrderedDict([(u'staged', staged), (u'created', created), (u'rejected', rejected)])
+        result.update(self.applyStagingActivationDiff())
+        result[u'unchanged'] -= created
+
+        self.__app.logger.debug(u"bulk reconciliation: {0}" . format(dict(result)))
+        return result
+
+
+    def createStagingTable(self):
+        u"""
+            void createStagingTable()
+
+            Legt die temporäre Staging-Tabelle für den Abgleich an. Die Spaltentypen werden
+            von den Zieltabellen outlet, apo_masterdata und bundeslaender übernommen. Die
+            Tabelle wird am Ende der Transaktion automatisch gelöscht.
+
+            @throws Exception
+        """
+        query = u"""CREATE TEMPORARY TABLE {table} ON COMMIT DROP AS
+            SELECT am.byr_salesforce_id, am.byr_sap_id, o.name, o.strasse, o.plz, o.ort,
+                    b.name AS bundesland, o.email, o.telefon1, am.byr_name, am.byr_status,
+                    am.byr_shelf_details, am.byr_contact_c, am.byr_is_deleted, am.byr_active,
+                    am.byr_shopper_termination, am.byr_shopper_termination_reason,
+                    true AS is_valid, o.id AS outlet_id, false AS is_new
+                FROM outlet o, apo_masterdata am, bundeslaender b
+            WITH NO DATA""" . format(table=self.STAGING_TABLE)
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'createStagingTable', query)
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+
+    def loadStagingTable(self, records):
+        u"""
+            integer loadStagingTable(records)
+
+            Lädt die Datensätze per COPY in die Staging-Tabelle. Die Zeilen werden über einen
+            CopyStream erst beim Senden erzeugt, die Datensätze werden also nicht gepuffert.
+            Mehrfach vorkommende Salesforce-Ids werden nur einmal übernommen, maßgeblich ist
+            der erste Datensatz.
+
+            @param records  - Iterable mit Datensätzen als PharmacyRecord
+            @return integer - Anzahl der geladenen Datensätze
+            @throws Exception
+        """
+        seen = set()
+        def lines():
+            for record in records:
+                salesforceId = record[u'Shopper_Contract__c']
+                if salesforceId in seen:
+                    continue
+                seen.add(salesforceId)
+                line = u'\t'.join(self.__copyValue(record.get(key)) for column, key in self.STAGING_COLUMNS)
+                yield (line + u'\n').encode('utf-8')
+
+        query = u"""COPY {table} ({columns}) FROM STDIN""" . format(table=self.STAGING_TABLE,
+                columns=u', '.join(column for column, key in self.STAGING_COLUMNS))
+
+        stream = CopyStream(lines())
+        cur = self.__postgresql.cursor()
+        try:
+            self.__copy(cur, u'loadStagingTable', query, stream)
+        except Exception as msg:
+            if stream.error:
+                raise stream.error[0], stream.error[1], stream.error[2]
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return len(seen)
+
+
+    def reconcileStagingTable(self):
+        u"""
+            tuple reconcileStagingTable()
+
+            Ordnet den Datensätzen der Staging-Tabelle die Outlet-Ids zu und legt nicht vorhandene
+            Apotheken aktiv in outlet und apo_masterdata an. Neue Ids werden vorab aus der
+            Sequenz outlet_id_seq vergeben, damit beide Tabellen mit je einem INSERT befüllt
+            werden können. Nicht vorhandene Apotheken mit fehlerhaften Daten (is_valid) werden
+            nicht angelegt.
+
+            @return tuple   - Anzahl der neu angelegten und der abgewiesenen Apotheken
+            @throws Exception
+        """
+        assignIds = u"""UPDATE {table} s SET outlet_id = am.id
+            FROM apo_masterdata am WHERE am.byr_salesforce_id = s.byr_salesforce_id"""
+        assignNewIds = u"""UPDATE {table} SET outlet_id = nextval('{sequence}'), is_new = true
+            WHERE outlet_id IS NULL AND is_valid"""
+        insertOutlets = u"""INSERT INTO outlet (id, name, strasse, plz, ort, bundesland, email, telefon1, outletart, aktiv)
+            SELECT s.outlet_id, s.name, s.strasse, s.plz, s.ort, b.code, s.email, s.telefon1, 'apotheke', true
+            FROM {table} s LEFT JOIN bundeslaender b ON b.name = s.bundesland
+            WHERE s.is_new"""
+        insertMasterdata = u"""INSERT INTO apo_masterdata (id, byr_sap_id, byr_salesforce_id, byr_name, byr_status,
+                byr_shelf_details, byr_contact_c, byr_is_deleted, byr_active,
+                byr_shopper_termination, byr_shopper_termination_reason)
+            SELECT s.outlet_id, s.byr_sap_id, s.byr_salesforce_id, s.byr_name, s.byr_status,
+                s.byr_shelf_details, s.byr_contact_c, s.byr_is_deleted, s.byr_active,
+                s.byr_shopper_termination, s.byr_shopper_termination_reason
+            FROM {table} s WHERE s.is_new"""
+
+        params = { u'table': self.STAGING_TABLE, u'sequence': self.OUTLET_SEQUENCE }
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'reconcileStagingTable', assignIds . format(**params))
+            self.__execute(cur, u'reconcileStagingTable', assignNewIds . format(**params))
+            self.__execute(cur, u'reconcileStagingTable', insertOutlets . format(**params))
+            created = cur.rowcount
+            self.__execute(cur, u'reconcileStagingTable', insertMasterdata . format(**params))
+            self.__execute(cur, u'reconcileStagingTable',
+                    u"""SELECT count(*) FROM {table} WHERE outlet_id IS NULL""" . format(**params))
+            rejected = cur.fetchone()[0]
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return created, rejected
+
+
+    def applyStagingActivationDiff(self):
+        u"""
+            OrderedDict applyStagingActivationDiff()
+
+            Gleicht den Status 'aktiv' aller Apotheken mit den markierten Apotheken der
+            Staging-Tabelle ab. Geschrieben werden nur Outlets, deren Status sich tatsächlich
+            ändert: markierte Apotheken, die inaktiv sind, werden aktiviert, aktive Apotheken,
+            die nicht markiert sind, werden deaktiviert. Abgewiesene Datensätze haben keine
+            Outlet-Id und gehören nicht dazu.
+
+            @return OrderedDict     - Anzahl der aktivierten, deaktivierten und unveränderten Apotheken
+            @throws Exception
+        """
+        return self.__activationDiff(u"""SELECT outlet_id AS id FROM {table} WHERE outlet_id IS NOT NULL""" .
+                format(table=self.STAGING_TABLE), {})
+
+
+    def createPlan(self, seedDigests=False):
+        u"""
+            SyncPlan createPlan(seedDigests)
+
+            Erstellt einen leeren Änderungsplan auf Basis eines Abbilds der SWDB. Dafür werden
+            die Indizes geladen und der Status aller Apotheken sowie die Prüfsummen der zuletzt
+            übernommenen Stammdaten (DIGEST_TABLE) mit je einer Abfrage gelesen. Die
+            Lesetransaktion wird anschließend beendet, es bleiben keine Sperren bestehen.
+
+            @param seedDigests  - fehlende Prüfsummen vorhandener Apotheken nur speichern,
+                                  statt die Apotheken zu aktualisieren, siehe SyncPlan
+            @return SyncPlan
+            @throws SWDBError   - DIGEST_TABLE existiert nicht
+            @throws Exception
+        """
+        self.loadIndexes()
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'createPlan', self.OUTLET_STATUS_QUERY)
+            outletStatus = dict(cur.fetchall())
+            if not self.digestTableExists():
+                raise SWDBError(u"table {0} does not exist, create it with --check-schema --create-indexes" .
+                        format(self.DIGEST_TABLE))
+            self.__execute(cur, u'createPlan', u"""SELECT outlet_id, digest FROM {table}""" .
+                    format(table=self.DIGEST_TABLE))
+            digests = dict(cur.fetchall())
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+            self.__postgresql.rollback()
+
+        return SyncPlan(dict(self.__outletIds), outletStatus, digests, seedDigests=seedDigests)
+
+
+    def digestTableExists(self):
+        u"""True, wenn DIGEST_TABLE im aktuellen Schema existiert"""
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'digestTableExists', u"""SELECT to_regclass(%(table)s) IS NOT NULL""",
+                    { u'table': self.DIGEST_TABLE })
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+
+    def applyPlan(self, plan, batchSize=APPLY_BATCH_SIZE):
+        u"""
+            OrderedDict applyPlan(plan, batchSize)
+
+            Führt einen Änderungsplan aus: legt die neuen Apotheken an, aktualisiert die
+            Stammdaten der geänderten und schaltet den Status der geplanten Outlets um. Die
+            Updates des Status prüfen den aktuellen Wert, Outlets, die seit der Planung bereits
+            umgeschaltet wurden, werden nicht erneut geschrieben. Die Transaktion wird nicht
+            abgeschlossen.
+
+            Angelegt und aktualisiert wird blockweise, jeder Block unter einem Savepoint.
+            Schlägt ein Block fehl, wird er zurückgerollt und Datensatz für Datensatz wiederholt.
+            Datensätze, die auch einzeln fehlschlagen, werden mit SyncPlan.fail() vermerkt, die
+            übrigen bleiben in der Transaktion. Zuletzt werden die Prüfsummen der Apotheken
+            gespeichert, die der Plan nur übernehmen soll (SyncPlan.seeds).
+
+            @param plan         - SyncPlan, siehe createPlan()
+            @param batchSize    - Anzahl der Apotheken je Savepoint
+            @return OrderedDict - Anzahl der angelegten, abgewiesenen, fehlgeschlagenen,
+                                  aktualisierten, aktivierten, deaktivierten und unveränderten
+                                  Apotheken
+            @throws Exception
+        """
+        result = plan.summary()
+        pharmacies = [(None, record) for record in plan.creates] + plan.updates
+        for start in xrange(0, len(pharmacies), batchSize):
+            batch = pharmacies[start:start + batchSize]
+            try:
+                self.__applyBatch(batch)
+            except Exception as msg:
+                if len(batch) == 1:
+                    plan.fail(batch[0][1], msg)
+                    continue
+                self.__app.logger.warning(u"batch of {0:d} records failed, retrying one by one: {1}" .
+                        format(len(batch), msg))
+                for entry in batch:
+                    try:
+                        self.__applyBatch([entry])
+                    except Exception as msg:
+                        plan.fail(entry[1], msg)
+
+        for record in plan.failed:
+            self.__app.logger.error(u"{0}: {1}" . format(record.Shopper_Contract__c, record.error))
+        failed = set(id(record) for record in plan.failed)
+        result[u'failed'] = len(failed)
+        result[u'created'] = sum(1 for record in plan.creates if id(record) not in failed)
+        result[u'updated'] = sum(1 for outletId, record in plan.updates if id(record) not in failed)
+
+        result[u'activated'] = self.setOutletsStatus(plan.activate, True)
+        result[u'deactivated'] = self.setOutletsStatus(plan.deactivate, False)
+        self.storeDigests(plan.seeds)
+
+        return result
+
+
+    def __applyBatch(self, batch):
+        u"""
+            Legt die Apotheken eines Blocks unter einem Savepoint an bzw. aktualisiert sie. Bei
+            einem Fehler wird auf den Savepoint zurückgerollt und die Exception weitergegeben.
+
+            @param batch    - Liste von (Outlet-Id, PharmacyRecord), Outlet-Id None für neue Apotheken
+        """
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'applyPlan', u"SAVEPOINT apply_batch")
+            try:
+                for outletId, record in batch:
+                    if outletId is None:
+                        self.insertApoMasterdata(record, self.insertOutlet(record))
+                self.updatePharmacies([entry for entry in batch if entry[0] is not None])
+                self.storeDigests([(outletId if outletId is not None else record[u'id'], record)
+                        for outletId, record in batch])
+            except Exception:
+                self.__execute(cur, u'applyPlan', u"ROLLBACK TO SAVEPOINT apply_batch")
+                for outletId, record in batch:
+                    if outletId is None:
+                        record[u'id'] = None
+                        self.__outletIds.pop(record.Shopper_Contract__c, None)
+                raise
+            self.__execute(cur, u'applyPlan', u"RELEASE SAVEPOINT apply_batch")
+        finally:
+            cur.close()
+
+
+    def updatePharmacies(self, updates):
+        u"""
+            void updatePharmacies(updates)
+
+            Übernimmt die Felder aus Salesforce in outlet und apo_masterdata. Die Statements
+            werden blockweise gesendet, die Anzahl der Roundtrips hängt nur von der Anzahl
+            der geänderten Apotheken ab.
+
+            @param updates  - Liste von (Outlet-Id, PharmacyRecord)
+            @throws Exception
+        """
+        if not updates:
+            return
+
+        outlets, masterdata = [], []
+        for id, record in updates:
+            params = record.outletParams()
+            params.update({ u'id': id, u'bundesland': self.__bundeslaender.get(record.country) })
+            outlets.append(params)
+            params = record.masterdataParams()
+            params[u'id'] = id
+            masterdata.append(params)
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__executeBatch(cur, u'updatePharmacies', self.UPDATE_OUTLET_QUERY, outlets)
+            self.__executeBatch(cur, u'updatePharmacies', self.UPDATE_MASTERDATA_QUERY, masterdata)
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+
+    def storeDigests(self, pharmacies):
+        u"""
+            void storeDigests(pharmacies)
+
+            Speichert die Prüfsummen der übernommenen Felder in DIGEST_TABLE.
+
+            @param pharmacies   - Liste von (Outlet-Id, PharmacyRecord)
+            @throws Exception
+        """
+        if not pharmacies:
+            return
+
+        query = u"""INSERT INTO {table} (outlet_id, digest, synced) VALUES (%(id)s, %(digest)s, now())
+            ON CONFLICT (outlet_id) DO UPDATE SET digest = EXCLUDED.digest, synced = EXCLUDED.synced""" . format(
+                table=self.DIGEST_TABLE)
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__executeBatch(cur, u'storeDigests', query,
+                    [{ u'id': id, u'digest': record.digest() } for id, record in pharmacies])
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+
+    def setOutletsStatus(self, outletIds, active):
+        u"""
+            integer setOutletsStatus(outletIds, active)
+
+            Setzt den Status 'aktiv' mehrerer Outlets mit einem Statement. Geschrieben werden
+            nur Outlets, deren Status abweicht.
+
+            @param outletIds    - Outlet-Ids
+            @param active       - Status
+            @return integer     - Anzahl der geänderten Outlets
+            @throws Exception
+        """
+        if not outletIds:
+            return 0
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'setOutletsStatus', self.SET_OUTLETS_STATUS_QUERY,
+                    { u'ids': list(outletIds), u'active': active })
+            res = cur.rowcount
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
         return res
 
 
+    def activateOutlets(self, salesforceIds):
+        u"""
+            tuple activateOutlets(salesforceIds)
+
+            Erster Teil des Status-Abgleichs für den parallelen Abgleich: aktiviert nur
+            die inaktiven Apotheken aus der Liste. Setzt geladene Indizes voraus.
+
+            @param salesforceIds    - Salesforce-Ids der markierten Apotheken
+            @return tuple           - Anzahl der aktivierten Apotheken und Outlet-Ids aller markierten
+            @throws Exception
+        """
+        outletIds = [self.__outletIds[id] for id in salesforceIds if id in self.__outletIds]
+        query = u"""UPDATE outlet SET aktiv = true
+            WHERE aktiv IS NOT TRUE AND id = ANY(%(ids)s::integer[])"""
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'activateOutlets', query, { u'ids': outletIds })
+            activated = cur.rowcount
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return activated, outletIds
+
+
+    def deactivateOutlets(self, outletIds, shard=0, shards=1):
+        u"""
+            integer deactivateOutlets(outletIds, shard, shards)
+
+            Zweiter Teil des Status-Abgleichs für den parallelen Abgleich: deaktiviert
+            die aktiven Apotheken, die nicht in outletIds stehen. Berücksichtigt werden nur
+            Outlets mit id % shards = shard, damit sich die Shards nicht gegenseitig sperren.
+
+            @param outletIds    - Outlet-Ids aller markierten Apotheken
+            @param shard        - Nummer des Shards, beginnend mit 0
+            @param shards       - Anzahl der Shards
+            @return integer     - Anzahl der deaktivierten Apotheken
+            @throws Exception
+        """
+        query = u"""UPDATE outlet SET aktiv = false
+            WHERE aktiv AND (id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke')
+                AND id %% %(shards)s = %(shard)s
+                AND id NOT IN (SELECT unnest(%(ids)s::integer[]))"""
+
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'deactivateOutlets', query,
+                    { u'ids': list(outletIds), u'shard': shard, u'shards': shards })
+            deactivated = cur.rowcount
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return deactivated
+
+
+    def countPharmacyOutlets(self):
+        u"""
+            integer countPharmacyOutlets()
+
+            Anzahl der Outlets, die am Abgleich des Status teilnehmen.
+
+            @return integer
+        """
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'countPharmacyOutlets', u"""SELECT count(*) FROM outlet
+                WHERE id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke'""")
+            total = cur.fetchone()[0]
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return total
+
+
+    def __activationDiff(self, marked, params):
+        u"""
+            Führt den Abgleich des Status mit einem einzigen Statement aus. 'marked' ist eine
+            Abfrage, die die Outlet-Ids der markierten Apotheken liefert. Die Deaktivierung
+            prüft mit NOT EXISTS, ein NULL in 'marked' kann sie daher nicht aushebeln. Die
+            abschließende Zählung sieht den Stand vor den Updates, daraus ergibt sich die Zahl
+            der unveränderten Apotheken.
+        """
+        query = u"""WITH marked AS ({marked}),
+                activated AS (
+                    UPDATE outlet SET aktiv = true
+                    WHERE aktiv IS NOT TRUE AND id IN (SELECT id FROM marked)
+                    RETURNING id),
+                deactivated AS (
+                    UPDATE outlet SET aktiv = false
+                    WHERE aktiv AND (id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke')
+                        AND NOT EXISTS (SELECT 1 FROM marked m WHERE m.id = outlet.id)
+                    RETURNING id)
+            SELECT (SELECT count(*) FROM activated) AS activated,
+                (SELECT count(*) FROM deactivated) AS deactivated,
+                (SELECT count(*) FROM outlet
+                    WHERE id IN (SELECT id FROM apo_masterdata) OR outletart = 'apotheke') AS total""" . format(marked=marked)
+
+        cur = self.__postgresql.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            self.__execute(cur, u'activationDiff', query, params)
+            row = cur.fetchone()
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        return collections.OrderedDict([(u'activated', row['activated']), (u'deactivated', row['deactivated']),
+                (u'unchanged', row['total'] - row['activated'] - row['deactivated'])])
+
+
+    def __activePharmaciesQuery(self, export=False):
+        u"""Abfrage der aktiven Apotheken für Ausgabe bzw. Export, aus der Sicht oder den Tabellen"""
+        if self.__useView:
+            return self.ACTIVE_PHARMACIES_VIEW_EXPORT_QUERY if export else self.ACTIVE_PHARMACIES_VIEW_QUERY
+
+        return self.ACTIVE_PHARMACIES_EXPORT_QUERY if export else self.ACTIVE_PHARMACIES_QUERY
+
+
+    def explain(self, query, params=None):
+        u"""
+            dict explain(query, params)
+
+            Liefert den Ausführungsplan einer Abfrage (EXPLAIN, FORMAT JSON). Die Abfrage
+            wird nicht ausgeführt, auch UPDATE-Statements können daher geprüft werden.
+
+            @param query    - Abfrage
+            @param params   - Parameter der Abfrage
+            @return dict    - oberster Knoten des Plans
+            @throws Exception
+        """
+        cur = self.__postgresql.cursor()
+        try:
+            self.__execute(cur, u'explain', u"EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()[0]
+        except Exception as msg:
+            self.__app.logger.error(msg)
+            raise
+        finally:
+            cur.close()
+
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        return plan[0][u'Plan']
+
+
+    def __execute(self, cur, operation, query, params=None):
+        u"""
+            Führt query auf cur aus und erfasst Dauer, Anzahl der Statements und betroffene
+            Zeilen in den Kennzahlen des Laufs (app.metrics), sofern vorhanden. Die Dauer wird
+            zusätzlich je Abfragetext erfasst, siehe RunMetrics.statements().
+
+            Bei einem serverseitigen Cursor führt execute() nur DECLARE aus, die Zeilen werden
+            erst beim Iterieren geholt. Dauer und Zeilen wären daher zu niedrig, die Abfrage wird
+            nicht je Abfragetext erfasst. Soll sie erfasst werden, __iterate() verwenden.
+        """
+        metrics = getattr(self.__app, 'metrics', None)
+        start = time.time()
+        try:
+            cur.execute(query, params)
+        finally:
+            if metrics:
+                elapsed = time.time() - start
+                metrics.addTime(u'sql_' + operation, elapsed)
+                metrics.count(u'sql_statements')
+                if cur.name is None:
+                    metrics.addStatement(query, elapsed)
+                    metrics.count(u'sql_rows', max(cur.rowcount, 0))
+
+
+    def __iterate(self, cur, operation, query, params=None):
+        u"""
+            Generator wie __execute() für serverseitige Cursor, liefert die Zeilen von cur
+
+            Erfasst werden DECLARE und alle Fetches, nicht die Zeit, die der Aufrufer für die
+            einzelnen Zeilen braucht. Die Kennzahlen werden geschrieben, wenn die Iteration
+            endet oder abgebrochen wird.
+        """
+        metrics = getattr(self.__app, 'metrics', None)
+        elapsed, rows = 0.0, 0
+        start = time.time()
+        try:
+            cur.execute(query, params)
+            for row in cur:
+                elapsed += time.time() - start
+                rows += 1
+                yield row
+                start = time.time()
+            elapsed += time.time() - start
+        finally:
+            if metrics:
+                metrics.addTime(u'sql_' + operation, elapsed)
+                metrics.addStatement(query, elapsed)
+                metrics.count(u'sql_statements')
+                metrics.count(u'sql_rows', rows)
+
+
+    def __executeBatch(self, cur, operation, query, argslist, pageSize=100):
+        u"""Wie __execute(), jedoch für viele Parametersätze über execute_batch()"""
+        metrics = getattr(self.__app, 'metrics', None)
+        start = time.time()
+        try:
+            psycopg2.extras.execute_batch(cur, query, argslist, page_size=pageSize)
+        finally:
+            if metrics:
+                elapsed = time.time() - start
+                metrics.addTime(u'sql_' + operation, elapsed)
+                metrics.addStatement(query, elapsed)
+                metrics.count(u'sql_statements', (len(argslist) + pageSize - 1) // pageSize)
+                metrics.count(u'sql_rows', len(argslist))
+
+
+    def __copy(self, cur, operation, query, fileobj):
+        u"""Wie __execute(), jedoch für COPY über copy_expert()"""
+        metrics = getattr(self.__app, 'metrics', None)
+        start = time.time()
+        try:
+            cur.copy_expert(query, fileobj)
+        finally:
+            if metrics:
+                elapsed = time.time() - start
+                metrics.addTime(u'sql_' + operation, elapsed)
+                metrics.addStatement(query, elapsed)
+                metrics.count(u'sql_statements')
+                metrics.count(u'sql_rows', max(cur.rowcount, 0))
+
+
+    def __copyValue(self, value):
+        u"""Formatiert einen Wert für das Textformat von COPY"""
+        if value is None:
+            return u'\\N'
+        elif isinstance(value, bool):
+            return u't' if value else u'f'
+        elif not isinstance(value, unicode):
+            value = unicode(value) if not isinstance(value, str) else value.decode('utf-8')
+
+        return u''.join(self.__copyEscapes.get(char, char) for char in value)
+
+
 if __name__ == '__main__':
     sys.exit("This module is not for execution.")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Daemon-Modus für den Abgleich.
+
+Hält die Salesforce-Session und die Verbindung zur SWDB über mehrere Läufe hinweg offen
+und führt den Abgleich für das aktuelle Datum in einem festen Intervall aus. Zusätzlich
+kann ein Lauf über einen Unix-Socket oder das Signal SIGUSR1 sofort angestoßen werden.
+
+Protokoll des Sockets (eine Zeile pro Verbindung):
+
+    sync [TOURDATUM|ZEITRAUM ...]   Abgleich sofort ausführen, Default: aktuelles Datum
+    stop                            Daemon beenden
+
+Die Antwort ist eine Zeile, die mit 'ok' oder 'error' beginnt.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, datetime, errno, select, signal, socket
+
+import psycopg2
+
+from simple_salesforce import SalesforceExpiredSession
+
+class SyncDaemon(object):
+
+    """const"""
+    INTERVAL = 15
+
+    """private"""
+    __app, __socketPath, __interval, __socket = (None,)*4
+    __triggered, __stopped = (False,)*2
+
+    def __init__(self, app):
+        if not hasattr(app, 'dispatch'):
+            raise AttributeError(u'Object \'app\' has no attribute \'dispatch\'')
+
+        self.__app = app
+        config = app.config
+        self.__interval = 60 * (config.getint('daemon', 'interval') \
+                if config.has_option('daemon', 'interval') else self.INTERVAL)
+        self.__socketPath = config.get('daemon', 'socket') \
+                if config.has_option('daemon', 'socket') else app.APPNAME + '.sock'
+
+        u"""Jeder Lauf soll aktuelle Daten sehen, Snapshots werden nur geschrieben"""
+        app.options.refresh = True
+
+
+    def run(self):
+        u"""
+            void run()
+
+            Hauptschleife des Daemons. Läuft, bis SIGTERM/SIGINT empfangen oder über den
+            Socket 'stop' gesendet wurde.
+        """
+        self.__openSocket()
+        signal.signal(signal.SIGUSR1, self.__onTrigger)
+        signal.signal(signal.SIGTERM, self.__onStop)
+        signal.signal(signal.SIGINT, self.__onStop)
+
+        self.__app.logger.info(u"daemon started, interval {0}s, socket {1}" . format(self.__interval, self.__socketPath))
+        nextRun = time.time()
+        try:
+            while not self.__stopped:
+                if self.__triggered or time.time() >= nextRun:
+                    self.__triggered = False
+                    self.runSync()
+                    nextRun = time.time() + self.__interval
+                    continue
+
+                try:
+                    readable, void, void = select.select([self.__socket], [], [], max(0, nextRun - time.time()))
+                except select.error as msg:
+                    if msg.args[0] != errno.EINTR:
+                        raise
+                    continue
+
+                if readable:
+                    self.__handleClient()
+        finally:
+            self.__closeSocket()
+            self.__app.logger.info(u"daemon stopped")
+
+
+    def runSync(self, tourDates=None):
+        u"""
+            boolean runSync(tourDates)
+
+            Führt einen Abgleich aus. Vorher werden die Verbindungen geprüft und bei Bedarf neu
+            aufgebaut. Ist die Salesforce-Session abgelaufen, wird neu angemeldet und der
+            Abgleich einmal wiederholt. Fehler, z.B. eine nicht erreichbare SWDB, beenden den
+            Daemon nicht: der Lauf gilt als fehlgeschlagen und wird im nächsten Intervall
+            erneut versucht.
+
+            @param tourDates    - Liste der Tourdaten (TT.MM.JJJJ), Default: aktuelles Datum
+            @return boolean
+        """
+        self.__app.tourDates = tourDates or [datetime.date.today().strftime('%d.%m.%Y')]
+        try:
+            self.ensureConnections()
+
+            success = self.__app.dispatch()
+            if not success and isinstance(self.__app.lastError, SalesforceExpiredSession):
+                self.__app.refreshSalesforce(self.__app.salesforce)
+                success = self.__app.dispatch()
+        except Exception as msg:
+            self.__app.lastError = msg
+            self.__app.logger.error(u"sync failed, retrying in {0}s: {1!r}" . format(self.__interval, msg))
+            self.__app.metrics.count(u'daemon_errors')
+            self.__app.writeMetrics(False)
+            success = False
+
+        return success
+
+
+    def ensureConnections(self):
+        u"""
+            void ensureConnections()
+
+            Prüft die Verbindung zur SWDB und baut sie neu auf, falls sie geschlossen wurde
+            oder nicht mehr antwortet.
+        """
+        postgresql = self.__app.postgresql
+        try:
+            if postgresql.closed:
+                raise psycopg2.InterfaceError(u"connection already closed")
+            cur = postgresql.cursor()
+            cur.execute(u"SELECT 1")
+            cur.close()
+            postgresql.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as msg:
+            self.__app.logger.warning(u"postgresql connection lost ({0}) -> reconnect" . format(msg))
+            self.__app.initPostgresql()
+
+
+    def __handleClient(self):
+        conn, void = self.__socket.accept()
+        try:
+            command = conn.makefile('rb').readline().decode('utf-8').split()
+            if not command:
+                reply = u"error empty command"
+            elif command[0] == u'stop':
+                self.__stopped = True
+                reply = u"ok stopping"
+            elif command[0] == u'sync':
+                try:
+                    tourDates = self.__app.parseTourDates(command[1:])
+                except ValueError as msg:
+                    reply = u"error {0}" . format(msg)
+                else:
+                    reply = u"ok" if self.runSync(tourDates) else u"error {0!r}" . format(self.__app.lastError)
+            else:
+                reply = u"error unknown command '{0}'" . format(command[0])
+
+            conn.sendall((reply + u"\n").encode('utf-8'))
+        except socket.error as msg:
+            self.__app.logger.warning(u"socket client failed: {0}" . format(msg))
+        finally:
+            conn.close()
+
+
+    def __openSocket(self):
+        if os.path.exists(self.__socketPath):
+            os.remove(self.__socketPath)
+
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.bind(self.__socketPath)
+        os.chmod(self.__socketPath, 0o600)
+        self.__socket.listen(5)
+
+
+    def __closeSocket(self):
+        self.__socket.close()
+        if os.path.exists(self.__socketPath):
+            os.remove(self.__socketPath)
+
+
+    def __onTrigger(self, signum, frame):
+        self.__triggered = True
+
+
+    def __onStop(self, signum, frame):
+        self.__stopped = True
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
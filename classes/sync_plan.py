@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Änderungsplan eines Abgleichs.
+
+Der Plan wird ohne Schreibzugriff aus den Datensätzen von Salesforce und einem Abbild der
+SWDB (Salesforce-Id -> Outlet-Id, Status 'aktiv' der Apotheken, Prüfsummen der zuletzt
+übernommenen Stammdaten) berechnet und enthält alle Änderungen: neu anzulegende,
+abgewiesene, zu aktualisierende, zu aktivierende und zu deaktivierende Apotheken.
+SWDB.applyPlan() führt ihn anschließend in einer kurzen Transaktion aus und vermerkt
+Datensätze, die dabei fehlschlagen, im Plan. Der Plan kann ausgegeben oder als JSON
+gespeichert werden.
+"""
+
+from __future__ import print_function
+
+import os, sys, time, json, codecs, tempfile, collections
+
+class SyncPlan(object):
+
+    """private"""
+    __outletIds, __outletStatus, __marked, __creates, __rejects, __activate, __deactivate = (None,)*7
+    __digests, __updates, __failed, __created, __seedDigests, __seeds = (None,)*6
+
+    def __init__(self, outletIds, outletStatus, digests=None, seedDigests=False):
+        u"""
+            @param outletIds    - dict Salesforce-Id -> Outlet-Id, siehe SWDB.loadIndexes()
+            @param outletStatus - dict Outlet-Id -> aktiv
+            @param digests      - dict Outlet-Id -> Prüfsumme der zuletzt übernommenen Stammdaten,
+                                  None, wenn vorhandene Apotheken nicht aktualisiert werden sollen
+            @param seedDigests  - vorhandene Apotheken ohne gespeicherte Prüfsumme gelten als
+                                  aktuell, nur ihre Prüfsumme wird übernommen (seeds)
+        """
+        self.__outletIds = outletIds
+        self.__outletStatus = outletStatus
+        self.__digests = digests
+        self.__seedDigests = seedDigests
+        self.__seeds = collections.OrderedDict()
+        self.__marked = set()
+        self.__creates = collections.OrderedDict()
+        self.__rejects = collections.OrderedDict()
+        self.__updates = collections.OrderedDict()
+        self.__failed = []
+        self.__created = time.time()
+
+
+    def add(self, record):
+        u"""
+            void add(record)
+
+            Nimmt einen Datensatz aus Salesforce in den Plan auf. Mehrfach vorkommende
+            Salesforce-Ids werden nur einmal berücksichtigt. Vorhandene Apotheken werden zur
+            Aktualisierung vorgemerkt, wenn die Prüfsumme ihrer Felder abweicht. Fehlt die
+            Prüfsumme und sollen Prüfsummen übernommen werden, wird nur diese vorgemerkt.
+
+            @param record   - Datensatz als PharmacyRecord
+        """
+        salesforceId = record.Shopper_Contract__c
+        outletId = self.__outletIds.get(salesforceId)
+        if outletId is not None:
+            if outletId in self.__marked:
+                return
+            self.__marked.add(outletId)
+            if self.__digests is not None and record.valid:
+                digest = self.__digests.get(outletId)
+                if digest is None and self.__seedDigests:
+                    self.__seeds[outletId] = record
+                elif digest != record.digest():
+                    self.__updates[outletId] = record
+        elif salesforceId in self.__creates or salesforceId in self.__rejects:
+            pass
+        elif record.valid:
+            self.__creates[salesforceId] = record
+        else:
+            self.__rejects[salesforceId] = record
+
+
+    def finish(self, partial=False):
+        u"""
+            void finish(partial)
+
+            Berechnet die Statusänderungen, nachdem alle Datensätze aufgenommen wurden.
+
+            @param partial  - die Datensätze sind nur ein Teil der markierten Apotheken, z.B. die
+                              Quarantäne bei --resume. Es wird nichts deaktiviert.
+        """
+        self.__activate = sorted(id for id in self.__marked if not self.__outletStatus.get(id))
+        self.__deactivate = [] if partial else \
+                sorted(id for id, active in self.__outletStatus.items() if active and id not in self.__marked)
+
+
+    def fail(self, record, error):
+        u"""
+            void fail(record, error)
+
+            Vermerkt einen Datensatz, dessen Anlage oder Aktualisierung in SWDB.applyPlan()
+            fehlgeschlagen ist.
+
+            @param record   - Datensatz als PharmacyRecord
+            @param error    - Exception oder Fehlermeldung
+        """
+        record.error = unicode(error).strip()
+        self.__failed.append(record)
+
+
+    @property
+    def creates(self):
+        u"""Neu anzulegende Apotheken als Liste von PharmacyRecord"""
+        return self.__creates.values()
+
+    @property
+    def rejects(self):
+        u"""Nicht vorhandene Apotheken mit fehlerhaften Daten als Liste von PharmacyRecord"""
+        return self.__rejects.values()
+
+    @property
+    def updates(self):
+        u"""Zu aktualisierende Apotheken als Liste von (Outlet-Id, PharmacyRecord)"""
+        return self.__updates.items()
+
+    @property
+    def seeds(self):
+        u"""Vorhandene Apotheken, deren Prüfsumme nur übernommen wird, als Liste von (Outlet-Id, PharmacyRecord)"""
+        return self.__seeds.items()
+
+    @property
+    def failed(self):
+        u"""Bei der Ausführung fehlgeschlagene Apotheken als Liste von PharmacyRecord"""
+        return list(self.__failed)
+
+    @property
+    def activate(self):
+        u"""Outlet-Ids der zu aktivierenden Apotheken"""
+        return self.__activate
+
+    @property
+    def deactivate(self):
+        u"""Outlet-Ids der zu deaktivierenden Apotheken"""
+        return self.__deactivate
+
+
+    def summary(self):
+        u"""
+            OrderedDict summary()
+
+            @return OrderedDict - Anzahl der neu anzulegenden, abgewiesenen, fehlgeschlagenen,
+                                  zu aktualisierenden, zu aktivierenden, zu deaktivierenden und
+                                  im Status unveränderten Apotheken
+        """
+        return collections.OrderedDict([(u'created', len(self.__creates)), (u'rejected', len(self.__rejects)),
+                (u'failed', len(self.__failed)),
+                (u'updated', len(self.__updates)), (u'activated', len(self.__activate)),
+                (u'deactivated', len(self.__deactivate)),
+                (u'unchanged', len(self.__outletStatus) - len(self.__activate) - len(self.__deactivate))])
+
+
+    def toDict(self):
+        u"""Liefert den Plan als OrderedDict, z.B. für JSON"""
+        return collections.OrderedDict([
+            (u'created', self.__created),
+            (u'summary', self.summary()),
+            (u'create', [record.toDict() for record in self.creates]),
+            (u'reject', [collections.OrderedDict([(u'Shopper_Contract__c', record.Shopper_Contract__c),
+                    (u'error', record.error)]) for record in self.rejects]),
+            (u'update', collections.OrderedDict((unicode(id), record.toDict()) for id, record in self.updates)),
+            (u'activate', self.__activate),
+            (u'deactivate', self.__deactivate),
+        ])
+
+
+    def save(self, path):
+        u"""
+            void save(path)
+
+            Speichert den Plan als JSON. Die Datei wird unter einem temporären Namen
+            geschrieben und umbenannt.
+
+            @param path     - Dateiname
+            @throws IOError
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                json.dump(self.toDict(), fp, indent=2)
+            os.rename(tmpPath, path)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+
+    def render(self, stream=None):
+        u"""
+            void render(stream)
+
+            Gibt den Plan zeilenweise aus, eine Zeile pro Änderung.
+
+            @param stream   - Ausgabe, Default: stdout
+        """
+        stream = stream or codecs.getwriter('utf-8')(sys.stdout)
+        lines = [u"\n\nÄnderungsplan\n"]
+        for record in self.creates:
+            lines.append(u"create     {0} {1} {2} {3}\n" . format(record.Shopper_Contract__c, record.pharmacy or u'',
+                    record.plz or u'', record.ort or u''))
+        for record in self.rejects:
+            lines.append(u"reject     {0} {1}\n" . format(record.Shopper_Contract__c, record.error))
+        for id, record in self.updates:
+            lines.append(u"update     {0:d} {1} {2}\n" . format(id, record.Shopper_Contract__c, record.pharmacy or u''))
+        lines.extend(u"activate   {0:d}\n" . format(id) for id in self.__activate)
+        lines.extend(u"deactivate {0:d}\n" . format(id) for id in self.__deactivate)
+        lines.append(u", " . join(u"{0}: {1:d}" . format(key, value) for key, value in self.summary().items()))
+        lines.append(u"\n")
+        stream.write(u'' . join(lines))
+        stream.flush()
+
+
+if __name__ == '__main__':
+    sys.exit("This module is not for execution")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+BulkQuery gegen einen lokalen HTTP-Stub der Bulk API 2.0 (jobs/query).
+
+Der Stub legt Jobs an, meldet InProgress und danach JobComplete, Failed oder Aborted und
+liefert das Ergebnis in CSV-Blöcken mit einer Kette von Sforce-Locator-Headern. Die Aufrufe
+laufen über eine echte requests.Session, ein Adapter leitet https://stub.test auf den Stub
+um. Benötigt requests und unicodecsv, sonst werden die Tests übersprungen.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, json, gzip, time, logging, threading, unittest, urlparse, collections, StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from ConfigParser import SafeConfigParser
+
+try:
+    import requests, unicodecsv
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+from bulk_query import BulkQuery, BulkQueryError
+from get_inspections import GetInspections
+from pharmacy_record import PharmacyRecord
+from run_metrics import RunMetrics
+
+INSTANCE = u'stub.test'
+JOB_ID = u'750000000000001'
+COLUMNS = [u'Shopper_Contract__c', u'Id', u'Name', u'Shopper_Contract__r.Account_Information__c',
+        u'Shopper_Contract__r.Status__c', u'Shopper_Contract__r.Shelf_Details__c', u'Shopper_Contract__r.IsDeleted',
+        u'Shopper_Contract__r.Active__c']
+ACCOUNT_INFORMATION = u"Apotheke am Markt<br>0012345<br>Marktplatz 1<br>80331 München<br>DE Bayern<br><br>" \
+        u"E-Mail: info@example.com<br>Telefon: 089 123456"
+
+
+def csvChunk(rows):
+    u"""CSV-Block wie von /results: Kopfzeile, Werte in Anführungszeichen, Zeilenende LF"""
+    quote = lambda value: u'"{0}"' . format(value.replace(u'"', u'""'))
+    lines = [u',' . join(quote(column) for column in COLUMNS)]
+    lines += [u',' . join(quote(value) for value in row) for row in rows]
+    return (u'\n' . join(lines) + u'\n').encode('utf-8')
+
+
+CHUNKS = [
+    csvChunk([[u'a0B000000000001', u'a0C000000000001', u'SI-000001', ACCOUNT_INFORMATION, u'Active', u'',
+            u'false', u'true']]),
+    csvChunk([[u'a0B000000000002', u'a0C000000000002', u'SI-000002', u'Apotheke ohne Adresse<br>0012346',
+            u'Active', u'Regal "links"', u'false', u'false']]),
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    u"""
+    Bulk API 2.0: POST jobs/query, GET jobs/query/<id>, GET jobs/query/<id>/results.
+
+    Für Pfade in server.script werden stattdessen nacheinander die dort hinterlegten
+    Antworten geliefert: dict mit status, body und optional headers, gzip und delay.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        self.server.requests.append((u'POST', self.path, body))
+        if self.__scripted():
+            return
+        if self.__authorized() and self.path.endswith(u'/jobs/query'):
+            self.__reply(200, { u'id': JOB_ID, u'state': u'UploadComplete', u'operation': body[u'operation'] })
+
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append((u'GET', url.path, params))
+        if self.__scripted() or not self.__authorized():
+            return
+
+        if url.path.endswith(u'/jobs/query/' + JOB_ID):
+            state = self.server.states.pop(0) if len(self.server.states) > 1 else self.server.states[0]
+            self.__reply(200, { u'id': JOB_ID, u'state': state,
+                    u'errorMessage': u'stub says {0}' . format(state) if state in (u'Failed', u'Aborted') else None })
+        elif url.path.endswith(u'/jobs/query/{0}/results' . format(JOB_ID)):
+            index = int(params.get(u'locator', 0))
+            locator = str(index + 1) if index + 1 < len(CHUNKS) else 'null'
+            self.__reply(200, CHUNKS[index], contentType='text/csv', headers={ 'Sforce-Locator': locator })
+        else:
+            self.__reply(404, [{ u'errorCode': u'NOT_FOUND' }])
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def __scripted(self):
+        path = urlparse.urlparse(self.path).path
+        if path not in self.server.script:
+            return False
+
+        self.server.headers.append(dict(self.headers.items()))
+        responses = self.server.script[path]
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        time.sleep(response.get('delay', 0))
+        data = json.dumps(response['body'])
+        headers = dict(response.get('headers', {}))
+        if response.get('gzip'):
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+                fp.write(data)
+            data = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self.__reply(response['status'], data, contentType='application/json; charset=UTF-8', headers=headers)
+        return True
+
+
+    def __authorized(self):
+        if self.headers.getheader('Authorization') == 'Bearer ' + self.server.token:
+            return True
+        self.__reply(401, [{ u'errorCode': u'INVALID_SESSION_ID', u'message': u'Session expired or invalid' }])
+        return False
+
+
+    def __reply(self, status, body, contentType='application/json', headers=None):
+        data = body if contentType != 'application/json' else json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer(HTTPServer):
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.states = [u'InProgress', u'JobComplete']
+        self.token = 'valid'
+        self.requests = []
+        self.script = {}
+        self.headers = []
+
+
+    def handle_error(self, request, client_address):
+        u"""Vom Client abgebrochene Verbindungen, z.B. nach einem Timeout, nicht ausgeben"""
+        pass
+
+
+if requests is not None:
+    class StubAdapter(HTTPAdapter):
+        u"""Leitet https://stub.test auf den lokalen Stub um"""
+
+        def __init__(self, port):
+            HTTPAdapter.__init__(self)
+            self.port = port
+
+        def send(self, request, **kwargs):
+            request.url = request.url.replace(u'https://' + INSTANCE, u'http://127.0.0.1:{0:d}' . format(self.port))
+            return HTTPAdapter.send(self, request, **kwargs)
+
+
+class FakeSalesforce(object):
+    u"""Die Attribute von simple_salesforce.Salesforce, die BulkQuery verwendet"""
+
+    def __init__(self, session, token):
+        self.session = session
+        self.sf_instance = INSTANCE
+        self.sf_version = u'38.0'
+        self.headers = { 'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json' }
+
+
+class FakeApp(object):
+    u"""Applikation mit den Attributen, die BulkQuery und GetInspections verwenden"""
+
+    def __init__(self, port, token):
+        self.session = requests.Session()
+        self.session.mount(u'https://' + INSTANCE, StubAdapter(port))
+        self.salesforce = FakeSalesforce(self.session, token)
+        self.config = SafeConfigParser()
+        self.config.add_section('salesforce')
+        self.logger = logging.getLogger('test_bulk_query')
+        self.metrics = RunMetrics()
+        self.logins = 0
+        self.restPages = []
+        self.restCalls = []
+
+
+    def refreshSalesforce(self, expired):
+        if self.salesforce is expired:
+            self.logins += 1
+            self.salesforce = FakeSalesforce(self.session, 'valid')
+
+
+    def callSalesforce(self, method, *args, **kwargs):
+        self.restCalls.append((method, args))
+        return self.restPages.pop(0)
+
+
+@unittest.skipIf(requests is None, u"requests or unicodecsv is not installed")
+class BulkQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.app = FakeApp(self.server.server_address[1], 'valid')
+        self.pollInterval, BulkQuery.POLL_INTERVAL = BulkQuery.POLL_INTERVAL, 0.01
+
+
+    def tearDown(self):
+        BulkQuery.POLL_INTERVAL = self.pollInterval
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def fetch(self):
+        return list(BulkQuery(self.app).iterPages(u"SELECT Id FROM Shopper_Inspection__c"))
+
+
+    def testJobCompleteFollowsLocatorChain(self):
+        pages = self.fetch()
+
+        self.assertEqual([len(page) for page in pages], [1, 1])
+        polls = [path for method, path, params in self.server.requests if path.endswith(JOB_ID)]
+        self.assertEqual(len(polls), 2)
+        results = [params for method, path, params in self.server.requests if path.endswith(u'/results')]
+        self.assertEqual([params.get(u'locator') for params in results], [None, u'1'])
+        self.assertEqual(results[0][u'maxRecords'], unicode(BulkQuery.MAX_RECORDS))
+        self.assertEqual(self.server.requests[0][2][u'operation'], u'query')
+        self.assertTrue(self.server.requests[0][1].endswith(u'/services/data/v47.0/jobs/query'))
+
+
+    def testNestRecord(self):
+        record = self.fetch()[0][0]
+
+        self.assertEqual(record.keys(), [u'attributes', u'Shopper_Contract__c', u'Id', u'Name', u'Shopper_Contract__r'])
+        self.assertEqual(record[u'attributes'], { u'type': BulkQuery.SOBJECT })
+        contract = record[u'Shopper_Contract__r']
+        self.assertEqual(contract[u'attributes'], { u'type': u'Shopper_Contract__r' })
+        self.assertEqual(contract[u'Account_Information__c'], ACCOUNT_INFORMATION)
+        self.assertIsNone(contract[u'Shelf_Details__c'])
+        self.assertIs(contract[u'IsDeleted'], False)
+        self.assertIs(contract[u'Active__c'], True)
+
+
+    def testPharmacyRecordFromBulkResult(self):
+        first, second = [PharmacyRecord.fromSalesforce(page[0]) for page in self.fetch()]
+
+        self.assertTrue(first.valid)
+        self.assertEqual(first.Shopper_Contract__c, u'a0B000000000001')
+        self.assertEqual(first.Id, u'a0C000000000001')
+        self.assertEqual(first.pharmacy, u'Apotheke am Markt')
+        self.assertEqual(first.sap_id, u'0012345')
+        self.assertEqual(first.strasse, u'Marktplatz 1')
+        self.assertEqual((first.plz, first.ort), (u'80331', u'München'))
+        self.assertEqual((first.state, first.country), (u'DE', u'Bayern'))
+        self.assertEqual(first.email, u'info@example.com')
+        self.assertEqual(first.phone, u'089 123456')
+        self.assertIs(first.Active__c, True)
+
+        self.assertFalse(second.valid)
+        self.assertEqual(second.Shelf_Details__c, u'Regal "links"')
+        self.assertIsNotNone(second.Account_Information__c)
+
+
+    def testFailedJobRaises(self):
+        self.server.states = [u'InProgress', u'Failed']
+        with self.assertRaises(BulkQueryError) as context:
+            self.fetch()
+        self.assertIn(u'failed', unicode(context.exception))
+        self.assertIn(u'stub says Failed', unicode(context.exception))
+        self.assertFalse([path for method, path, params in self.server.requests if path.endswith(u'/results')])
+
+
+    def testAbortedJobRaises(self):
+        self.server.states = [u'Aborted']
+        with self.assertRaises(BulkQueryError) as context:
+            self.fetch()
+        self.assertIn(u'aborted', unicode(context.exception))
+
+
+    def testExpiredSessionLogsInAgain(self):
+        self.app.salesforce = FakeSalesforce(self.app.session, 'expired')
+        pages = self.fetch()
+
+        self.assertEqual(self.app.logins, 1)
+        self.assertEqual([len(page) for page in pages], [1, 1])
+        self.assertEqual([method for method, path, params in self.server.requests[:2]], [u'POST', u'POST'])
+
+
+    def testAutoEngineSwitchesToBulkAboveThreshold(self):
+        self.app.restPages = [{ 'totalSize': GetInspections.BULK_THRESHOLD + 1, 'done': False,
+                'records': [{ u'Id': u'rest' }], 'nextRecordsUrl': u'/services/data/v38.0/query/01g-2000' }]
+        inspections = GetInspections(self.app, u'01.08.2018')
+        pages = list(inspections.iterAutoPages(u"SELECT Id FROM Shopper_Inspection__c"))
+
+        self.assertEqual(len(self.app.restCalls), 1)
+        self.assertEqual([page[0][u'Shopper_Contract__c'] for page in pages], [u'a0B000000000001', u'a0B000000000002'])
+        self.assertEqual(inspections.totalSize, GetInspections.BULK_THRESHOLD + 1)
+
+
+    def testAutoEngineKeepsRestBelowThreshold(self):
+        self.app.restPages = [{ 'totalSize': 1, 'done': True, 'records': [{ u'Id': u'rest' }] }]
+        pages = list(GetInspections(self.app, u'01.08.2018').iterAutoPages(u"SELECT Id FROM Shopper_Inspection__c"))
+
+        self.assertEqual(pages, [[{ u'Id': u'rest' }]])
+        self.assertEqual([method for method, args in self.app.restCalls], ['query'])
+        self.assertFalse(self.server.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
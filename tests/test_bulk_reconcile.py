@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Abgleich gegen eine temporäre PostgreSQL-Instanz (siehe benchmarks/bench_synchronize.py).
+
+Benötigt initdb/pg_ctl im PATH oder im Verzeichnis aus der Umgebungsvariable PGBIN sowie
+psycopg2. Fehlt eines davon, werden die Tests übersprungen. initdb läuft nicht als root.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, json, shutil, tempfile, unittest, StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+def findPgbin():
+    u"""Verzeichnis mit initdb, None, wenn keines gefunden wird"""
+    directories = [os.environ['PGBIN']] if os.environ.get('PGBIN') else os.environ.get('PATH', '').split(os.pathsep)
+    for directory in directories:
+        if os.access(os.path.join(directory, 'initdb'), os.X_OK):
+            return directory
+
+    return None
+
+try:
+    import psycopg2
+    import bench_synchronize as bench
+except ImportError:
+    bench = None
+
+class Output(StringIO.StringIO):
+    u"""Konsole für die Tests, unicode wird wie auf dem Terminal als UTF-8 geschrieben"""
+
+    def write(self, s):
+        StringIO.StringIO.write(self, s.encode('utf-8') if isinstance(s, unicode) else s)
+
+    def getvalue(self):
+        return StringIO.StringIO.getvalue(self).decode('utf-8')
+
+
+DATABASE = 'swdb_test'
+SIZE = 100
+EXISTING_RATIO = 0.8
+
+
+class DatabaseTestCase(unittest.TestCase):
+    u"""Temporärer Server je Testklasse mit SERVER_SETTINGS, die Datenbank wird je Test neu angelegt"""
+
+    SERVER_SETTINGS = None
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = bench.TempPostgres(findPgbin(), cls.SERVER_SETTINGS)
+        cls.server.start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+
+    def setUp(self):
+        self.existing, self.stale = bench.createDatabase(self.server, DATABASE, SIZE, EXISTING_RATIO, True)
+        self.directory = tempfile.mkdtemp()
+        self.rejectFile = os.path.join(self.directory, 'rejects.json')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def execute(self, query):
+        u"""Führt ein Statement auf der Testdatenbank aus und übernimmt es"""
+        connection = self.server.connect(DATABASE)
+        try:
+            connection.cursor().execute(query)
+            connection.commit()
+        finally:
+            connection.close()
+
+
+    def query(self, query):
+        connection = self.server.connect(DATABASE)
+        try:
+            cur = connection.cursor()
+            cur.execute(query)
+            return cur.fetchall()
+        finally:
+            connection.close()
+
+
+    def expectedDeactivations(self):
+        u"""Veraltete Apotheken, die createDatabase() aktiv anlegt (Outlet-Id durch 3 teilbar)"""
+        return sum(1 for id in xrange(self.existing + 1, self.existing + self.stale + 1) if id % 3 == 0)
+
+
+    def reconcile(self, bulk, malformed):
+        salesforce = bench.FakeSalesforce(SIZE, malformed=malformed)
+        app = bench.createApp(self.server, DATABASE, salesforce, bulk)
+        try:
+            inspections = bench.GetInspections(app, bench.TOUR_DATE)
+            if bulk:
+                result = app._App__swdb.bulkReconcile(inspections.iterInspections())
+            else:
+                result = app.reconcileRecords(inspections)
+            app.postgresql.rollback()
+        finally:
+            app.postgresql.close()
+
+        return result
+
+
+    def dispatchApp(self, **options):
+        u"""App für dispatch() mit --commit, Ausgabe auf der Konsole und [writeback]"""
+        app = bench.createApp(self.server, DATABASE, bench.FakeSalesforce(SIZE), False)
+        app.config.add_section('writeback')
+        app.config.set('writeback', 'statusField', 'SWDB_Synchronized__c')
+        app.config.add_section('postgresql')
+        app.config.set('postgresql', 'rejectFile', self.rejectFile)
+        settings = dict(commit=True, planOnly=False, quiet=False, outfile=None, shards=None, profile=None,
+                metricsJson=None, metricsProm=None, summary=True, limit=None, pageSize=0)
+        settings.update(options)
+        for key, value in settings.items():
+            setattr(app.options, key, value)
+        app.tourDates = [bench.TOUR_DATE]
+        app.connectPostgresql = lambda: self.server.connect(DATABASE)
+        return app
+
+
+    def dispatch(self, app):
+        stdout, sys.stdout = sys.stdout, Output()
+        try:
+            success = app.dispatch()
+            return success, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            app.postgresql.close()
+
+
+    def countPharmacies(self):
+        return self.query(u"SELECT count(*) FROM apo_masterdata")[0][0]
+
+
+    def countDigests(self):
+        return self.query(u"SELECT count(*) FROM sf_sync_digest")[0][0]
+
+
+    def failingNames(self, *indexes):
+        u"""Lässt das Anlegen der Apotheken mit diesen Indizes von FakeSalesforce scheitern"""
+        names = [u'SI-{0:06d}' . format(i) for i in indexes]
+        self.execute(u"""ALTER TABLE apo_masterdata ADD CONSTRAINT test_failing_names
+            CHECK (byr_name NOT IN ({0}))""" . format(u', ' . join(u"'{0}'" . format(name) for name in names)))
+        return names
+
+
+    def commitRun(self, salesforce=None, **options):
+        u"""Abgleich mit --commit ohne Ausgabe und Zurückschreiben, liefert die Kennzahlen des Laufs"""
+        app = self.dispatchApp(quiet=True, **options)
+        app.config.remove_section('writeback')
+        if salesforce:
+            app.salesforce = salesforce
+        app.writeMetrics = lambda success: None
+        success, output = self.dispatch(app)
+        self.assertTrue(success, output)
+        return app.metrics
+
+
+@unittest.skipIf(bench is None, u"psycopg2 is not installed")
+@unittest.skipIf(findPgbin() is None, u"initdb not found, set PGBIN")
+@unittest.skipIf(hasattr(os, 'geteuid') and os.geteuid() == 0, u"initdb cannot run as root")
+class ReconcileTest(DatabaseTestCase):
+
+    def testReportFailureAfterCommitKeepsChangesAndWritesBack(self):
+        app = self.dispatchApp()
+        def brokenPipe():
+            raise IOError(32, 'Broken pipe')
+        app.writeActivePharmaciesToStdout = brokenPipe
+        writebacks = []
+        app.writeBackToSalesforce = lambda: writebacks.append(True)
+
+        success, output = self.dispatch(app)
+
+        self.assertFalse(success)
+        self.assertIsInstance(app.lastError, IOError)
+        self.assertEqual(writebacks, [True])
+        self.assertNotIn(u'rollback', output)
+        self.assertIn(u'changes committed', output)
+        self.assertEqual(self.countPharmacies(), SIZE + self.stale)
+
+
+    def checkSchema(self, createIndexes=False):
+        from schema_check import SchemaCheck
+
+        app = self.dispatchApp()
+        stdout, sys.stdout = sys.stdout, Output()
+        try:
+            return SchemaCheck(app, app._App__swdb).run(createIndexes), sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            app.postgresql.close()
+
+
+    def testSchemaCheckAcceptsSeqScanOnSmallTables(self):
+        success, output = self.checkSchema()
+        self.assertTrue(success, output)
+
+
+    def testSchemaCheckReportsMissingIndex(self):
+        self.execute(u"DROP INDEX apo_masterdata_byr_salesforce_id_idx")
+
+        success, output = self.checkSchema()
+        self.assertFalse(success)
+        self.assertIn(u'FEHLT INDEX', output)
+
+
+    def testActivePharmaciesViewWithDuplicateCitymanager(self):
+        self.execute(u"""INSERT INTO outlet_gebietsleiter (outlet, gebietsleiter)
+            SELECT outlet, gebietsleiter FROM outlet_gebietsleiter WHERE outlet <= 3""")
+
+        app = self.dispatchApp()
+        try:
+            swdb = app._App__swdb
+            swdb.refreshActivePharmaciesView()
+            swdb.refreshActivePharmaciesView()
+            cur = app.postgresql.cursor()
+            cur.execute(u"SELECT count(*), count(DISTINCT id) FROM {0}" . format(swdb.ACTIVE_PHARMACIES_VIEW))
+            count, distinct = cur.fetchone()
+        finally:
+            app.postgresql.close()
+
+        self.assertEqual(count, distinct)
+
+
+    def testServerSideCursorStatisticsCoverTheFetches(self):
+        app = self.dispatchApp()
+        try:
+            swdb, metrics = app._App__swdb, app.metrics
+            rows = list(swdb.iterActivePharmacies(itersize=10))
+            entries = [entry for entry in metrics.statements() if u'LIMIT' in entry[u'query']]
+            fetched = metrics.get(u'sql_rows')
+
+            statements = len(metrics.statements())
+            swdb.getActivePharmaciesCursor(name='export_active_pharmacies').close()
+        finally:
+            app.postgresql.close()
+
+        self.assertGreater(len(rows), 10)
+        self.assertEqual([entry[u'count'] for entry in entries], [1])
+        self.assertEqual(fetched, len(rows))
+        self.assertEqual(len(metrics.statements()), statements)
+        self.assertEqual(metrics.get(u'sql_rows'), fetched)
+
+
+    def testPlanOnlySkipsReport(self):
+        app = self.dispatchApp(planOnly=True, outfile='unused.csv')
+        calls = []
+        app.writeActivePharmaciesToStdout = lambda: calls.append(u'stdout')
+        app.exportActivePharmacies = lambda: calls.append(u'export')
+
+        success, output = self.dispatch(app)
+
+        self.assertTrue(success)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.countPharmacies(), self.existing + self.stale)
+
+
+    def applyWithFailingRecords(self):
+        names = self.failingNames(SIZE - 15, SIZE - 10)
+        self.commitRun()
+        return names
+
+
+    def testFailingRecordDoesNotDiscardItsBatch(self):
+        names = self.applyWithFailingRecords()
+
+        self.assertEqual(self.countPharmacies(), SIZE + self.stale - len(names))
+        self.assertEqual(self.query(u"SELECT count(*) FROM apo_masterdata WHERE byr_name IN ('{0}')" .
+                format(u"', '" . join(names)))[0][0], 0)
+        self.assertEqual(self.query(u"""SELECT count(*) FROM outlet o
+            WHERE NOT EXISTS (SELECT 1 FROM apo_masterdata am WHERE am.id = o.id)""")[0][0], 0)
+
+
+    def testRejectFileHoldsExactlyTheFailedRecords(self):
+        names = self.applyWithFailingRecords()
+
+        with open(self.rejectFile, 'rb') as fp:
+            entries = json.load(fp)[u'records']
+        self.assertEqual(sorted(entry[u'record'][u'Name'] for entry in entries), names)
+        self.assertEqual(set(entry[u'stage'] for entry in entries), set([u'apply']))
+        self.assertTrue(all(entry[u'error'] for entry in entries))
+
+
+    def testResumeAppliesQuarantinedRecords(self):
+        self.applyWithFailingRecords()
+        active = self.query(u"SELECT count(*) FROM outlet WHERE aktiv")[0][0]
+        self.execute(u"ALTER TABLE apo_masterdata DROP CONSTRAINT test_failing_names")
+
+        self.commitRun(resume=True)
+
+        self.assertEqual(self.countPharmacies(), SIZE + self.stale)
+        self.assertEqual(self.query(u"SELECT count(*) FROM outlet WHERE aktiv")[0][0], active + 2)
+        self.assertFalse(os.path.exists(self.rejectFile))
+
+
+    def testSecondRunLeavesPharmaciesUnchanged(self):
+        first = self.commitRun()
+        self.assertEqual(first.get(u'pharmacies_updated'), self.existing)
+
+        second = self.commitRun()
+        self.assertEqual(second.get(u'pharmacies_created'), 0)
+        self.assertEqual(second.get(u'pharmacies_updated'), 0)
+
+
+    def testChangedFieldIsUpdatedAgain(self):
+        class ChangedSalesforce(bench.FakeSalesforce):
+            def record(self, i):
+                record = bench.FakeSalesforce.record(self, i)
+                if i == 5:
+                    record[u'Shopper_Contract__r'][u'Status__c'] = u'Inactive'
+                return record
+
+        self.commitRun()
+        metrics = self.commitRun(ChangedSalesforce(SIZE))
+
+        self.assertEqual(metrics.get(u'pharmacies_updated'), 1)
+        self.assertEqual(self.query(u"SELECT byr_status FROM apo_masterdata WHERE id = 6"), [(u'Inactive',)])
+
+
+    def testSeedDigestsDoesNotRewritePharmacies(self):
+        self.execute(u"UPDATE apo_masterdata SET byr_status = 'Seeded' WHERE id <= 10")
+
+        metrics = self.commitRun(seedDigests=True)
+
+        self.assertEqual(metrics.get(u'pharmacies_updated'), 0)
+        self.assertEqual(self.query(u"SELECT count(*) FROM apo_masterdata WHERE byr_status = 'Seeded'"), [(10,)])
+        self.assertEqual(self.countDigests(), SIZE)
+        self.assertEqual(self.commitRun().get(u'pharmacies_updated'), 0)
+
+
+    def testMissingDigestTableFailsUntilSchemaCheckCreatesIt(self):
+        self.execute(u"DROP TABLE sf_sync_digest")
+        app = self.dispatchApp(quiet=True)
+        app.config.remove_section('writeback')
+        success, output = self.dispatch(app)
+        self.assertFalse(success)
+        self.assertIn(u'sf_sync_digest does not exist', unicode(app.lastError))
+
+        success, output = self.checkSchema(createIndexes=True)
+        self.assertTrue(success, output)
+        self.assertEqual(self.countDigests(), 0)
+        self.commitRun()
+        self.assertEqual(self.countDigests(), SIZE)
+
+
+    def testShardsRequirePreparedTransactions(self):
+        from swdb import SWDBError
+
+        app = self.dispatchApp(quiet=True, shards=2)
+        success, output = self.dispatch(app)
+
+        self.assertFalse(success)
+        self.assertIsInstance(app.lastError, SWDBError)
+        self.assertIn(u'max_prepared_transactions', unicode(app.lastError))
+        self.assertEqual(self.countPharmacies(), self.existing + self.stale)
+
+
+    def testBulkRejectedRecordDoesNotSuppressDeactivation(self):
+        result = self.reconcile(True, malformed=1)
+        self.assertEqual(result[u'rejected'], 1)
+        self.assertEqual(result[u'created'], SIZE - self.existing - 1)
+        self.assertEqual(result[u'deactivated'], self.expectedDeactivations())
+
+
+    def testBulkFetchErrorDuringCopyIsRaisedUnchanged(self):
+        class FetchError(Exception):
+            pass
+
+        salesforce = bench.FakeSalesforce(SIZE)
+        app = bench.createApp(self.server, DATABASE, salesforce, True)
+        fetched = []
+        def records():
+            for record in bench.GetInspections(app, bench.TOUR_DATE).iterInspections():
+                fetched.append(record)
+                yield record
+            raise FetchError(u"connection reset")
+
+        try:
+            swdb = app._App__swdb
+            swdb.createStagingTable()
+            self.assertRaises(FetchError, swdb.loadStagingTable, records())
+            self.assertEqual(len(fetched), SIZE)
+        finally:
+            app.postgresql.rollback()
+            app.postgresql.close()
+
+
+    def testRecordsRejectedRecordDoesNotSuppressDeactivation(self):
+        result = self.reconcile(False, malformed=1)
+        self.assertEqual(result[u'rejected'], 1)
+        self.assertEqual(result[u'created'], SIZE - self.existing - 1)
+        self.assertEqual(result[u'deactivated'], self.expectedDeactivations())
+
+
+    def testBulkAndRecordsAgree(self):
+        bulk = self.reconcile(True, malformed=0)
+        self.setUp()
+        records = self.reconcile(False, malformed=0)
+        for key in (u'created', u'rejected', u'activated', u'deactivated', u'unchanged'):
+            self.assertEqual(bulk[key], records[key], key)
+
+
+@unittest.skipIf(bench is None, u"psycopg2 is not installed")
+@unittest.skipIf(findPgbin() is None, u"initdb not found, set PGBIN")
+@unittest.skipIf(hasattr(os, 'geteuid') and os.geteuid() == 0, u"initdb cannot run as root")
+class ShardedReconcileTest(DatabaseTestCase):
+    u"""Paralleler Abgleich (--shards) mit Two-Phase-Commit, der Server erlaubt vorbereitete Transaktionen"""
+
+    SERVER_SETTINGS = { 'max_prepared_transactions': 4 }
+    SHARDS = 3
+
+    def preparedTransactions(self):
+        return self.query(u"SELECT count(*) FROM pg_prepared_xacts")[0][0]
+
+
+    def testShardsCommitTogether(self):
+        metrics = self.commitRun(shards=self.SHARDS)
+
+        self.assertEqual(metrics.get(u'pharmacies_created'), SIZE - self.existing)
+        self.assertEqual(metrics.get(u'pharmacies_deactivated'), self.expectedDeactivations())
+        self.assertEqual(self.countPharmacies(), SIZE + self.stale)
+        self.assertEqual(self.query(u"SELECT count(*) FROM outlet WHERE aktiv AND id <= {0:d}" . format(self.existing)),
+                [(self.existing,)])
+        self.assertEqual(self.preparedTransactions(), 0)
+
+
+    def testFailingShardRollsBackAllShards(self):
+        self.failingNames(SIZE - 10)
+        active = self.query(u"SELECT count(*) FROM outlet WHERE aktiv")
+
+        app = self.dispatchApp(quiet=True, shards=self.SHARDS)
+        app.config.remove_section('writeback')
+        success, output = self.dispatch(app)
+
+        self.assertFalse(success)
+        self.assertEqual(self.countPharmacies(), self.existing + self.stale)
+        self.assertEqual(self.query(u"SELECT count(*) FROM outlet WHERE aktiv"), active)
+        self.assertEqual(self.preparedTransactions(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
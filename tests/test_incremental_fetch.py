@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Inkrementeller Abruf mit GetInspections und InspectionState: der erste Lauf legt den Stand
+mit der Watermark ab, der zweite führt geänderte und gelöschte Inspektionen damit zusammen.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, shutil, tempfile, datetime, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from optparse import Values
+from ConfigParser import SafeConfigParser
+
+from bayershopper_synchronize import App
+from get_inspections import GetInspections
+from inspection_state import InspectionState
+from run_metrics import RunMetrics
+
+TOUR_DATE = u'01.08.2018'
+
+
+def inspection(inspectionId, modstamp, name=None, status=GetInspections.STATUS_OPEN):
+    u"""Inspektion, wie query() sie liefert"""
+    return { u'Id': inspectionId, u'Name': name or inspectionId, u'Status__c': status,
+            u'Shopper_Contract__c': u'a0B' + inspectionId[3:], u'SystemModstamp': modstamp + u'.000+0000',
+            u'Shopper_Contract__r': { u'Account_Information__c': u'Apotheke<br>4711<br>Hauptstr. 1<br>'
+                    u'50667 Köln<br>NRW DE<br><br>E-Mail: info@example.com<br>Tel: 0221 1',
+                    u'SystemModstamp': u'2018-07-01T00:00:00.000+0000' } }
+
+
+class FakeSalesforce(object):
+    u"""
+        Liefert für die Abfrage geänderter Inspektionen (SystemModstamp > ...) changed, sonst
+        records, und über den queryAll-Endpunkt deleted, eine Seite je Liste. Die Aufrufe
+        werden in calls vermerkt.
+    """
+
+    def __init__(self, records, changed=(), deleted=()):
+        self.records, self.changed, self.deleted = list(records), list(changed), list(deleted)
+        self.calls = []
+
+    def query(self, query, include_deleted=False):
+        self.calls.append((u'query', query, include_deleted))
+        if include_deleted:
+            return self.__page(0)
+        records = self.changed if u'SystemModstamp >' in query else self.records
+        return { u'done': True, u'totalSize': len(records), u'records': [dict(record) for record in records] }
+
+    def query_more(self, url, identifier_is_url=False, include_deleted=False):
+        self.calls.append((u'query_more', url, include_deleted))
+        return self.__page(int(url.rsplit('-', 1)[1]))
+
+    def __page(self, index):
+        page = { u'done': index + 1 >= len(self.deleted), u'totalSize': sum(len(page) for page in self.deleted),
+                u'records': list(self.deleted[index]) if self.deleted else [] }
+        if not page[u'done']:
+            page[u'nextRecordsUrl'] = u'/services/data/v42.0/query/01g-{0:d}' . format(index + 1)
+        return page
+
+
+def createApp(directory):
+    u"""App ohne Konstruktor mit InspectionState, wie tests/test_multi_day.createApp()"""
+    app = object.__new__(App)
+    app.config = SafeConfigParser()
+    app.options = Values({ 'quiet': True, 'progress': False, 'engine': 'rest', 'full': False, 'refresh': False })
+    app.logger = logging.getLogger('test_incremental_fetch')
+    app.metrics = RunMetrics()
+    app.inspectionState = InspectionState(app, directory, margin=0)
+    return app
+
+
+class IncrementalFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_incremental_fetch-')
+        self.app = createApp(self.directory)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def fetch(self, salesforce):
+        self.app.salesforce = salesforce
+        inspections = GetInspections(self.app, TOUR_DATE)
+        return inspections, list(inspections.iterInspections())
+
+
+    def load(self):
+        inspections = GetInspections(self.app, TOUR_DATE)
+        return self.app.inspectionState.load(datetime.datetime(2018, 8, 1), inspections.buildQuery())
+
+
+    def testFirstRunSavesWatermark(self):
+        self.fetch(FakeSalesforce([inspection(u'a0C1', u'2018-07-31T10:00:00'),
+                inspection(u'a0C2', u'2018-07-31T12:00:00')]))
+
+        watermark, records = self.load()
+        self.assertEqual(watermark, u'2018-07-31T12:00:00')
+        self.assertEqual(records.keys(), [u'a0C1', u'a0C2'])
+
+
+    def testSecondRunMergesChangedAndDeletedRecords(self):
+        self.fetch(FakeSalesforce([inspection(u'a0C1', u'2018-07-31T10:00:00'),
+                inspection(u'a0C2', u'2018-07-31T11:00:00'), inspection(u'a0C3', u'2018-07-31T12:00:00')]))
+
+        salesforce = FakeSalesforce([], changed=[
+                inspection(u'a0C1', u'2018-07-31T13:00:00', name=u'renamed'),
+                inspection(u'a0C3', u'2018-07-31T14:00:00', status=u'Done'),
+                inspection(u'a0C4', u'2018-07-31T15:00:00')],
+            deleted=[[{ u'Id': u'a0C2', u'SystemModstamp': u'2018-07-31T16:00:00.000+0000' }],
+                [{ u'Id': u'a0C9', u'SystemModstamp': u'2018-07-31T17:00:00.000+0000' }]])
+        inspections, records = self.fetch(salesforce)
+
+        self.assertEqual([(record.Id, record.Name) for record in records],
+                [(u'a0C1', u'renamed'), (u'a0C4', u'a0C4')])
+        self.assertEqual(inspections.totalSize, 2)
+        self.assertEqual([call[0] for call in salesforce.calls], [u'query', u'query', u'query_more'])
+        self.assertIn(u'SystemModstamp > 2018-07-31T12:00:00Z', salesforce.calls[0][1])
+        self.assertEqual([call[2] for call in salesforce.calls], [False, True, True])
+        self.assertEqual(self.app.metrics.get(u'salesforce_api_calls'), 1 + 3)
+        self.assertEqual(self.app.metrics.get(u'incremental_updated'), 2)
+        self.assertEqual(self.app.metrics.get(u'incremental_removed'), 2)
+
+        watermark, known = self.load()
+        self.assertEqual(watermark, u'2018-07-31T17:00:00')
+        self.assertEqual(known.keys(), [u'a0C1', u'a0C4'])
+        self.assertEqual(known[u'a0C1'][u'Name'], u'renamed')
+
+
+    def testNoRecordsSaveNoState(self):
+        self.fetch(FakeSalesforce([]))
+        self.assertIsNone(self.load())
+
+        salesforce = FakeSalesforce([inspection(u'a0C1', u'2018-07-31T10:00:00')])
+        inspections, records = self.fetch(salesforce)
+
+        self.assertEqual([record.Id for record in records], [u'a0C1'])
+        self.assertEqual([call[0] for call in salesforce.calls], [u'query'])
+        self.assertNotIn(u'SystemModstamp >', salesforce.calls[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Verbindungsaufbau mit App.initConnections(): --check-schema verbindet sich nur mit der SWDB.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from optparse import Values
+
+from bayershopper_synchronize import App
+
+
+class InitConnectionsTest(unittest.TestCase):
+
+    def connect(self, **options):
+        u"""Ruft initConnections() mit Attrappen für beide Verbindungen auf, liefert die Aufrufe"""
+        calls = []
+        app = object.__new__(App)
+        app.options = Values(dict({ 'checkSchema': False }, **options))
+        app.logger = logging.getLogger('test_init_connections')
+        app.initSalesforce = lambda: calls.append(u'salesforce')
+        app.initPostgresql = lambda: calls.append(u'postgresql')
+        app.initConnections()
+        return sorted(calls)
+
+
+    def testSynchronizeConnectsBoth(self):
+        self.assertEqual(self.connect(), [u'postgresql', u'salesforce'])
+
+
+    def testCheckSchemaSkipsSalesforceLogin(self):
+        self.assertEqual(self.connect(checkSchema=True), [u'postgresql'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Abruf mehrerer Tourdaten mit MultiDayInspections und Vormerken der Inspektionen für das
+Zurückschreiben, auch der als doppelte Verträge verworfenen.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from optparse import Values
+from ConfigParser import SafeConfigParser
+
+from bayershopper_synchronize import App
+from get_inspections import MultiDayInspections
+from pharmacy_record import PharmacyRecord
+from salesforce_writeback import SalesforceWriteback
+
+TOUR_DATES = [u'01.08.2018', u'02.08.2018']
+
+
+def inspection(inspectionId, contract):
+    return PharmacyRecord.fromDict({ u'Id': inspectionId, u'Shopper_Contract__c': contract })
+
+
+class FakeDay(object):
+    u"""Ein Tourdatum mit festen Inspektionen, Schnittstelle wie GetInspections"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def getInspections(self):
+        return self.records
+
+
+def createApp():
+    u"""App ohne Konstruktor mit [writeback], wie benchmarks/bench_synchronize.createApp()"""
+    config = SafeConfigParser()
+    config.add_section('writeback')
+    config.set('writeback', 'statusField', 'SWDB_Synchronized__c')
+
+    app = object.__new__(App)
+    app.config = config
+    app.options = Values({ 'quiet': True, 'progress': False })
+    app.logger = logging.getLogger('test_multi_day')
+    app.salesforce = None
+    app._App__writeback = SalesforceWriteback(app)
+    return app
+
+
+class MultiDayInspectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = createApp()
+        self.inspections = MultiDayInspections(self.app, TOUR_DATES)
+        self.inspections._MultiDayInspections__days = [
+            FakeDay([inspection(u'a0C1', u'a0B1'), inspection(u'a0C2', u'a0B2')]),
+            FakeDay([inspection(u'a0C3', u'a0B2'), inspection(u'a0C4', u'a0B3')]),
+        ]
+
+
+    def testDuplicateContractsAreDeliveredOnce(self):
+        records = list(self.inspections.iterInspections())
+        self.assertEqual([record.Id for record in records], [u'a0C1', u'a0C2', u'a0C4'])
+        self.assertEqual([record.Id for record in self.inspections.duplicates], [u'a0C3'])
+
+
+    def testDuplicateInspectionsAreTrackedForWriteback(self):
+        records = list(self.app.echoRecords(self.inspections))
+        tracked = self.app._App__writeback._SalesforceWriteback__inspections
+        self.assertEqual(len(records), 3)
+        self.assertEqual(sorted(tracked.keys()), [u'a0C1', u'a0C2', u'a0C3', u'a0C4'])
+        self.assertEqual(tracked[u'a0C3'], u'a0B2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Zerlegen von Account_Information__c mit PharmacyRecord im Vergleich zur ursprünglichen
+Zerlegung in GetInspections.splitAccountInformation().
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, unittest, collections
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from pharmacy_record import PharmacyRecord
+
+REGULAR = u'Apotheke am Markt<br>0004711<br>Hauptstraße 1<br>80331 München<br>DE Bayern<br><br>' \
+        u'E-Mail: info@example.com<br>Telefon: 089 12345'
+MIXED_CASE = REGULAR.replace(u'<br>', u'<BR>', 2)
+SELF_CLOSING = REGULAR.replace(u'<br>', u'<br/>', 2)
+PADDED = u' Apotheke am Markt <br> 0004711<br>Hauptstraße 1 <br>80331  München<br>DE Bayern<br> <br>' \
+        u'E-Mail:  info@example.com<br>Telefon: 089 12345 '
+
+
+def splitAccountInformation(record):
+    u"""Zerlegung, wie GetInspections sie vor PharmacyRecord vorgenommen hat"""
+    parts = record[u'Account_Information__c'].split('<br>')
+    if isinstance(parts, list) and len(parts) > 7:
+        d = collections.OrderedDict()
+        d[u'pharmacy'] = parts[0]
+        d[u'sap_id'] = parts[1]
+        d[u'strasse'] = parts[2]
+        d[u'plz'], void, d[u'ort'] = parts[3].partition(u' ')
+        d[u'state'], void, d[u'country'] = parts[4].partition(u' ')
+        d[u'extra'] = parts[5]
+        void, void, d[u'email'] = parts[6].partition(u' ')
+        void, void, d[u'phone'] = parts[7].partition(u' ')
+        record.update(d)
+        del record[u'Account_Information__c']
+
+
+class PharmacyRecordTest(unittest.TestCase):
+
+    def parse(self, blob):
+        return PharmacyRecord.fromSalesforce({ u'Id': u'a0C1', u'Shopper_Contract__r':
+                { u'Account_Information__c': blob } })
+
+
+    def assertSplitAsBefore(self, blob):
+        expected = { u'Account_Information__c': blob }
+        splitAccountInformation(expected)
+        record = self.parse(blob)
+        if u'Account_Information__c' in expected:
+            self.assertFalse(record.valid)
+            self.assertEqual(record.Account_Information__c, blob)
+        else:
+            self.assertTrue(record.valid, record.error)
+            self.assertEqual(dict((key, record[key]) for key in expected), expected)
+
+
+    def testRegularBlob(self):
+        record = self.parse(REGULAR)
+        self.assertTrue(record.valid)
+        self.assertEqual((record.plz, record.ort, record.state, record.country),
+                (u'80331', u'München', u'DE', u'Bayern'))
+        self.assertEqual((record.extra, record.email, record.phone), (u'', u'info@example.com', u'089 12345'))
+        self.assertSplitAsBefore(REGULAR)
+
+
+    def testOnlyLowerCaseBrSeparates(self):
+        for blob in (MIXED_CASE, SELF_CLOSING):
+            record = self.parse(blob)
+            self.assertFalse(record.valid)
+            self.assertEqual(record.error, u"Account_Information__c has 6 of 8 parts")
+            self.assertSplitAsBefore(blob)
+
+
+    def testPaddedFieldsAreKept(self):
+        record = self.parse(PADDED)
+        self.assertEqual((record.pharmacy, record.sap_id, record.strasse), (u' Apotheke am Markt ', u' 0004711',
+                u'Hauptstraße 1 '))
+        self.assertEqual((record.plz, record.ort, record.extra, record.email), (u'80331', u' München', u' ',
+                u' info@example.com'))
+        self.assertSplitAsBefore(PADDED)
+
+
+    def testMissingBlob(self):
+        record = PharmacyRecord.fromSalesforce({ u'Id': u'a0C1' })
+        self.assertFalse(record.valid)
+        self.assertEqual(record.error, u"Account_Information__c missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
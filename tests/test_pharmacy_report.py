@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Seitenweise Ausgabe der aktiven Apotheken mit PharmacyReport.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, unittest, StringIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from pharmacy_report import PharmacyReport
+
+
+class FakeApp(object):
+
+    def __init__(self):
+        self.logger = logging.getLogger('test_pharmacy_report')
+
+
+class FakeSWDB(object):
+    u"""Liefert count aktive Apotheken, Schnittstelle wie SWDB.iterActivePharmacies()"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def iterActivePharmacies(self, limit=None):
+        for id in xrange(1, min(self.count, limit or self.count) + 1):
+            yield { u'id': id, u'name': u'Apotheke {0:d}' . format(id), u'strasse': None, u'plz': None,
+                    u'ort': None, u'byr_status': u'Active', u'citymanager': None }
+
+
+class PharmacyReportTest(unittest.TestCase):
+
+    def render(self, count, pageSize):
+        stream = StringIO.StringIO()
+        rows = PharmacyReport(FakeApp(), FakeSWDB(count), stream).render(pageSize=pageSize)
+        headers = stream.getvalue().count(u'Citymanager')
+        return rows, headers
+
+
+    def testHeaderRepeatedPerPage(self):
+        self.assertEqual(self.render(5, 2), (5, 3))
+        self.assertEqual(self.render(4, 2), (4, 2))
+
+
+    def testPageSizeOne(self):
+        self.assertEqual(self.render(3, 1), (3, 3))
+
+
+    def testWithoutPages(self):
+        self.assertEqual(self.render(5, 0), (5, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
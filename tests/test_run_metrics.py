@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+Ausgabe der Kennzahlen mit RunMetrics als JSON und im Prometheus-Textformat.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, json, stat, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from run_metrics import RunMetrics
+
+PREFIX = RunMetrics.PROMETHEUS_PREFIX
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_run_metrics-')
+        self.metrics = RunMetrics()
+        self.metrics.addTime(u'login', 0.25)
+        self.metrics.addTime(u'commit', 1.5)
+        self.metrics.count(u'salesforce_api_calls', 3)
+        self.metrics.count(u'pharmacies_new')
+        for seconds in (0.1, 0.2, 0.3):
+            self.metrics.addStatement(u"SELECT id\n    FROM outlet", seconds)
+        self.metrics.addStatement(u"UPDATE outlet SET byr_status = 'Active'", 2.0)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as fp:
+            return fp.read().decode('utf-8')
+
+
+    def assertWrittenAtomically(self, name):
+        self.assertEqual(os.listdir(self.directory), [name])
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.directory, name)).st_mode), 0o644)
+
+
+    def testJson(self):
+        self.metrics.success = True
+        self.metrics.writeJson(os.path.join(self.directory, 'metrics.json'))
+
+        data = json.loads(self.read('metrics.json'))
+        self.assertWrittenAtomically('metrics.json')
+        self.assertTrue(data[u'success'])
+        self.assertEqual(data[u'stages'], { u'login': 0.25, u'commit': 1.5 })
+        self.assertEqual(data[u'counters'], { u'salesforce_api_calls': 3, u'pharmacies_new': 1 })
+        self.assertEqual([entry[u'query'] for entry in data[u'statements']],
+                [u"UPDATE outlet SET byr_status = 'Active'", u"SELECT id FROM outlet"])
+        select = data[u'statements'][1]
+        self.assertEqual(select[u'count'], 3)
+        self.assertAlmostEqual(select[u'total'], 0.6)
+        self.assertAlmostEqual(select[u'mean'], 0.2)
+        self.assertEqual(select[u'p95'], 0.3)
+
+
+    def testPrometheus(self):
+        self.metrics.success = True
+        self.metrics.writePrometheus(os.path.join(self.directory, 'metrics.prom'))
+
+        lines = self.read('metrics.prom').splitlines()
+        self.assertWrittenAtomically('metrics.prom')
+        self.assertIn(u'{0}_stage_seconds{{stage="login"}} 0.250000' . format(PREFIX), lines)
+        self.assertIn(u'{0}_stage_seconds{{stage="commit"}} 1.500000' . format(PREFIX), lines)
+        self.assertIn(u'{0}_count{{counter="salesforce_api_calls"}} 3' . format(PREFIX), lines)
+        self.assertIn(u'{0}_count{{counter="pharmacies_new"}} 1' . format(PREFIX), lines)
+        self.assertIn(u'{0}_success 1' . format(PREFIX), lines)
+        self.assertIn(u'# TYPE {0}_duration_seconds gauge' . format(PREFIX), lines)
+        self.assertFalse([line for line in lines if u'SELECT' in line])
+
+        samples = [line for line in lines if not line.startswith(u'#')]
+        for line in samples:
+            name, value = line.rsplit(u' ', 1)
+            self.assertTrue(name.startswith(PREFIX + u'_'))
+            float(value)
+
+
+    def testPrometheusFailedRun(self):
+        self.metrics.success = False
+        self.metrics.writePrometheus(os.path.join(self.directory, 'metrics.prom'))
+
+        self.assertIn(u'{0}_success 0' . format(PREFIX), self.read('metrics.prom').splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
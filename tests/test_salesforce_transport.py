@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+SalesforceTransport gegen den HTTP-Stub aus test_bulk_query.py: Wiederholungen idempotenter
+Aufrufe, gzip, Default-Timeout und die Drosselung anhand von Sforce-Limit-Info. Benötigt
+requests, sonst werden die Tests übersprungen.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, threading, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from ConfigParser import SafeConfigParser
+
+from test_bulk_query import StubServer, requests
+from run_metrics import RunMetrics
+
+if requests is not None:
+    from salesforce_transport import SalesforceTransport
+
+PATH = u'/services/data/v42.0/limits'
+OK = { 'status': 200, 'body': { u'ok': True } }
+UNAVAILABLE = { 'status': 503, 'body': [{ u'errorCode': u'SERVER_UNAVAILABLE' }] }
+
+
+class FakeApp(object):
+    u"""Applikation mit den Attributen, die SalesforceTransport verwendet"""
+
+    def __init__(self, **settings):
+        self.config = SafeConfigParser()
+        self.config.add_section('salesforce')
+        settings.setdefault('backoff', '0')
+        for key, value in settings.items():
+            self.config.set('salesforce', key, value)
+        self.logger = logging.getLogger('test_salesforce_transport')
+        self.metrics = RunMetrics()
+
+
+@unittest.skipIf(requests is None, u"requests is not installed")
+class SalesforceTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = u'http://127.0.0.1:{0:d}{1}' . format(self.server.server_address[1], PATH)
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def createSession(self, **settings):
+        self.app = FakeApp(**settings)
+        self.transport = SalesforceTransport(self.app)
+        return self.transport.createSession()
+
+
+    def calls(self):
+        return len(self.server.headers)
+
+
+    def testIdempotentCallRetriedOnServerError(self):
+        self.server.script[PATH] = [UNAVAILABLE, UNAVAILABLE, OK]
+
+        response = self.createSession().get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls(), 3)
+        self.assertEqual(self.app.metrics.get(u'salesforce_retries'), 2)
+
+
+    def testRetriesExhaustedReturnLastResponse(self):
+        self.server.script[PATH] = [UNAVAILABLE]
+
+        response = self.createSession(retries='2').get(self.url)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.calls(), 3)
+
+
+    def testPostNotRetriedOnServerError(self):
+        self.server.script[PATH] = [UNAVAILABLE, OK]
+
+        response = self.createSession().post(self.url, json={ u'query': u'SELECT Id FROM Account' })
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.calls(), 1)
+
+
+    def testGzipRequestedAndDecoded(self):
+        self.server.script[PATH] = [dict(OK, gzip=True)]
+
+        response = self.createSession().get(self.url)
+
+        self.assertIn(u'gzip', self.server.headers[0]['accept-encoding'])
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.json(), { u'ok': True })
+
+
+    def testDefaultTimeout(self):
+        self.server.script[PATH] = [dict(OK, delay=0.5)]
+        session = self.createSession(timeout='0.1', retries='0')
+
+        self.assertRaises(requests.exceptions.ConnectionError, session.get, self.url)
+
+
+    def testLimitInfoThrottlesAndSkipsOptionalCalls(self):
+        self.server.script[PATH] = [dict(OK, headers={ 'Sforce-Limit-Info': 'api-usage=950/1000' })]
+        session = self.createSession(quotaReserve='0.1', throttleDelay='0.01')
+
+        self.assertTrue(self.transport.allowOptional(u'getMetadata'))
+        session.get(self.url)
+
+        self.assertEqual(self.transport.apiUsage(), (950, 1000))
+        self.assertTrue(self.transport.isLow())
+        self.assertFalse(self.transport.allowOptional(u'getMetadata'))
+        self.assertEqual(self.app.metrics.get(u'salesforce_throttled'), 0)
+
+        session.get(self.url)
+        self.assertEqual(self.app.metrics.get(u'salesforce_throttled'), 1)
+
+
+    def testLimitInfoAboveReserveDoesNotThrottle(self):
+        self.server.script[PATH] = [dict(OK, headers={ 'Sforce-Limit-Info': 'api-usage=100/1000' })]
+        session = self.createSession()
+
+        session.get(self.url)
+        session.get(self.url)
+
+        self.assertFalse(self.transport.isLow())
+        self.assertEqual(self.app.metrics.get(u'salesforce_throttled'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+u"""
+SyncDaemon.runSync() bei einer nicht erreichbaren SWDB. Benötigt psycopg2 und
+simple_salesforce, sonst werden die Tests übersprungen.
+
+Aufruf:
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import os, sys, logging, unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'classes')))
+
+from optparse import Values
+from ConfigParser import SafeConfigParser
+
+try:
+    import psycopg2
+    from sync_daemon import SyncDaemon
+except ImportError:
+    SyncDaemon = None
+
+from run_metrics import RunMetrics
+
+
+class FakeConnection(object):
+    u"""Verbindung, die bis zu connect() geschlossen ist"""
+
+    def __init__(self, closed):
+        self.closed = closed
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        pass
+
+    def close(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeApp(object):
+    u"""Applikation, deren SWDB erst nach 'outages' Verbindungsversuchen wieder erreichbar ist"""
+
+    APPNAME = u'test_sync_daemon'
+
+    def __init__(self, outages):
+        self.config = SafeConfigParser()
+        self.options = Values({ 'refresh': False })
+        self.logger = logging.getLogger('test_sync_daemon')
+        self.metrics = RunMetrics()
+        self.postgresql = FakeConnection(closed=True)
+        self.outages = outages
+        self.dispatched = 0
+        self.failedRuns = 0
+        self.lastError = None
+        self.tourDates = None
+
+    def initPostgresql(self):
+        if self.outages:
+            self.outages -= 1
+            raise psycopg2.OperationalError(u"could not connect to server: Connection refused")
+        self.postgresql = FakeConnection(closed=False)
+
+    def dispatch(self):
+        self.dispatched += 1
+        return True
+
+    def writeMetrics(self, success):
+        if not success:
+            self.failedRuns += 1
+
+
+@unittest.skipIf(SyncDaemon is None, u"psycopg2 or simple_salesforce is not installed")
+class SyncDaemonTest(unittest.TestCase):
+
+    def testDatabaseOutageFailsRunWithoutStoppingDaemon(self):
+        app = FakeApp(outages=2)
+        daemon = SyncDaemon(app)
+
+        self.assertFalse(daemon.runSync())
+        self.assertIsInstance(app.lastError, psycopg2.OperationalError)
+        self.assertFalse(daemon.runSync())
+        self.assertEqual((app.dispatched, app.failedRuns), (0, 2))
+        self.assertEqual(app.metrics.get(u'daemon_errors'), 2)
+
+        self.assertTrue(daemon.runSync())
+        self.assertEqual(app.dispatched, 1)
+
+
+    def testDispatchRaisingFailsRun(self):
+        app = FakeApp(outages=0)
+        def dispatch():
+            raise psycopg2.InterfaceError(u"connection already closed")
+        app.dispatch = dispatch
+
+        self.assertFalse(SyncDaemon(app).runSync([u'01.08.2018']))
+        self.assertIsInstance(app.lastError, psycopg2.InterfaceError)
+        self.assertEqual(app.tourDates, [u'01.08.2018'])
+
+
+if __name__ == '__main__':
+    unittest.main()